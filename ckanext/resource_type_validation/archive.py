@@ -0,0 +1,270 @@
+# encoding: utf-8
+""" Structural inspection of archive uploads.
+
+Only archive metadata is read: the ZIP central directory, or the tar
+member headers, located by seeking. No member is ever decompressed, so
+the cost depends on the number of entries rather than the file size.
+A ZIP archive can also be checked from just its last bytes, if its
+central directory is among them.
+"""
+
+from fnmatch import fnmatchcase
+from logging import getLogger
+import os
+import struct
+import tarfile
+import typing
+
+LOG = getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 50000
+DEFAULT_MAX_RATIO = 250
+DEFAULT_MAX_SIZE = 20 * 1024 * 1024 * 1024
+
+# ZIP record layouts, per APPNOTE.TXT
+END_RECORD = struct.Struct('<4s4H2LH')
+END_RECORD_SIGNATURE = b'PK\x05\x06'
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_END_RECORD_SIGNATURE = b'PK\x06\x06'
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+ZIP64_EXTRA_ID = 0x0001
+MAX_COMMENT_LENGTH = 0xFFFF
+UTF8_NAME_FLAG = 0x800
+
+
+class ArchiveError(Exception):
+    """ The archive is malformed, exceeds a limit, or lacks the
+    members expected of its type.
+    """
+
+
+class _Unavailable(Exception):
+    """ The part of an archive needed is not at hand.
+    """
+
+
+class _TailStream:
+    """ The last bytes of a file, read as if from the whole file.
+    Reading from before them raises _Unavailable.
+    """
+
+    def __init__(self, tail: bytes, offset: int):
+        self.tail = tail
+        self.offset = offset
+        self.position = offset
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.offset + len(self.tail)
+        self.position = offset
+        return offset
+
+    def read(self, size: int) -> bytes:
+        if self.position < self.offset:
+            raise _Unavailable()
+        start = self.position - self.offset
+        data = self.tail[start:start + size]
+        self.position += len(data)
+        return data
+
+
+class ArchiveLimits(typing.NamedTuple):
+    max_entries: int = DEFAULT_MAX_ENTRIES
+    # ratio of total uncompressed size to archive file size
+    max_ratio: float = DEFAULT_MAX_RATIO
+    # total uncompressed size in bytes
+    max_size: int = DEFAULT_MAX_SIZE
+
+
+class ArchiveSummary:
+    """ Running totals for the entries of an archive,
+    checked against limits as each entry is added.
+    """
+
+    def __init__(self, archive_size: int, limits: ArchiveLimits, required_members: 'list[str]'):
+        self.archive_size = archive_size
+        self.limits = limits
+        self.missing_members = {pattern.lower() for pattern in required_members}
+        self.entries = 0
+        self.uncompressed_size = 0
+
+    def add(self, name: str, uncompressed_size: int) -> None:
+        self.entries += 1
+        self.uncompressed_size += uncompressed_size
+        if self.entries > self.limits.max_entries:
+            raise ArchiveError("more than {} entries".format(self.limits.max_entries))
+        if self.uncompressed_size > self.limits.max_size:
+            raise ArchiveError("more than {} bytes uncompressed".format(self.limits.max_size))
+        if self.uncompressed_size > self.limits.max_ratio * max(self.archive_size, 1):
+            raise ArchiveError("compression ratio above {}".format(self.limits.max_ratio))
+        if self.missing_members:
+            lower_name = name.lower()
+            self.missing_members = {pattern for pattern in self.missing_members
+                                    if not fnmatchcase(lower_name, pattern)}
+
+    def finish(self) -> 'ArchiveSummary':
+        if self.missing_members:
+            raise ArchiveError("no member matching {}".format(sorted(self.missing_members)))
+        return self
+
+
+def _read_exactly(stream: 'typing.IO[bytes]|_TailStream', size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise ArchiveError("truncated archive")
+    return data
+
+
+def _find_end_record(stream: 'typing.IO[bytes]', archive_size: int) -> 'tuple[int, tuple[typing.Any, ...]]':
+    """ Locate the end of central directory record, which may be
+    followed by a comment of up to 64 KiB.
+    """
+    tail_size = min(archive_size, END_RECORD.size + MAX_COMMENT_LENGTH)
+    stream.seek(archive_size - tail_size, os.SEEK_SET)
+    return _end_record_in(stream.read(tail_size), archive_size - tail_size)
+
+
+def _end_record_in(tail: bytes, tail_offset: int) -> 'tuple[int, tuple[typing.Any, ...]]':
+    position = tail.rfind(END_RECORD_SIGNATURE)
+    if position < 0 or position + END_RECORD.size > len(tail):
+        raise ArchiveError("no ZIP end of central directory record")
+    return tail_offset + position, END_RECORD.unpack_from(tail, position)
+
+
+def _central_directory(stream: 'typing.IO[bytes]|_TailStream', end_offset: int,
+                       end_record: 'tuple[typing.Any, ...]') -> 'tuple[int, int]':
+    """ Returns the entry count and actual starting offset
+    of the central directory.
+    """
+    entries, directory_size, directory_offset = end_record[4], end_record[5], end_record[6]
+    records_size = END_RECORD.size
+    if entries == 0xFFFF or 0xFFFFFFFF in (directory_size, directory_offset):
+        if end_offset < ZIP64_LOCATOR.size:
+            raise ArchiveError("missing ZIP64 locator")
+        stream.seek(end_offset - ZIP64_LOCATOR.size, os.SEEK_SET)
+        locator = ZIP64_LOCATOR.unpack(_read_exactly(stream, ZIP64_LOCATOR.size))
+        if locator[0] != ZIP64_LOCATOR_SIGNATURE:
+            raise ArchiveError("missing ZIP64 locator")
+        stream.seek(end_offset - ZIP64_LOCATOR.size - ZIP64_END_RECORD.size, os.SEEK_SET)
+        zip64_record = ZIP64_END_RECORD.unpack(_read_exactly(stream, ZIP64_END_RECORD.size))
+        if zip64_record[0] != ZIP64_END_RECORD_SIGNATURE:
+            raise ArchiveError("missing ZIP64 end of central directory record")
+        entries, directory_size, directory_offset = zip64_record[7], zip64_record[8], zip64_record[9]
+        records_size += ZIP64_LOCATOR.size + ZIP64_END_RECORD.size
+    # allow for data prepended to the archive, eg self-extractors
+    directory_start = end_offset + END_RECORD.size - records_size - directory_size
+    if directory_start < 0 or directory_offset > directory_start:
+        raise ArchiveError("invalid central directory offset")
+    return entries, directory_start
+
+
+def _zip64_uncompressed_size(extra: bytes) -> int:
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, data_size = struct.unpack_from('<2H', extra, position)
+        if header_id == ZIP64_EXTRA_ID and data_size >= 8:
+            return struct.unpack_from('<Q', extra, position + 4)[0]
+        position += 4 + data_size
+    raise ArchiveError("missing ZIP64 size")
+
+
+def inspect_zip(stream: 'typing.IO[bytes]', limits: ArchiveLimits,
+                required_members: 'list[str]') -> ArchiveSummary:
+    archive_size = stream.seek(0, os.SEEK_END)
+    end_offset, end_record = _find_end_record(stream, archive_size)
+    return _read_central_directory(stream, archive_size, end_offset, end_record, limits, required_members)
+
+
+def inspect_zip_tail(tail: bytes, archive_size: int, limits: ArchiveLimits,
+                     required_members: 'list[str]') -> 'ArchiveSummary|None':
+    """ Check a ZIP archive of 'archive_size' bytes from its last bytes,
+    'tail', eg as an upload arrives.
+
+    Returns None if the central directory isn't entirely within 'tail'.
+    """
+    tail_offset = archive_size - len(tail)
+    try:
+        end_offset, end_record = _end_record_in(tail, tail_offset)
+    except ArchiveError:
+        if tail_offset > 0:
+            # perhaps there is a long comment
+            return None
+        raise
+    try:
+        return _read_central_directory(_TailStream(tail, tail_offset), archive_size,
+                                       end_offset, end_record, limits, required_members)
+    except _Unavailable:
+        return None
+
+
+def _read_central_directory(stream: 'typing.IO[bytes]|_TailStream', archive_size: int, end_offset: int,
+                            end_record: 'tuple[typing.Any, ...]', limits: ArchiveLimits,
+                            required_members: 'list[str]') -> ArchiveSummary:
+    entries, directory_start = _central_directory(stream, end_offset, end_record)
+    if entries > limits.max_entries:
+        raise ArchiveError("more than {} entries".format(limits.max_entries))
+
+    summary = ArchiveSummary(archive_size, limits, required_members)
+    stream.seek(directory_start, os.SEEK_SET)
+    for _ in range(entries):
+        header = CENTRAL_HEADER.unpack(_read_exactly(stream, CENTRAL_HEADER.size))
+        if header[0] != CENTRAL_HEADER_SIGNATURE:
+            raise ArchiveError("corrupt central directory")
+        flags, uncompressed_size = header[5], header[11]
+        name_length, extra_length, comment_length = header[12], header[13], header[14]
+        raw_name = _read_exactly(stream, name_length)
+        extra = _read_exactly(stream, extra_length)
+        stream.seek(comment_length, os.SEEK_CUR)
+        if uncompressed_size == 0xFFFFFFFF:
+            uncompressed_size = _zip64_uncompressed_size(extra)
+        name = raw_name.decode('utf-8' if flags & UTF8_NAME_FLAG else 'cp437', 'replace')
+        summary.add(name, uncompressed_size)
+    return summary.finish()
+
+
+def inspect_tar(stream: 'typing.IO[bytes]', limits: ArchiveLimits,
+                required_members: 'list[str]') -> ArchiveSummary:
+    archive_size = stream.seek(0, os.SEEK_END)
+    stream.seek(0, os.SEEK_SET)
+    summary = ArchiveSummary(archive_size, limits, required_members)
+    try:
+        # uncompressed tar only; member data is skipped by seeking
+        with tarfile.open(fileobj=stream, mode='r:') as archive:
+            member = archive.next()
+            while member is not None:
+                summary.add(member.name, member.size)
+                member = archive.next()
+    except tarfile.TarError as e:
+        raise ArchiveError(str(e))
+    return summary.finish()
+
+
+ARCHIVE_INSPECTORS: 'dict[str, typing.Callable[[typing.IO[bytes], ArchiveLimits, list[str]], ArchiveSummary]]' = {
+    'application/zip': inspect_zip,
+    'application/x-tar': inspect_tar,
+}
+
+
+def inspect_archive(stream: 'typing.IO[bytes]', archive_type: str, limits: ArchiveLimits,
+                    required_members: 'list[str]') -> 'ArchiveSummary|None':
+    """ Check the structure of an archive without decompressing it.
+
+    Returns None if there is no inspector for 'archive_type',
+    or raises ArchiveError if the archive is unacceptable.
+    The stream is left positioned at its start.
+    """
+    inspector = ARCHIVE_INSPECTORS.get(archive_type)
+    if not inspector:
+        return None
+    try:
+        summary = inspector(stream, limits, required_members)
+    finally:
+        stream.seek(0, os.SEEK_SET)
+    LOG.debug("%s archive has %s entries totalling %s bytes uncompressed",
+              archive_type, summary.entries, summary.uncompressed_size)
+    return summary
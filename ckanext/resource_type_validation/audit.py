@@ -0,0 +1,163 @@
+# encoding: utf-8
+""" Offline re-validation of previously uploaded resources.
+
+Resources are read from the local upload storage and validated in a
+pool of worker processes, producing a streaming report of resources
+whose stored MIME type no longer matches what validation proposes.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+from logging import getLogger
+import os
+import typing
+
+from ckan.logic import ValidationError
+
+from werkzeug.datastructures import FileStorage as FlaskFileStorage
+
+from .resource_type_validation import ResourceTypeValidator
+
+LOG = getLogger(__name__)
+
+STATUS_OK = 'ok'
+STATUS_MISMATCH = 'mismatch'
+STATUS_REJECTED = 'rejected'
+STATUS_MISSING = 'missing'
+
+REPORT_FIELDS = ['id', 'filename', 'format', 'mimetype', 'proposed_mimetype', 'status', 'errors']
+
+# validator for the current worker process
+_validator: 'ResourceTypeValidator|None' = None
+
+
+class AuditRecord(typing.NamedTuple):
+    id: str
+    path: str
+    filename: str
+    format: 'str|None'
+    mimetype: 'str|None'
+    # the parts of its dataset that select a policy profile
+    dataset: 'dict[str, typing.Any]|None' = None
+
+
+def init_worker(config: 'dict[str, typing.Any]') -> None:
+    global _validator
+    _validator = ResourceTypeValidator(config)
+
+
+def audit_resource(record: AuditRecord) -> 'dict[str, typing.Any]':
+    """ Validate a stored upload as if it had just been uploaded,
+    without its stored MIME type, and compare the outcome with the
+    stored MIME type.
+    """
+    assert _validator
+    result: 'dict[str, typing.Any]' = dict(record._asdict(), proposed_mimetype=None, errors=None)
+    del result['path'], result['dataset']
+    resource: 'dict[str, typing.Any]' = {'id': record.id, 'url': record.filename, 'format': record.format}
+    try:
+        with open(record.path, 'rb') as upload_file:
+            resource['upload'] = FlaskFileStorage(filename=record.filename, stream=upload_file)
+            _validator.validate_resource_mimetype(resource, dataset=record.dataset)
+    except ValidationError as e:
+        result.update(status=STATUS_REJECTED, errors=e.error_dict)
+        return result
+    except OSError as e:
+        result.update(status=STATUS_MISSING, errors=str(e))
+        return result
+
+    result['proposed_mimetype'] = resource.get('mimetype')
+    if _validator.type_equals(record.mimetype, result['proposed_mimetype']):
+        result['status'] = STATUS_OK
+    else:
+        result['status'] = STATUS_MISMATCH
+    return result
+
+
+class ReportWriter:
+    """ Appends audit results to a JSON Lines or CSV report.
+    """
+
+    def __init__(self, stream: 'typing.TextIO', report_format: str = 'jsonl'):
+        self.stream = stream
+        self.report_format = report_format
+        if report_format == 'csv':
+            self.csv_writer = csv.DictWriter(stream, REPORT_FIELDS)
+            if not stream.seekable() or stream.tell() == 0:
+                self.csv_writer.writeheader()
+        elif report_format != 'jsonl':
+            raise ValueError("Unknown report format: {}".format(report_format))
+
+    def write(self, result: 'dict[str, typing.Any]') -> None:
+        if self.report_format == 'csv':
+            row = dict(result)
+            if row['errors'] is not None:
+                row['errors'] = json.dumps(row['errors'])
+            self.csv_writer.writerow(row)
+        else:
+            self.stream.write(json.dumps(result) + '\n')
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+class Checkpoint:
+    """ Records the last resource ID audited, and running totals,
+    so that an interrupted audit can resume where it stopped.
+    """
+
+    def __init__(self, path: 'str|None'):
+        self.path = path
+        self.last_id: 'str|None' = None
+        self.counts: 'dict[str, int]' = {}
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            self.last_id = state.get('last_id')
+            self.counts = state.get('counts', {})
+
+    def save(self, last_id: str) -> None:
+        self.last_id = last_id
+        if not self.path:
+            return
+        # write then rename, so that the checkpoint is never half-written
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump({'last_id': last_id, 'counts': self.counts}, checkpoint_file)
+        os.replace(temp_path, self.path)
+
+
+def run_audit(pages: 'typing.Iterable[list[AuditRecord]]', config: 'dict[str, typing.Any]',
+              writer: ReportWriter, checkpoint: Checkpoint,
+              workers: int = 0, include_all: bool = False) -> 'dict[str, int]':
+    """ Audit each page of records in turn, spreading each page over
+    'workers' processes (or validating in this process if 0).
+
+    The report is flushed and the checkpoint saved after every page.
+    Returns the number of resources with each status.
+    """
+    executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(config,)) \
+        if workers > 0 else None
+    if not executor:
+        init_worker(config)
+    try:
+        for page in pages:
+            if not page:
+                continue
+            if executor:
+                results = executor.map(audit_resource, page,
+                                       chunksize=max(1, len(page) // (workers * 4)))
+            else:
+                results = map(audit_resource, page)
+            for result in results:
+                checkpoint.counts[result['status']] = checkpoint.counts.get(result['status'], 0) + 1
+                if include_all or result['status'] != STATUS_OK:
+                    writer.write(result)
+            writer.flush()
+            checkpoint.save(page[-1].id)
+            LOG.info("Audited resources up to %s: %s", page[-1].id, checkpoint.counts)
+    finally:
+        if executor:
+            executor.shutdown()
+    return checkpoint.counts
@@ -0,0 +1,81 @@
+# encoding: utf-8
+""" State for validating an upload as its chunks arrive, eg through a
+multipart upload flow, so that an upload of the wrong type is rejected
+after its first chunk rather than once it has been received and stored.
+
+The state is small, and serialisable as JSON, so that it can be kept
+between the requests that deliver each chunk. It holds the first bytes
+until they can be sniffed, the last bytes of a possible archive, for
+checking its central directory once the upload is complete, and a
+chained digest of the chunks received.
+"""
+
+import base64
+import hashlib
+import json
+import typing
+
+from .sniffer import HEAD_SIZE
+
+# last bytes kept of a possible archive; a ZIP central directory that
+# doesn't fit is left to be checked once the upload has been stored
+ARCHIVE_TAIL_SIZE = 16 * 1024
+
+
+class ChunkedUpload(typing.NamedTuple):
+    """ The progress of an upload arriving in chunks.
+
+    'chained_digest' chains the SHA-256 digest of each chunk onto that
+    of the chunks before it, since a running hash can't itself be
+    serialised. It is not a digest of the content: it depends on where
+    the upload was split into chunks, and doesn't match the 'hash' of
+    the stored resource. An uploader can compute it from the same chunks
+    to check that every chunk arrived intact. 'sniffed_mimetype' is set once the first bytes have
+    been sniffed, after which 'head' is no longer kept, and 'tail' is
+    kept only while the upload may be an archive.
+    """
+    filename: str
+    received: int = 0
+    chained_digest: str = ''
+    head: bytes = b''
+    tail: bytes = b''
+    sniffed_mimetype: 'str|None' = None
+    keep_tail: bool = True
+
+    def add(self, chunk: 'bytes|memoryview', offset: 'int|None' = None) -> 'ChunkedUpload':
+        """ Returns the state after the next chunk, 'chunk', which starts
+        at 'offset' within the upload, if given.
+
+        Raises ValueError if the chunk doesn't follow those so far,
+        eg after a chunk was lost, so that the uploader can resume from
+        'received'.
+        """
+        if offset is not None and offset != self.received:
+            raise ValueError("Chunk starts at {} but {} bytes have been received".format(offset, self.received))
+        chunk = bytes(chunk)
+        chained_digest = hashlib.sha256(bytes.fromhex(self.chained_digest) + hashlib.sha256(chunk).digest())
+        head = self.head
+        if self.sniffed_mimetype is None and len(head) < HEAD_SIZE:
+            head += chunk[:HEAD_SIZE - len(head)]
+        tail = (self.tail + chunk)[-ARCHIVE_TAIL_SIZE:] if self.keep_tail else b''
+        return self._replace(received=self.received + len(chunk), chained_digest=chained_digest.hexdigest(),
+                             head=head, tail=tail)
+
+    def sniffed(self, sniffed_mimetype: str, keep_tail: bool) -> 'ChunkedUpload':
+        """ Returns the state once the first bytes have been sniffed.
+        """
+        return self._replace(head=b'', sniffed_mimetype=sniffed_mimetype, keep_tail=keep_tail,
+                             tail=self.tail if keep_tail else b'')
+
+    def to_json(self) -> str:
+        fields = self._asdict()
+        for name in ('head', 'tail'):
+            fields[name] = base64.b64encode(fields[name]).decode('ascii')
+        return json.dumps(fields)
+
+    @classmethod
+    def from_json(cls, value: 'str|bytes') -> 'ChunkedUpload':
+        fields = json.loads(value)
+        for name in ('head', 'tail'):
+            fields[name] = base64.b64decode(fields[name])
+        return cls(**fields)
@@ -0,0 +1,126 @@
+# encoding: utf-8
+""" Command-line tools for resource type validation.
+"""
+
+import os
+import sys
+import typing
+
+import click
+
+from ckan import model
+from ckan.lib.uploader import ResourceUpload
+from ckan.plugins.toolkit import config
+
+from .audit import AuditRecord, Checkpoint, ReportWriter, run_audit
+from .policy_check import check_types
+from .profiles import dataset_dict
+from .resource_type_validation import DEFAULT_TYPES_FILE
+from .type_policy import load_types_file
+
+VALIDATOR_CONFIG_KEYS = ('ckan.mimetypes_allowed', 'ckan.site_url')
+VALIDATOR_CONFIG_PREFIX = 'ckanext.resource_validation.'
+
+
+def _validator_config() -> 'dict[str, typing.Any]':
+    """ The settings needed to build a validator in a worker process.
+    """
+    return {key: value for key, value in config.items()
+            if key.startswith(VALIDATOR_CONFIG_PREFIX) or key in VALIDATOR_CONFIG_KEYS}
+
+
+def _upload_pages(page_size: int, after_id: 'str|None') -> 'typing.Iterator[list[AuditRecord]]':
+    """ Yield pages of active uploaded resources in ID order,
+    starting after 'after_id'.
+    """
+    uploader = ResourceUpload({})
+    if not uploader.storage_path:
+        raise click.ClickException("ckan.storage_path is not configured")
+    while True:
+        query = model.Session.query(
+            model.Resource.id, model.Resource.url,
+            model.Resource.format, model.Resource.mimetype,
+            model.Package.owner_org, model.Package.type.label('dataset_type'),
+            model.Group.name.label('organization_name'),
+        ).join(
+            model.Package, model.Package.id == model.Resource.package_id,
+        ).outerjoin(
+            model.Group, model.Group.id == model.Package.owner_org,
+        ).filter(
+            model.Resource.state == 'active',
+            model.Resource.url_type == 'upload',
+        )
+        if after_id:
+            query = query.filter(model.Resource.id > after_id)
+        rows = query.order_by(model.Resource.id).limit(page_size).all()
+        model.Session.remove()
+        if not rows:
+            return
+        yield [AuditRecord(row.id, uploader.get_path(row.id),
+                           (row.url or '').rsplit('/', 1)[-1], row.format, row.mimetype,
+                           dataset_dict(row.owner_org, row.organization_name, row.dataset_type))
+               for row in rows]
+        after_id = rows[-1].id
+
+
+@click.group(name='resource-type-validation', short_help='Resource type validation commands')
+def resource_type_validation():
+    pass
+
+
+@resource_type_validation.command(short_help='Re-validate existing uploaded resources')
+@click.option('-o', '--output', default='-', type=click.Path(dir_okay=False, allow_dash=True),
+              help='Report file, appended to if it exists. Defaults to standard output.')
+@click.option('-f', '--report-format', type=click.Choice(['jsonl', 'csv']), default='jsonl',
+              help='Report format.')
+@click.option('-w', '--workers', type=int, default=os.cpu_count() or 1,
+              help='Number of worker processes; 0 to validate in this process.')
+@click.option('-p', '--page-size', type=int, default=1000,
+              help='Number of resources to read from the database at a time.')
+@click.option('-c', '--checkpoint', type=click.Path(dir_okay=False),
+              help='File recording progress, to resume an interrupted audit.')
+@click.option('-a', '--all', 'include_all', is_flag=True,
+              help='Report every resource, not just mismatches and rejections.')
+def audit(output: str, report_format: str, workers: int, page_size: int,
+          checkpoint: 'str|None', include_all: bool):
+    """ Validate existing uploads, straight from local storage,
+    and report those whose MIME type does not match the outcome.
+    """
+    progress = Checkpoint(checkpoint)
+    if progress.last_id:
+        click.echo("Resuming after resource {}".format(progress.last_id), err=True)
+    report_stream = sys.stdout if output == '-' else open(output, 'a', newline='')
+    try:
+        counts = run_audit(_upload_pages(page_size, progress.last_id), _validator_config(),
+                           ReportWriter(report_stream, report_format), progress,
+                           workers=workers, include_all=include_all)
+    finally:
+        if report_stream is not sys.stdout:
+            report_stream.close()
+    click.echo("Audit complete: {}".format(
+        ', '.join('{} {}'.format(count, status) for status, count in sorted(counts.items()))
+        or 'no uploaded resources'), err=True)
+
+
+@resource_type_validation.command('check-types', short_help='Check the types file for problems')
+@click.option('-t', '--types-file', type=click.Path(exists=True, dir_okay=False),
+              help='Types file to check. Defaults to the configured types file.')
+def check_types_file(types_file: 'str|None'):
+    """ Check the types file for entries that contradict each other
+    or can never take effect.
+    """
+    types_file = types_file or str(config.get('ckanext.resource_validation.types_file', DEFAULT_TYPES_FILE))
+    try:
+        file_mime_config = load_types_file(types_file)
+    except ValueError as e:
+        raise click.ClickException("{} is not valid JSON: {}".format(types_file, e))
+    problems = check_types(file_mime_config)
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise click.ClickException("{} problem(s) found in {}".format(len(problems), types_file))
+    click.echo("No problems found in {}".format(types_file), err=True)
+
+
+def get_commands() -> 'list[click.Command]':
+    return [resource_type_validation]
@@ -0,0 +1,163 @@
+# encoding: utf-8
+""" Deferred validation of large uploads.
+
+When enabled, uploads above a configured size get only the checks that
+need the start of the file while the request is in progress, and are
+marked as pending. A background job then validates the stored file in
+full, and either confirms the resource, with its final MIME type, or
+quarantines it, with the reasons for rejection.
+"""
+
+import json
+from logging import getLogger
+import typing
+
+from ckan import model, plugins
+from ckan.lib.uploader import ResourceUpload
+from ckan.plugins import toolkit
+
+from werkzeug.datastructures import FileStorage as FlaskFileStorage
+
+from .profiles import stored_dataset
+
+LOG = getLogger(__name__)
+
+# resource fields recording the outcome of deferred validation
+STATUS_FIELD = 'resource_type_validation_status'
+ERRORS_FIELD = 'resource_type_validation_errors'
+STATUS_PENDING = 'pending'
+STATUS_CONFIRMED = 'confirmed'
+STATUS_QUARANTINED = 'quarantined'
+# resource field identifying the checks that the resource last passed
+FINGERPRINT_FIELD = 'resource_type_validation_fingerprint'
+# resource fields that only validation may set
+VALIDATION_FIELDS = (STATUS_FIELD, ERRORS_FIELD, FINGERPRINT_FIELD)
+# resource fields that affect the type it is validated as
+TYPE_FIELDS = ('url', 'format', 'mimetype')
+
+# context flags
+JOB_CONTEXT = 'resource_type_validation.deferred_job'
+PENDING_CONTEXT = 'resource_type_validation.pending_upload'
+
+Enqueue = typing.Callable[..., typing.Any]
+
+
+def is_pending(resource: 'dict[str, typing.Any]') -> bool:
+    return resource.get(STATUS_FIELD) == STATUS_PENDING
+
+
+def protect_status(context: typing.Any, current: 'dict[str, typing.Any]|None',
+                   data_dict: 'dict[str, typing.Any]') -> None:
+    """ Keep the stored validation status of a resource, unless it is
+    being changed by the deferred validation job itself.
+    """
+    if context.get(JOB_CONTEXT):
+        return
+    for field in VALIDATION_FIELDS:
+        if current and field in current:
+            data_dict[field] = current[field]
+        else:
+            data_dict.pop(field, None)
+
+
+def stored_statuses(resource_ids: 'typing.Iterable[str|None]') -> 'dict[str, dict[str, typing.Any]]':
+    """ Returns the stored validation fields of those resources that
+    exist, along with the fields that affect their type, by id,
+    in a single query.
+    """
+    ids = {resource_id for resource_id in resource_ids if resource_id}
+    if not ids:
+        return {}
+    resources = model.Session.query(model.Resource).filter(model.Resource.id.in_(ids))
+    return {resource.id: dict({field: resource.extras[field] for field in VALIDATION_FIELDS
+                               if field in resource.extras},
+                              **{field: getattr(resource, field) for field in TYPE_FIELDS})
+            for resource in resources}
+
+
+def enqueue_validation(resource_id: str, enqueue: Enqueue, queue: 'str|None' = None) -> None:
+    LOG.debug("Queueing deferred validation of resource %s", resource_id)
+    kwargs = {'queue': queue} if queue else {}
+    enqueue(validate_deferred_upload, [resource_id],
+            title="Validate type of resource {}".format(resource_id), **kwargs)
+
+
+def enqueue_changes(resource: 'dict[str, typing.Any]', changes: 'dict[str, typing.Any]',
+                    enqueue: Enqueue, queue: 'str|None' = None) -> None:
+    """ Queue recording the outcome of checks made as an upload was
+    stored, rather than updating its dataset again in the same request.
+    """
+    LOG.debug("Queueing changes to resource %s: %s", resource['id'], sorted(changes))
+    kwargs = {'queue': queue} if queue else {}
+    enqueue(record_stored_changes, [resource['id'], changes, resource.get('last_modified')],
+            title="Record checks of resource {}".format(resource['id']), **kwargs)
+
+
+def complete_validation(validator: typing.Any, resource: 'dict[str, typing.Any]',
+                        path: str, dataset: 'dict[str, typing.Any]|None' = None) -> 'dict[str, typing.Any]':
+    """ Validate the stored file of a pending resource in full,
+    ignoring its provisional MIME type, under the policy profile
+    of 'dataset', if any.
+
+    Returns the changes to make to the resource.
+    """
+    filename = str(resource.get('url') or '').rsplit('/', 1)[-1]
+    candidate: 'dict[str, typing.Any]' = {'id': resource.get('id'), 'url': filename, 'format': resource.get('format')}
+    try:
+        with open(path, 'rb') as upload_file:
+            candidate['upload'] = FlaskFileStorage(filename=filename, stream=upload_file)
+            verdict = validator.validate_resources([candidate], allow_deferral=False, dataset=dataset)[0]
+    except OSError as e:
+        LOG.warning("Unable to read upload for resource %s: %s", resource.get('id'), e)
+        return {STATUS_FIELD: STATUS_QUARANTINED,
+                ERRORS_FIELD: json.dumps({'upload': ["File could not be read"]})}
+    if verdict.errors:
+        LOG.warning("Quarantining resource %s: %s", resource.get('id'), verdict.errors)
+        return {STATUS_FIELD: STATUS_QUARANTINED, ERRORS_FIELD: json.dumps(verdict.errors)}
+    return {STATUS_FIELD: STATUS_CONFIRMED, 'mimetype': verdict.mimetype}
+
+
+def _site_context() -> typing.Any:
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    return {'ignore_auth': True, 'user': site_user['name']}
+
+
+def record_changes(resource_id: str, changes: 'dict[str, typing.Any]', context: typing.Any = None) -> None:
+    """ Make changes to a resource as the outcome of validation,
+    including to the fields that only validation may set, as the site
+    user unless 'context' is given.
+    """
+    job_context: typing.Any = dict(context or _site_context(), **{JOB_CONTEXT: True})
+    toolkit.get_action('resource_patch')(job_context, dict(changes, id=resource_id))
+
+
+def record_stored_changes(resource_id: str, changes: 'dict[str, typing.Any]',
+                          last_modified: 'str|None') -> None:
+    """ Background job to record the outcome of checks made as an
+    upload was stored, unless it has been replaced since.
+    """
+    context = _site_context()
+    resource = toolkit.get_action('resource_show')(context, {'id': resource_id})
+    if resource.get('last_modified') != last_modified:
+        LOG.info("Resource %s changed since its upload was stored; discarding checks", resource_id)
+        return
+    record_changes(resource_id, changes, context)
+
+
+def validate_deferred_upload(resource_id: str) -> None:
+    """ Background job to complete the validation of a pending upload.
+    """
+    validator = getattr(plugins.get_plugin('resource_type_validation'), 'validator')
+    context = _site_context()
+    resource = toolkit.get_action('resource_show')(context, {'id': resource_id})
+    if not is_pending(resource):
+        LOG.debug("Resource %s is no longer pending validation", resource_id)
+        return
+    dataset = stored_dataset(resource.get('package_id')) if validator.uses_profiles() else None
+    changes = complete_validation(validator, resource, ResourceUpload({}).get_path(resource_id), dataset)
+    latest = toolkit.get_action('resource_show')(context, {'id': resource_id})
+    if not is_pending(latest) or latest.get('last_modified') != resource.get('last_modified'):
+        # replaced while we were checking; a new job will follow if needed
+        LOG.info("Resource %s changed during deferred validation; discarding outcome", resource_id)
+        return
+    record_changes(resource_id, changes, context)
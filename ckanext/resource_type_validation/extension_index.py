@@ -0,0 +1,69 @@
+# encoding: utf-8
+""" Lookup of file extensions, including multi-part ones like '.tar.gz',
+by splitting off the final suffixes of a name rather than matching it
+against a pattern.
+"""
+
+import typing
+
+
+class ExtensionPolicy(typing.NamedTuple):
+    """ Extra conditions on files with a particular extension.
+    """
+    max_size: 'int|None' = None
+    sniffed_types: 'tuple[str, ...]' = ()
+
+    @classmethod
+    def from_config(cls, config: 'dict[str, typing.Any]') -> 'ExtensionPolicy':
+        max_size = config.get('max_size')
+        return cls(None if max_size is None else int(max_size),
+                   tuple(config.get('sniffed_types', ())))
+
+
+class ExtensionIndex:
+    """ The allowed file extensions, if restricted, and any policies
+    for particular extensions, matched case-insensitively against
+    the end of a filename or URL.
+    """
+
+    def __init__(self, allowed_extensions: 'typing.Iterable[str]',
+                 extension_policies: 'dict[str, dict[str, typing.Any]]|None' = None):
+        allowed = frozenset(extension.lower() for extension in allowed_extensions)
+        # None allows any extension
+        self.allowed: 'frozenset[str]|None' = allowed or None
+        self.policies = {extension.lower(): ExtensionPolicy.from_config(policy)
+                         for extension, policy in (extension_policies or {}).items()}
+        # numbers of parts to try, eg 2 for 'tar.gz', longest first
+        self._allowed_lengths = _part_counts(allowed)
+        self._policy_lengths = _part_counts(self.policies)
+        self._max_parts = max(self._allowed_lengths + self._policy_lengths + [0])
+
+    def _suffixes(self, filename: str) -> 'list[str]':
+        # like the '$' of a regular expression, ignore one trailing newline
+        if filename.endswith('\n'):
+            filename = filename[:-1]
+        return filename.rsplit('.', self._max_parts)[1:]
+
+    def is_allowed(self, filename: str) -> bool:
+        if self.allowed is None:
+            return True
+        suffixes = self._suffixes(filename)
+        return any(parts <= len(suffixes) and '.'.join(suffixes[-parts:]).lower() in self.allowed
+                   for parts in self._allowed_lengths)
+
+    def policy_for(self, filename: str) -> 'ExtensionPolicy|None':
+        """ Returns the policy for the longest matching extension, if any.
+        """
+        if not self.policies:
+            return None
+        suffixes = self._suffixes(filename)
+        for parts in self._policy_lengths:
+            if parts <= len(suffixes):
+                policy = self.policies.get('.'.join(suffixes[-parts:]).lower())
+                if policy:
+                    return policy
+        return None
+
+
+def _part_counts(extensions: 'typing.Iterable[str]') -> 'list[int]':
+    return sorted({extension.count('.') + 1 for extension in extensions}, reverse=True)
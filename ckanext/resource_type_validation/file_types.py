@@ -0,0 +1,72 @@
+# encoding: utf-8
+""" Lookup of MIME types by file extension and resource format.
+
+Each validator has its own registry, built once from the system MIME
+types plus its configured extras, so that validators with different
+configurations can coexist and the global 'mimetypes' module is left
+untouched. Lookups are plain dictionary hits; names that need the full
+'mimetypes' treatment, such as compressed suffixes like '.csv.gz' or
+'data:' URLs, are passed to a private 'mimetypes.MimeTypes' instance
+holding the same mappings.
+"""
+
+import mimetypes
+import posixpath
+import typing
+
+
+class FileTypeRegistry:
+    """ Maps lower-cased file extensions, eg '.csv',
+    and resource formats, eg 'CSV', to MIME types.
+    """
+
+    def __init__(self, extra_mimetypes: 'dict[str, str]|None' = None):
+        if not mimetypes.inited:
+            mimetypes.init()
+        database = mimetypes.MimeTypes()
+        database.suffix_map = dict(mimetypes.suffix_map)
+        database.encodings_map = dict(mimetypes.encodings_map)
+        for extension, mime_type in mimetypes.common_types.items():
+            database.add_type(mime_type, extension, strict=False)
+        for extension, mime_type in mimetypes.types_map.items():
+            database.add_type(mime_type, extension)
+        # NB It's more important to match a sniffable type than an RFC type.
+        for extension, mime_type in (extra_mimetypes or {}).items():
+            database.add_type(mime_type, extension.lower())
+        self.database = database
+
+        # strict types take precedence over common non-standard ones
+        self.extensions: 'dict[str, str]' = {}
+        for strict in (False, True):
+            self.extensions.update(
+                (extension.lower(), mime_type)
+                for extension, mime_type in database.types_map[strict].items())
+        self.formats = {extension[1:]: mime_type for extension, mime_type in self.extensions.items()}
+
+        # suffixes that alter the interpretation of the suffix before them
+        self.special_extensions = frozenset(
+            extension.lower() for extension in list(database.suffix_map) + list(database.encodings_map))
+        self.special_formats = frozenset(extension[1:] for extension in self.special_extensions)
+
+    def _guess(self, name: str) -> 'str|None':
+        return self.database.guess_type(name, strict=False)[0]
+
+    def type_for_filename(self, filename: str) -> 'str|None':
+        """ Returns the MIME type indicated by the extension
+        of a filename or URL, if known.
+        """
+        extension = posixpath.splitext(filename)[1].lower()
+        if extension in self.special_extensions or filename[:5].lower() == 'data:':
+            return self._guess(filename)
+        return self.extensions.get(extension)
+
+    def type_for_format(self, resource_format: typing.Any) -> 'str|None':
+        """ Returns the MIME type of files with the extension matching
+        a resource format, eg 'application/pdf' for 'PDF', if known.
+        """
+        resource_format = str(resource_format)
+        lower_format = resource_format.lower()
+        if '.' in resource_format or '/' in resource_format or ':' in resource_format \
+                or lower_format in self.special_formats:
+            return self._guess('example.' + resource_format)
+        return self.formats.get(lower_format)
@@ -0,0 +1,237 @@
+# encoding: utf-8
+""" Instrumentation of the validation process.
+
+The validator reports how long each stage takes, how many bytes it
+sniffs, and how many uploads it accepts or rejects, to a metrics sink.
+By default these are discarded; they can instead be sent to a statsd
+server over UDP, or aggregated in-process for a Prometheus scraper.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from logging import getLogger
+import re
+import socket
+import threading
+import time
+import typing
+
+LOG = getLogger(__name__)
+
+DEFAULT_STATSD_HOST = 'localhost'
+DEFAULT_STATSD_PORT = 8125
+DEFAULT_PREFIX = 'resource_type_validation'
+
+# stage names
+STAGE_SNIFF = 'sniff'
+STAGE_TEXT_SNIFF = 'text_sniff'
+STAGE_EXTENSION = 'extension_check'
+STAGE_GUESS_TYPE = 'guess_type'
+STAGE_FORMAT = 'format_check'
+STAGE_ARCHIVE = 'archive'
+STAGE_COALESCE = 'coalesce'
+STAGE_ALLOW_LIST = 'allow_list'
+STAGE_REMOTE_FETCH = 'remote_fetch'
+
+# stages that can decide the outcome of a validation;
+# only 'content' reads the upload, and 'remote' the start of a link
+DECIDED_EXTENSION = 'extension'
+DECIDED_FORMAT = 'format'
+DECIDED_ALLOW_LIST = 'allow_list'
+DECIDED_SIZE = 'size'
+DECIDED_CONTENT = 'content'
+DECIDED_STORED = 'stored'
+DECIDED_REMOTE = 'remote'
+
+# Histogram upper bounds; durations in seconds, sizes in bytes
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (512, 2048, 8192, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+Labels = typing.Optional[typing.Dict[str, str]]
+
+_NULL_STAGE = nullcontext()
+
+
+class MetricsSink:
+    """ Receives measurements from the validator and discards them.
+    Subclasses send them somewhere useful.
+    """
+
+    def timing(self, stage: str, seconds: float) -> None:
+        """ Record the duration of a validation stage.
+        """
+
+    def observe(self, name: str, value: float) -> None:
+        """ Record a sample of a distribution, eg bytes sniffed.
+        """
+
+    def increment(self, name: str, labels: Labels = None) -> None:
+        """ Add one to a counter, distinguished by 'labels'.
+        """
+
+    def stage(self, stage: str) -> 'typing.ContextManager[None]':
+        """ Time the enclosed block as 'stage'.
+        """
+        return _NULL_STAGE
+
+
+class _TimingSink(MetricsSink):
+    """ Base for sinks that actually record stage durations.
+    """
+
+    @contextmanager
+    def stage(self, stage: str) -> 'typing.Iterator[None]':
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(stage, time.perf_counter() - start)
+
+
+def _statsd_name(value: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', value)
+
+
+class StatsdSink(_TimingSink):
+    """ Sends measurements to a statsd server over UDP.
+
+    Labels are appended to counter names, eg
+    'resource_type_validation.validations.accepted.text_csv',
+    since plain statsd has no notion of tags.
+    Sending is best effort; failures are logged and ignored.
+    """
+
+    def __init__(self, host: str = DEFAULT_STATSD_HOST, port: int = DEFAULT_STATSD_PORT,
+                 prefix: str = DEFAULT_PREFIX):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, line: str) -> None:
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except OSError as e:
+            LOG.debug("Unable to send metric %s: %s", line, e)
+
+    def timing(self, stage: str, seconds: float) -> None:
+        self._send('{}.stage.{}:{:.3f}|ms'.format(self.prefix, stage, seconds * 1000))
+
+    def observe(self, name: str, value: float) -> None:
+        self._send('{}.{}:{}|h'.format(self.prefix, name, value))
+
+    def increment(self, name: str, labels: Labels = None) -> None:
+        parts = [self.prefix, name] + [_statsd_name(value) for _, value in sorted((labels or {}).items())]
+        self._send('{}:1|c'.format('.'.join(parts)))
+
+
+class Histogram:
+    """ Cumulative histogram in the Prometheus style.
+    """
+
+    def __init__(self, buckets: 'typing.Sequence[float]'):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+def _label_text(labels: 'typing.Iterable[tuple[str, str]]') -> str:
+    pairs = ['{}="{}"'.format(key, value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+             for key, value in labels]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class PrometheusRegistry(_TimingSink):
+    """ Aggregates measurements in this process, for exposition
+    in the Prometheus text format.
+
+    Each web server process has its own registry, so a scraper
+    sees whichever process answered its request.
+    """
+
+    def __init__(self, prefix: str = DEFAULT_PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.stage_durations: 'dict[str, Histogram]' = {}
+        self.distributions: 'dict[str, Histogram]' = {}
+        self.counters: 'dict[tuple[str, tuple[tuple[str, str], ...]], int]' = {}
+
+    def timing(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.stage_durations.get(stage)
+            if histogram is None:
+                histogram = self.stage_durations[stage] = Histogram(DURATION_BUCKETS)
+            histogram.observe(seconds)
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            histogram = self.distributions.get(name)
+            if histogram is None:
+                histogram = self.distributions[name] = Histogram(SIZE_BUCKETS)
+            histogram.observe(value)
+
+    def increment(self, name: str, labels: Labels = None) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def _histogram_lines(self, name: str, histogram: Histogram,
+                         labels: 'list[tuple[str, str]]') -> 'list[str]':
+        lines: 'list[str]' = []
+        cumulative = 0
+        bounds = [repr(float(bound)) for bound in histogram.buckets] + ['+Inf']
+        for bound, count in zip(bounds, histogram.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name, _label_text(labels + [('le', bound)]), cumulative))
+        lines.append('{}_sum{} {}'.format(name, _label_text(labels), histogram.sum))
+        lines.append('{}_count{} {}'.format(name, _label_text(labels), histogram.count))
+        return lines
+
+    def render(self) -> str:
+        """ Returns the current measurements in the Prometheus
+        text exposition format.
+        """
+        lines: 'list[str]' = []
+        with self._lock:
+            if self.stage_durations:
+                name = self.prefix + '_stage_seconds'
+                lines += ['# HELP {} Time spent in each validation stage.'.format(name),
+                          '# TYPE {} histogram'.format(name)]
+                for stage in sorted(self.stage_durations):
+                    lines += self._histogram_lines(name, self.stage_durations[stage], [('stage', stage)])
+            for distribution in sorted(self.distributions):
+                name = '{}_{}'.format(self.prefix, distribution)
+                lines.append('# TYPE {} histogram'.format(name))
+                lines += self._histogram_lines(name, self.distributions[distribution], [])
+            for counter in sorted({counter for counter, _ in self.counters}):
+                name = '{}_{}_total'.format(self.prefix, counter)
+                lines.append('# TYPE {} counter'.format(name))
+                lines += ['{}{} {}'.format(name, _label_text(labels), value)
+                          for (counter_name, labels), value in sorted(self.counters.items())
+                          if counter_name == counter]
+        return '\n'.join(lines) + '\n'
+
+
+def build_metrics_sink(config: typing.Any) -> MetricsSink:
+    """ Construct the configured metrics sink.
+    """
+    backend = config.get('ckanext.resource_validation.metrics', 'none')
+    prefix = config.get('ckanext.resource_validation.metrics_prefix', DEFAULT_PREFIX)
+    if backend == 'statsd':
+        return StatsdSink(
+            config.get('ckanext.resource_validation.statsd_host', DEFAULT_STATSD_HOST),
+            int(config.get('ckanext.resource_validation.statsd_port', DEFAULT_STATSD_PORT)),
+            prefix)
+    if backend == 'prometheus':
+        return PrometheusRegistry(prefix)
+    if backend in ('none', '', None):
+        return MetricsSink()
+    raise ValueError("Unknown metrics backend: {}".format(backend))
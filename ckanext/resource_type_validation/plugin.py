@@ -1,11 +1,32 @@
 # encoding: utf-8
 
-from typing import Any
+from typing import Any, cast
 
 from ckan import plugins
 from ckan.common import CKANConfig
+from ckan.logic import ValidationError
+from ckan.plugins import toolkit
 
+from . import cli, deferred, profiles, views
 from .resource_type_validation import ResourceTypeValidator
+from .tee import TeeStream
+
+# context key listing resources already handled by a resource-level hook
+VALIDATED_RESOURCES = 'resource_type_validation.validated_resources'
+# context key holding the wrapped stream of a resource's new upload
+TEE_CONTEXT = 'resource_type_validation.upload_tee'
+
+
+def _mark_validated(context: Any, data_dict: 'dict[str, Any]') -> None:
+    if isinstance(context, dict):
+        context.setdefault(VALIDATED_RESOURCES, []).append(data_dict)
+        # only a new upload is newly pending; others keep their stored status
+        if data_dict.get('upload') and deferred.is_pending(data_dict):
+            context[deferred.PENDING_CONTEXT] = True
+
+
+def _is_marked_validated(context: Any, resource: 'dict[str, Any]') -> bool:
+    return any(resource is validated for validated in context.get(VALIDATED_RESOURCES, []))
 
 
 class ResourceTypeValidationPlugin(plugins.SingletonPlugin):
@@ -15,13 +36,130 @@ class ResourceTypeValidationPlugin(plugins.SingletonPlugin):
     """
     plugins.implements(plugins.IConfigurable, inherit=True)
     plugins.implements(plugins.IResourceController, inherit=True)
+    plugins.implements(plugins.IClick)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IBlueprint)
 
     validator: 'ResourceTypeValidator|None' = None
+    enqueue_job: 'deferred.Enqueue|None' = None
+    deferred_queue: 'str|None' = None
 
     # IConfigurable
 
     def configure(self, config: CKANConfig):
         self.validator = ResourceTypeValidator(config)
+        self.enqueue_job = toolkit.enqueue_job
+        self.deferred_queue = config.get('ckanext.resource_validation.deferred_queue') or None
+
+    # IClick
+
+    def get_commands(self):
+        return cli.get_commands()
+
+    # IBlueprint
+
+    def get_blueprint(self):
+        return views.get_blueprints()
+
+    # IActions
+
+    def get_actions(self):
+        return {
+            'package_create': toolkit.chained_action(self._validate_package_uploads),
+            'package_update': toolkit.chained_action(self._validate_package_uploads),
+        }
+
+    def _validate_package_uploads(self, original_action: Any, context: Any, data_dict: 'dict[str, Any]'):
+        """ Check all uploads that arrive with a dataset, eg from
+        bulk ingestion, and any links whose contents are fetched, in one
+        batch, and report every rejection rather than only the first.
+        """
+        assert self.validator
+        dataset = self._package_dataset(data_dict)
+        resources: 'list[Any]' = data_dict.get('resources') or []
+        unchecked: 'list[tuple[int, dict[str, Any]]]' = [
+            (index, resource) for index, resource in enumerate(resources)
+            if isinstance(resource, dict) and not _is_marked_validated(context, resource)]
+        statuses = deferred.stored_statuses(resource.get('id') for _, resource in unchecked)
+        checked: 'list[tuple[int, dict[str, Any]]]' = []
+        for index, resource in unchecked:
+            current = statuses.get(resource.get('id') or '')
+            deferred.protect_status(context, current, resource)
+            if (resource.get('upload') or self.validator.checks_link(resource)) \
+                    and not self.validator.is_unchanged(current, resource, dataset):
+                checked.append((index, resource))
+        if checked:
+            verdicts = self.validator.validate_resources((resource for _, resource in checked), dataset=dataset)
+            if any(verdict.errors for verdict in verdicts):
+                errors: 'list[str|dict[str, Any]]' = [{} for _ in resources]
+                for (index, _), verdict in zip(checked, verdicts):
+                    errors[index] = verdict.errors or {}
+                raise ValidationError({'resources': errors})
+        tees = self._tee_uploads(checked)
+        result = original_action(context, data_dict)
+        pending = [index for index, resource in checked if deferred.is_pending(resource)]
+        if pending or tees:
+            self._after_package_uploads(context, result, tees, pending, dataset)
+        return result
+
+    def _package_dataset(self, data_dict: 'dict[str, Any]') -> 'dict[str, Any]|None':
+        """ Returns what selects the policy profile of a dataset being
+        created or updated, if there are any profiles.
+        """
+        assert self.validator
+        if not self.validator.uses_profiles():
+            return None
+        # an update may leave out fields that are to stay as they are
+        stored = profiles.stored_dataset(data_dict.get('id')) or {}
+        return profiles.dataset_summary(
+            data_dict.get('owner_org', stored.get('owner_org')),
+            data_dict.get('type') or stored.get('type'))
+
+    def _resource_dataset(self, data_dict: 'dict[str, Any]') -> 'dict[str, Any]|None':
+        assert self.validator
+        if not self.validator.uses_profiles():
+            return None
+        return profiles.stored_dataset(data_dict.get('package_id'))
+
+    def _tee_uploads(self, checked: 'list[tuple[int, dict[str, Any]]]') -> 'dict[int, TeeStream]':
+        assert self.validator
+        tees: 'dict[int, TeeStream]' = {}
+        for index, resource in checked:
+            tee = self.validator.tee_upload(resource)
+            if tee is not None:
+                tees[index] = tee
+        return tees
+
+    def _after_package_uploads(self, context: Any, result: Any, tees: 'dict[int, TeeStream]',
+                               pending: 'list[int]', dataset: 'dict[str, Any]|None'):
+        """ Queue recording what was seen of a dataset's uploads as they
+        were stored, and deferred validation of those still pending.
+        """
+        show_context: Any = dict(context, ignore_auth=True)
+        package = cast('dict[str, Any]', result) if isinstance(result, dict) \
+            else toolkit.get_action('package_show')(show_context, {'id': result})
+        changes = {index: self._record_stored_upload(package['resources'][index], tee, dataset)
+                   for index, tee in tees.items()}
+        for index in pending:
+            resource = package['resources'][index]
+            if deferred.is_pending(dict(resource, **changes.get(index, {}))):
+                self._enqueue_validation(resource['id'])
+
+    def _record_stored_upload(self, resource: 'dict[str, Any]', tee: TeeStream,
+                              dataset: 'dict[str, Any]|None') -> 'dict[str, Any]':
+        """ Queue recording what was seen of an upload as it was stored,
+        so that saving it doesn't update its dataset a second time.
+        Returns the changes to be made.
+        """
+        assert self.validator and self.enqueue_job
+        changes = self.validator.check_stored_upload(resource, tee, dataset)
+        if changes:
+            deferred.enqueue_changes(resource, changes, self.enqueue_job, self.deferred_queue)
+        return changes
+
+    def _enqueue_validation(self, resource_id: str):
+        assert self.enqueue_job
+        deferred.enqueue_validation(resource_id, self.enqueue_job, self.deferred_queue)
 
     # IResourceController
 
@@ -29,18 +167,55 @@ class ResourceTypeValidationPlugin(plugins.SingletonPlugin):
     def before_create(self, context: Any, data_dict: 'dict[str, Any]'):
         self.before_resource_create(context, data_dict)
 
+    def after_create(self, context: Any, resource: 'dict[str, Any]'):
+        self.after_resource_create(context, resource)
+
     def before_update(self, context: Any, current: 'dict[str, Any]', data_dict: 'dict[str, Any]'):
         self.before_resource_update(context, current, data_dict)
 
+    def after_update(self, context: Any, resource: 'dict[str, Any]'):
+        self.after_resource_update(context, resource)
+
     # CKAN 2.10
     def before_resource_create(self, context: Any, data_dict: 'dict[str, Any]'):
         """ Check that uploads have an acceptable mime type.
         """
         assert self.validator
-        self.validator.validate_resource_mimetype(data_dict)
+        deferred.protect_status(context, None, data_dict)
+        self.validator.validate_resource_mimetype(data_dict, dataset=self._resource_dataset(data_dict))
+        _mark_validated(context, data_dict)
+        self._tee_upload(context, data_dict)
+
+    def _tee_upload(self, context: Any, data_dict: 'dict[str, Any]'):
+        assert self.validator
+        tee = self.validator.tee_upload(data_dict)
+        if tee is not None:
+            context[TEE_CONTEXT] = tee
+
+    def after_resource_create(self, context: Any, resource: 'dict[str, Any]'):
+        """ Queue recording the digest of a new upload, completing its
+        checks if possible, and queue full validation of large uploads,
+        if still deferred.
+        """
+        tee = context.pop(TEE_CONTEXT, None)
+        changes = self._record_stored_upload(resource, tee, self._resource_dataset(resource)) \
+            if tee is not None else {}
+        if context.pop(deferred.PENDING_CONTEXT, False) and deferred.is_pending(dict(resource, **changes)):
+            self._enqueue_validation(resource['id'])
 
     def before_resource_update(self, context: Any, current: 'dict[str, Any]', data_dict: 'dict[str, Any]'):
-        """ Check that uploads have an acceptable mime type.
+        """ Check that uploads have an acceptable mime type,
+        unless nothing that affects it has changed.
         """
         assert self.validator
-        self.validator.validate_resource_mimetype(data_dict)
+        deferred.protect_status(context, current, data_dict)
+        dataset = self._resource_dataset(data_dict)
+        if not self.validator.is_unchanged(current, data_dict, dataset):
+            self.validator.validate_resource_mimetype(data_dict, dataset=dataset)
+        _mark_validated(context, data_dict)
+        self._tee_upload(context, data_dict)
+
+    def after_resource_update(self, context: Any, resource: 'dict[str, Any]'):
+        """ As after creating a resource.
+        """
+        self.after_resource_create(context, resource)
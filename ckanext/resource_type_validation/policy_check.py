@@ -0,0 +1,76 @@
+# encoding: utf-8
+""" Checking a types file for entries that contradict each other or can
+never take effect, with 'ckan resource-type-validation check-types'.
+"""
+
+import typing
+
+from .profiles import profile_config
+from .type_policy import CompiledTypes
+
+
+def check_types(file_mime_config: 'dict[str, typing.Any]',
+                compiled: 'CompiledTypes|None' = None) -> 'list[str]':
+    """ Returns descriptions of any entries in a types file that
+    contradict each other or can never take effect.
+    """
+    compiled = compiled or CompiledTypes(file_mime_config)
+    return _override_problems(compiled) + _equal_type_problems(compiled) \
+        + _extension_problems(file_mime_config, compiled) + _archive_problems(compiled) \
+        + _profile_problems(file_mime_config, compiled)
+
+
+def _override_problems(compiled: CompiledTypes) -> 'list[str]':
+    type_index = compiled.type_index
+    override_sets = {generic_type: type_index.type_set(overrides)
+                     for generic_type, overrides in compiled.allowed_overrides.items()}
+    problems: 'list[str]' = []
+    generic_types = list(override_sets)
+    for position, first in enumerate(generic_types):
+        for second in generic_types[position + 1:]:
+            if first in override_sets[second] and second in override_sets[first] \
+                    and not type_index.equals(first, second):
+                problems.append("allowed_overrides: '{}' and '{}' override each other".format(first, second))
+    return problems
+
+
+def _equal_type_problems(compiled: CompiledTypes) -> 'list[str]':
+    problems: 'list[str]' = []
+    groups = [frozenset(group) for group in compiled.equal_types]
+    for position, group in enumerate(groups):
+        if len(group) < 2:
+            problems.append("equal_types: {} has nothing to be equal to".format(sorted(group)))
+        elif any(group <= other for other_position, other in enumerate(groups) if other_position != position):
+            problems.append("equal_types: {} is already within another entry".format(sorted(group)))
+    return problems
+
+
+def _extension_problems(file_mime_config: 'dict[str, typing.Any]', compiled: CompiledTypes) -> 'list[str]':
+    problems: 'list[str]' = []
+    for extension in file_mime_config.get('allowed_extensions', []):
+        if compiled.file_types.type_for_filename('example.' + extension) is None:
+            problems.append("allowed_extensions: no MIME type is known for '{}'".format(extension))
+    for extension in file_mime_config.get('extension_policies', {}):
+        if not compiled.extensions.is_allowed('example.' + extension):
+            problems.append("extension_policies: '{}' is not an allowed extension".format(extension))
+    return problems
+
+
+def _archive_problems(compiled: CompiledTypes) -> 'list[str]':
+    return ["archive_members: '{}' is not a subtype of any archive type".format(subtype)
+            for subtype in compiled.archive_members
+            if not any(compiled.type_index.valid_override(archive_type, subtype)[0]
+                       for archive_type in compiled.archive_mimetypes)]
+
+
+def _profile_problems(file_mime_config: 'dict[str, typing.Any]', compiled: CompiledTypes) -> 'list[str]':
+    problems: 'list[str]' = []
+    for selector_key, selected in (('organizations', compiled.profiles.by_organization),
+                                   ('dataset_types', compiled.profiles.by_dataset_type)):
+        for name, profile in compiled.profiles.profiles.items():
+            problems.extend("profiles: {} '{}' is already in profile '{}'".format(selector_key, key, selected[key])
+                            for key in profile.get(selector_key, []) if selected[key] != name)
+    for name in compiled.profiles.profiles:
+        problems.extend('profiles.{}: {}'.format(name, problem)
+                        for problem in check_types(profile_config(file_mime_config, name)[0]))
+    return problems
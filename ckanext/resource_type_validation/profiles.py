@@ -0,0 +1,116 @@
+# encoding: utf-8
+""" Named policy profiles from the types file, selected for each dataset
+by its owner organisation or its dataset type.
+
+A profile replaces the top-level entries of the types file that it
+names, and extends those under its "add" entry, eg:
+
+    "profiles": {
+        "spatial": {
+            "organizations": ["spatial-agency"],
+            "dataset_types": ["geospatial"],
+            "add": {"allowed_extensions": ["dwg", "sid"]}
+        },
+        "office": {
+            "organizations": ["records-agency"],
+            "allowed_extensions": ["doc", "docx", "pdf", "xls", "xlsx"],
+            "mimetypes_allowed": ["application/pdf", "application/msword",
+                                  "application/vnd.ms-excel",
+                                  "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                                  "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"]
+        }
+    }
+
+"mimetypes_allowed" replaces ckan.mimetypes_allowed for the profile.
+As there, types are matched exactly, so a wildcard such as
+"application/*" matches nothing; only "*" allows every type.
+An organisation's profile takes precedence over a dataset type's.
+"""
+
+import typing
+
+from ckan import model
+
+# profile entries that select datasets rather than configure types
+SELECTOR_KEYS = ('organizations', 'dataset_types')
+ADD_KEY = 'add'
+ALLOWED_MIME_TYPES_KEY = 'mimetypes_allowed'
+
+
+class ProfileSelector:
+    """ Finds the profile, if any, for a dataset, with one dict lookup
+    per organisation key and one for the dataset type.
+    """
+
+    def __init__(self, profiles: 'dict[str, dict[str, typing.Any]]'):
+        self.profiles = profiles
+        self.by_organization: 'dict[str, str]' = {}
+        self.by_dataset_type: 'dict[str, str]' = {}
+        for name, profile in profiles.items():
+            for organization in profile.get('organizations', []):
+                self.by_organization.setdefault(organization, name)
+            for dataset_type in profile.get('dataset_types', []):
+                self.by_dataset_type.setdefault(dataset_type, name)
+
+    def __bool__(self) -> bool:
+        return bool(self.profiles)
+
+    def select(self, dataset: 'dict[str, typing.Any]|None') -> 'str|None':
+        """ Returns the name of the profile for a dataset, given as a
+        package dict, matching its organisation by ID or name.
+        """
+        if not dataset or not self.profiles:
+            return None
+        organization = dataset.get('organization')
+        if isinstance(organization, dict):
+            organization = typing.cast('dict[str, typing.Any]', organization).get('name')
+        for key in (dataset.get('owner_org'), organization):
+            if key and key in self.by_organization:
+                return self.by_organization[key]
+        return self.by_dataset_type.get(dataset.get('type') or 'dataset')
+
+
+def profile_config(file_mime_config: 'dict[str, typing.Any]',
+                   name: str) -> 'tuple[dict[str, typing.Any], list[str]|None]':
+    """ Returns the types file contents as seen by a profile, and the
+    MIME types it allows, if they differ from ckan.mimetypes_allowed.
+    """
+    profile = file_mime_config['profiles'][name]
+    config = {key: value for key, value in file_mime_config.items() if key != 'profiles'}
+    for key, value in profile.get(ADD_KEY, {}).items():
+        if isinstance(value, dict):
+            config[key] = dict(config.get(key) or {}, **value)
+        else:
+            config[key] = list(config.get(key) or []) + list(value)
+    config.update((key, value) for key, value in profile.items()
+                  if key not in SELECTOR_KEYS + (ADD_KEY, ALLOWED_MIME_TYPES_KEY))
+    return config, profile.get(ALLOWED_MIME_TYPES_KEY)
+
+
+def dataset_dict(owner_org: 'str|None', organization_name: 'str|None',
+                 dataset_type: 'str|None') -> 'dict[str, typing.Any]':
+    """ Returns the parts of a package dict that select its profile.
+    """
+    return {'owner_org': owner_org,
+            'organization': {'name': organization_name} if organization_name else None,
+            'type': dataset_type or 'dataset'}
+
+
+def dataset_summary(owner_org: 'str|None', dataset_type: 'str|None') -> 'dict[str, typing.Any]':
+    """ Returns the parts of a package dict that select its profile,
+    given its owner organisation as an ID or name.
+    """
+    organization = model.Group.get(owner_org) if owner_org else None
+    if not organization:
+        return dataset_dict(owner_org, None, dataset_type)
+    return dataset_dict(organization.id, organization.name, dataset_type)
+
+
+def stored_dataset(package_id: 'str|None') -> 'dict[str, typing.Any]|None':
+    """ Returns the parts of a stored dataset that select its profile,
+    if it exists.
+    """
+    package = model.Package.get(package_id) if package_id else None
+    if not package:
+        return None
+    return dataset_summary(package.owner_org, package.type)
@@ -0,0 +1,284 @@
+# encoding: utf-8
+""" Fetching the first bytes of link resources, so that their contents
+can be sniffed like those of uploads.
+
+Only a prefix is requested, with an HTTP Range header, over keep-alive
+connections shared by every validation in the process. Connections per
+host are limited, so that a harvest full of links to one server doesn't
+overwhelm it. Results are cached for a while, then revalidated with the
+server's ETag or Last-Modified validators, so that unchanged links cost
+a single round trip. Failures are cached too, so that a dead server
+costs one timeout per cache period rather than one per link. The
+timeout bounds the whole fetch, so a server can't hold a validation by
+sending its response a byte at a time.
+
+By default, connections are only made to public addresses, so that
+resource links can't be used to probe the site's internal network.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import ipaddress
+from logging import getLogger
+import socket
+import threading
+import time
+import typing
+from urllib.parse import urlsplit
+
+from ckan.common import asbool
+import urllib3
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+LOG = getLogger(__name__)
+
+DEFAULT_FETCH_BYTES = 2048
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_CACHE_SIZE = 10000
+MAX_REDIRECTS = 3
+# hosts whose connection pools are kept at once
+POOL_COUNT = 100
+# links fetched at once when fetching a batch
+PREFETCH_THREADS = 16
+# types that say nothing about the contents
+UNINFORMATIVE_TYPES = ('application/octet-stream', 'binary/octet-stream')
+
+
+class BlockedAddressError(urllib3.exceptions.HTTPError):
+    """ A link resolved to an address that may not be fetched.
+    """
+
+
+def _public_only(sock: socket.socket) -> socket.socket:
+    """ Refuses connections to private, loopback, link-local and other
+    non-global addresses. The address checked is the one actually
+    connected to, so DNS tricks can't slip past it.
+    """
+    address = ipaddress.ip_address(sock.getpeername()[0].split('%')[0])
+    if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    if not address.is_global:
+        sock.close()
+        raise BlockedAddressError("{} is not a public address".format(address))
+    return sock
+
+
+class _PublicHTTPConnection(HTTPConnection):
+
+    def _new_conn(self) -> socket.socket:
+        return _public_only(super()._new_conn())
+
+
+class _PublicHTTPSConnection(HTTPSConnection):
+
+    def _new_conn(self) -> socket.socket:
+        return _public_only(super()._new_conn())
+
+
+# urllib3's connection classes, and so these, don't satisfy the protocols
+# its pools declare as far as static checkers can tell
+class _PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = typing.cast(typing.Any, _PublicHTTPConnection)
+
+
+class _PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = typing.cast(typing.Any, _PublicHTTPSConnection)
+
+
+class RemoteContent(typing.NamedTuple):
+    """ What a link's server said about it: the Content-Type, without
+    parameters, unless it was missing or uninformative, and the first
+    bytes of the body.
+    """
+    content_type: 'str|None'
+    head: bytes
+
+
+class _CacheEntry(typing.NamedTuple):
+    content: 'RemoteContent|None'
+    etag: 'str|None'
+    last_modified: 'str|None'
+    expires: float
+
+
+def _content_type(header: 'str|None') -> 'str|None':
+    content_type = (header or '').split(';', 1)[0].strip().lower()
+    if not content_type or content_type in UNINFORMATIVE_TYPES:
+        return None
+    return content_type
+
+
+def _read_some(response: typing.Any, amount: int) -> bytes:
+    """ Read what arrives next of a body, up to 'amount' bytes, taking
+    no more than one read from the socket.
+
+    urllib3 2 offers 'read1' for this. Its 1.26 series, which CKAN 2.9
+    and 2.10 pin, lacks it, and its 'read' waits for 'amount' bytes,
+    so it is read a byte at a time; the socket is buffered, so this
+    still takes few reads from it.
+    """
+    read1 = getattr(response, 'read1', None)
+    if read1 is not None:
+        return read1(amount)
+    return response.read(1, decode_content=False)
+
+
+class RemoteFetcher:
+    """ Fetches and caches the first 'max_bytes' of links.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_FETCH_BYTES, timeout: float = DEFAULT_TIMEOUT,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS, cache_ttl: float = DEFAULT_CACHE_TTL,
+                 cache_size: int = DEFAULT_CACHE_SIZE, allow_private: bool = False,
+                 clock: 'typing.Callable[[], float]' = time.monotonic):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.clock = clock
+        # block, so that each host gets at most 'max_connections' at once
+        self.pool = urllib3.PoolManager(
+            num_pools=POOL_COUNT, maxsize=max_connections, block=True,
+            timeout=urllib3.Timeout(total=timeout),
+            retries=urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=MAX_REDIRECTS))
+        if not allow_private:
+            self.pool.pool_classes_by_scheme = {
+                'http': _PublicHTTPConnectionPool, 'https': _PublicHTTPSConnectionPool}
+        self._cache: 'OrderedDict[str, _CacheEntry]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor: 'ThreadPoolExecutor|None' = None
+
+    def _cached(self, url: str) -> '_CacheEntry|None':
+        with self._lock:
+            entry = self._cache.get(url)
+            if entry is not None:
+                self._cache.move_to_end(url)
+            return entry
+
+    def _store(self, url: str, entry: _CacheEntry) -> None:
+        with self._lock:
+            self._cache[url] = entry
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def fetch(self, url: str) -> 'RemoteContent|None':
+        """ Returns what the server of 'url' says about it, from the
+        cache if still fresh, or None if it couldn't be fetched.
+        """
+        entry = self._cached(url)
+        if entry is not None and entry.expires > self.clock():
+            return entry.content
+        if urlsplit(url).scheme.lower() not in ('http', 'https'):
+            return None
+        entry = self._request(url, entry)
+        self._store(url, entry)
+        return entry.content
+
+    def _request(self, url: str, stale: '_CacheEntry|None') -> _CacheEntry:
+        headers = {'Range': 'bytes=0-{}'.format(self.max_bytes - 1), 'Accept-Encoding': 'identity'}
+        if stale and stale.etag:
+            headers['If-None-Match'] = stale.etag
+        if stale and stale.last_modified:
+            headers['If-Modified-Since'] = stale.last_modified
+        expires = self.clock() + self.cache_ttl
+        deadline = time.monotonic() + self.timeout
+        try:
+            response = self.pool.request('GET', url, headers=headers, preload_content=False,
+                                         pool_timeout=self.timeout)
+        except (urllib3.exceptions.HTTPError, OSError, ValueError) as e:
+            LOG.debug("Unable to fetch %s: %s", url, e)
+            return _CacheEntry(None, None, None, expires)
+        try:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if response.status == 304 and stale:
+                LOG.debug("%s is unchanged", url)
+                return _CacheEntry(stale.content, etag or stale.etag, last_modified or stale.last_modified, expires)
+            if response.status not in (200, 206):
+                LOG.debug("Unable to fetch %s: status %s", url, response.status)
+                return _CacheEntry(None, None, None, expires)
+            head = self._read_head(response, deadline)
+            return _CacheEntry(RemoteContent(_content_type(response.headers.get('Content-Type')), head),
+                               etag, last_modified, expires)
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            LOG.debug("Unable to read %s: %s", url, e)
+            return _CacheEntry(None, None, None, expires)
+        finally:
+            self._release(response)
+
+    def _read_head(self, response: typing.Any, deadline: float) -> bytes:
+        """ Read up to 'max_bytes' of the body, a read at a time, giving
+        up once 'deadline' has passed.
+        """
+        head = b''
+        while len(head) < self.max_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("gave up after {} seconds".format(self.timeout))
+            # no single read may outlast the deadline either; the
+            # connection is released once the body has all been read
+            connection = response.connection
+            if connection is not None and connection.sock is not None:
+                connection.sock.settimeout(remaining)
+            data = _read_some(response, self.max_bytes - len(head))
+            if not data:
+                break
+            head += data
+        return head
+
+    def _release(self, response: typing.Any) -> None:
+        """ Return the connection to the pool, if the rest of the body
+        was already read, or else close it rather than download the rest.
+        """
+        if response.length_remaining == 0:
+            response.drain_conn()
+        else:
+            response.close()
+        response.release_conn()
+
+    def fetch_all(self, urls: 'typing.Iterable[str]') -> 'dict[str, RemoteContent|None]':
+        """ Returns what the servers of 'urls' say about them, as by
+        'fetch'. Any that aren't cached are fetched several at once,
+        so that validating a batch of links waits for the slowest server
+        rather than for every server in turn.
+        """
+        now = self.clock()
+        contents: 'dict[str, RemoteContent|None]' = {}
+        missing: 'set[str]' = set()
+        for url in urls:
+            entry = self._cached(url)
+            if entry is None or entry.expires <= now:
+                missing.add(url)
+            else:
+                contents[url] = entry.content
+        if len(missing) == 1:
+            url = missing.pop()
+            contents[url] = self.fetch(url)
+        elif missing:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(PREFETCH_THREADS, thread_name_prefix='resource-type-fetch')
+            futures = {url: self._executor.submit(self.fetch, url) for url in missing}
+            wait(futures.values())
+            contents.update((url, future.result()) for url, future in futures.items())
+        return contents
+
+
+def build_remote_fetcher(config: typing.Any) -> 'RemoteFetcher|None':
+    """ Construct the fetcher for link resources, if enabled.
+    """
+    max_bytes = int(config.get('ckanext.resource_validation.remote_fetch_bytes', 0))
+    if max_bytes <= 0:
+        return None
+    allow_private = asbool(config.get('ckanext.resource_validation.remote_allow_private', False))
+    return RemoteFetcher(
+        max_bytes,
+        float(config.get('ckanext.resource_validation.remote_timeout', DEFAULT_TIMEOUT)),
+        int(config.get('ckanext.resource_validation.remote_max_connections', DEFAULT_MAX_CONNECTIONS)),
+        float(config.get('ckanext.resource_validation.remote_cache_ttl', DEFAULT_CACHE_TTL)),
+        int(config.get('ckanext.resource_validation.remote_cache_size', DEFAULT_CACHE_SIZE)),
+        allow_private)
@@ -3,32 +3,94 @@
 file extension, file contents, and resource format should match.
 """
 
+from collections import OrderedDict
+import io
 import json
 from logging import getLogger
-import magic
-import mimetypes
 import os
-import re
-import six
+import threading
 import typing
+from urllib.parse import urlsplit
 
+from ckan.lib.munge import munge_filename
 from ckan.lib.uploader import ALLOWED_UPLOAD_TYPES
 from ckan.logic import ValidationError
-from ckan.common import CKANConfig
+from ckan.common import CKANConfig, asbool
 
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
 
+from . import metrics
+from .deferred import ERRORS_FIELD, FINGERPRINT_FIELD, STATUS_CONFIRMED, STATUS_FIELD, STATUS_PENDING, \
+    STATUS_QUARANTINED, is_pending
+from .extension_index import ExtensionPolicy
+from .archive import ARCHIVE_INSPECTORS, ArchiveError, ArchiveLimits, DEFAULT_MAX_ENTRIES, \
+    DEFAULT_MAX_RATIO, DEFAULT_MAX_SIZE, inspect_archive, inspect_zip_tail
+from .chunked import ChunkedUpload
+from .profiles import profile_config
+from .remote import RemoteContent, build_remote_fetcher
+from .sniffer import CDFV2_CORRUPT, DEFAULT_MAX_SNIFF_BYTES, DEFAULT_POOL_SIZE, HEAD_SIZE, \
+    MagicPool, Sniffer, content_view, head_view, libmagic_version
+from .tee import TeeStream, TeeSummary
+from .text_sniffer import DEFAULT_MAX_BYTES as DEFAULT_TEXT_SNIFF_BYTES
+from .type_policy import TypePolicy, TypesFileWatcher, load_types_file
+from .verdict_cache import NEEDS_FULL_CONTENT, Verdict, VerdictCache, \
+    build_verdict_cache, content_digest, stream_digest, type_suffix
+from .urls import DEFAULT_CACHE_SIZE as DEFAULT_URL_CACHE_SIZE, REMOTE, UrlClassifier
+
 LOG = getLogger(__name__)
 
-IS_REMOTE_URL_PATTERN = re.compile(r'^[a-z+]+://')
+DEFAULT_TYPES_FILE = os.path.join(os.path.dirname(__file__), 'resources', 'resource_types.json')
+# compiled policy profiles kept at once
+DEFAULT_PROFILE_CACHE_SIZE = 16
 
 
-def _get_underlying_file(wrapper: 'FlaskFileStorage|typing.Any') -> 'typing.TextIO|typing.IO[bytes]':
+def _get_underlying_file(wrapper: 'FlaskFileStorage|typing.Any') -> 'typing.IO[bytes]':
     if isinstance(wrapper, FlaskFileStorage):
         return wrapper.stream
     return wrapper.file
 
 
+def _set_underlying_file(wrapper: 'FlaskFileStorage|typing.Any', stream: typing.Any) -> None:
+    if isinstance(wrapper, FlaskFileStorage):
+        wrapper.stream = stream
+    else:
+        wrapper.file = stream
+
+
+def _is_archive(policy: TypePolicy, filename_mimetype: 'str|None', sniffed_mimetype: 'str|None') -> bool:
+    return any(type_candidate in policy.archive_mimetypes
+               for type_candidate in (filename_mimetype, sniffed_mimetype))
+
+
+def _allow_override(policy: TypePolicy, filename_mimetype: 'str|None', format_mimetype: 'str|None') -> bool:
+    """ If the file extension or format matches a generic type,
+    then sniffing should say the same.
+    This is to prevent attacks based on browser sniffing.
+    """
+    return filename_mimetype not in policy.generic_mimetypes \
+        and format_mimetype not in policy.generic_mimetypes \
+        or filename_mimetype in policy.archive_mimetypes
+
+
+def _verdict_key(verdict_cache: VerdictCache, resource: 'dict[str, typing.Any]', filename: str, digest: str) -> str:
+    return verdict_cache.key(
+        digest, filename, _cast_to_str(resource.get('format')),
+        _cast_to_str(resource.get('mimetype')))
+
+
+def _new_upload(resource: 'dict[str, typing.Any]') -> typing.Any:
+    """ The upload in progress for a resource, if any.
+    """
+    upload = resource.get('upload', None)
+    return upload if isinstance(upload, ALLOWED_UPLOAD_TYPES) and upload.filename else None
+
+
+def _upload_size(upload_file: 'typing.IO[bytes]') -> int:
+    size = upload_file.seek(0, os.SEEK_END)
+    upload_file.seek(0, os.SEEK_SET)
+    return size
+
+
 def _cast_to_str(value: typing.Any) -> 'str|None':
     """ Cast an unknown value to 'str' without converting None to 'None'.
     """
@@ -39,52 +101,87 @@ def normalize_whitespace(text: str):
     return ' '.join(text.split())
 
 
+def _sniffed_from_prefix(sniffed_mimetype: 'str|None') -> 'str|None':
+    """ A type sniffed from the start of an upload, or None if
+    more is needed to tell.
+    """
+    if sniffed_mimetype and sniffed_mimetype.startswith(CDFV2_CORRUPT):
+        return None
+    return sniffed_mimetype
+
+
+def _apply_verdict(resource: 'dict[str, typing.Any]', verdict: Verdict) -> None:
+    """ Update a resource to match a previously determined verdict.
+    """
+    if verdict.mimetype is not None:
+        resource['mimetype'] = verdict.mimetype
+    if verdict.errors:
+        raise ValidationError(verdict.errors)
+
+
+def _type_fields(resource: 'dict[str, typing.Any]') -> 'tuple[str, str, str]':
+    return (str(resource.get('url') or ''), str(resource.get('format') or '').lower(),
+            str(resource.get('mimetype') or ''))
+
+
+class _Batch:
+    """ State shared while validating a series of resources:
+    the sniffer to use, the type policy in force when the batch
+    started, whether large uploads may be left for deferred
+    validation, and the contents of any links already fetched.
+    """
+
+    def __init__(self, sniffer: Sniffer, policy: TypePolicy, allow_deferral: bool = True,
+                 links: 'dict[str, RemoteContent|None]|None' = None):
+        self.sniffer = sniffer
+        self.policy = policy
+        self.allow_deferral = allow_deferral
+        self.links = links or {}
+
+
+class _Guesses(typing.NamedTuple):
+    """ The types indicated by an upload's name and resource format,
+    and any policy for its extension.
+    """
+    filename_mimetype: 'str|None'
+    format_mimetype: 'str|None'
+    extension_policy: 'ExtensionPolicy|None' = None
+
+
+class _EarlyRejection(ValidationError):
+    """ A rejection decided from names alone, before reading any upload.
+    """
+
+    def __init__(self, stage: str, error_dict: 'dict[str, typing.Any]'):
+        super().__init__(error_dict)
+        self.stage = stage
+
+
 class ResourceTypeValidator:
     allowed_mime_types: 'list[str]'
     invalid_upload_message: str
     mismatching_upload_message: str
-    generic_mimetypes: 'list[str]'
-
-    def __init__(self, config: CKANConfig):
-        types_file_name = config.get(
-            'ckanext.resource_validation.types_file',
-            os.path.join(os.path.dirname(__file__),
-                         'resources',
-                         'resource_types.json')
-        )
-        types_file = open(types_file_name)
-        try:
-            file_mime_config = json.load(types_file)
-        finally:
-            types_file.close()
-
-        # Add allowed upload types that don't seem to be standard.
-        # NB It's more important to match a sniffable type than an RFC type.
-        for extension, mime_type in six.iteritems(
-                file_mime_config.get('extra_mimetypes', {})
-        ):
-            mimetypes.add_type(mime_type, extension)
-
-        allowed_extensions = file_mime_config.get('allowed_extensions', [])
-        if allowed_extensions:
-            LOG.debug("Allowed file extensions: %s", allowed_extensions)
-            self.allowed_extensions_pattern = re.compile(
-                r'.*\.(' + '|'.join(allowed_extensions) + ')$', re.I
-            )
 
-        self.allowed_overrides = file_mime_config.get('allowed_overrides', {})
-        self.equal_types = file_mime_config.get('equal_types', [])
-        self.archive_mimetypes = file_mime_config.get('archive_types', [])
-        self.generic_mimetypes = file_mime_config.get(
-            'generic_types', self.allowed_overrides.keys())
-        error_contact = config.get(
+    def __init__(self, config: 'CKANConfig|dict[str, typing.Any]'):
+        types_file_name = config.get('ckanext.resource_validation.types_file', DEFAULT_TYPES_FILE)
+        self.types_file_name = types_file_name
+
+        self.archive_limits = ArchiveLimits(
+            max_entries=int(config.get(
+                'ckanext.resource_validation.archive_max_entries', DEFAULT_MAX_ENTRIES)),
+            max_ratio=float(config.get(
+                'ckanext.resource_validation.archive_max_ratio', DEFAULT_MAX_RATIO)),
+            max_size=int(config.get(
+                'ckanext.resource_validation.archive_max_size', DEFAULT_MAX_SIZE)),
+        )
+        self.error_contact = error_contact = config.get(
             'ckanext.resource_validation.support_contact',
             'the site owner.'
         )
-        self.file_download_pattern = re.compile(
-            config.get('ckan.site_url', '') + '(/[-_a-z0-9]+){2}/resource/[-0-9a-f]+/download',
-            re.IGNORECASE
-        )
+        self.urls = UrlClassifier(
+            config.get('ckan.site_url', ''),
+            config.get('ckanext.resource_validation.mirror_urls', '').split(),
+            int(config.get('ckanext.resource_validation.url_cache_size', DEFAULT_URL_CACHE_SIZE)))
 
         self.invalid_upload_message = normalize_whitespace(
             '''This file type is not supported.
@@ -96,107 +193,809 @@ class ResourceTypeValidator:
             Unable to determine whether the file is of type '{}' or '{}'.
             If possible, upload the file in another format.
             If you continue to have problems, contact ''' + error_contact)
+        self.invalid_archive_message = normalize_whitespace(
+            '''This archive is malformed, too large, or does not contain
+            the expected files for its type.
+            If possible, upload the file in another format.
+            If you continue to have problems, contact ''' + error_contact)
+        self.oversized_upload_message = normalize_whitespace(
+            '''This file is larger than allowed for its type.
+            If possible, upload the file in another format.
+            If you continue to have problems, contact ''' + error_contact)
 
         self.allowed_mime_types = config.get(
             'ckan.mimetypes_allowed', '*').split(',')
 
-    def validate_resource_mimetype(self, resource: 'dict[str, typing.Any]') -> None:
-        upload_field_storage: typing.Any = resource.get('upload', None)
-        sniffed_mimetype: 'str|None'  # type sniffed from file contents
-        filename: str  # name of the uploaded file
-        filename_mimetype: 'str|None'  # type deduced from file extension
-        format_mimetype: 'str|None'  # type deduced from selected resource format
-        claimed_mimetype: 'str|None'  # type recorded in resource data
-        best_guess_mimetype: 'str|None'  # best type match from coalescing other guesses
-        if isinstance(upload_field_storage, ALLOWED_UPLOAD_TYPES) \
-                and upload_field_storage.filename:
-            filename = upload_field_storage.filename
+        self.sniffer = MagicPool(int(config.get(
+            'ckanext.resource_validation.magic_pool_size', DEFAULT_POOL_SIZE)))
+        self.max_sniff_bytes = int(config.get(
+            'ckanext.resource_validation.max_sniff_bytes', DEFAULT_MAX_SNIFF_BYTES))
+        self.text_sniff_bytes = int(config.get(
+            'ckanext.resource_validation.text_sniff_bytes', DEFAULT_TEXT_SNIFF_BYTES))
+        self.deferred_min_size = int(config.get(
+            'ckanext.resource_validation.deferred_min_size', 0))
+        self.upload_digests = asbool(config.get('ckanext.resource_validation.upload_digests', False))
+        self.remote = build_remote_fetcher(config)
 
-            mime = magic.Magic(mime=True)
-            upload_file = _get_underlying_file(upload_field_storage)
-            # needs to be at least 2048 bytes to recognise DOCX properly
-            sniffed_mimetype = mime.from_buffer(upload_file.read(2048))
-            # go back to the beginning of the file buffer
-            upload_file.seek(0, os.SEEK_SET)
-            # When on old libmagic/file lookup, it needs the full file for type sniffing to be successful.
-            if (sniffed_mimetype.startswith('Composite Document File V2 Document, corrupt')):
-                sniffed_mimetype = mime.from_buffer(upload_file.read())
-                # go back to the beginning of the file buffer
-                upload_file.seek(0, os.SEEK_SET)
+        # each policy gets a cache with its own fingerprint; see _build_policy
+        self.verdict_cache = build_verdict_cache(config, '')
+        self._policy: 'TypePolicy|None' = None
+        self._policy_lock = threading.Lock()
+        self.profile_cache_size = int(config.get(
+            'ckanext.resource_validation.profile_cache_size', DEFAULT_PROFILE_CACHE_SIZE))
+        self._profile_policies: 'OrderedDict[tuple[str, str], TypePolicy]' = OrderedDict()
+        self._profile_lock = threading.Lock()
+        self.types_file_watcher: 'TypesFileWatcher|None' = None
+        poll_interval = float(config.get('ckanext.resource_validation.types_file_poll_interval', 0))
+        if poll_interval > 0:
+            self.types_file_watcher = TypesFileWatcher(types_file_name, poll_interval, self.replace_policy)
+        self.metrics = metrics.build_metrics_sink(config)
+        self.rejection_reasons = {
+            self.invalid_upload_message: 'unsupported',
+            self.invalid_archive_message: 'invalid_archive',
+            self.oversized_upload_message: 'too_large',
+        }
 
-            LOG.debug('Upload sniffing indicates MIME type %s',
-                      sniffed_mimetype)
-            # print('Upload sniffing indicates MIME type ',
-            #           sniffed_mimetype, upload_file, '\r\n')
-        elif IS_REMOTE_URL_PATTERN.search(
-                self.file_download_pattern.sub('', resource.get('url', 'http://example.com'))
-        ):
-            LOG.debug('%s [%s] is not an uploaded resource, skipping validation',
-                      resource.get('id', 'New resource'), resource.get('url'))
+    def _fingerprint(self, file_mime_config: 'dict[str, typing.Any]', allowed_mime_types: 'list[str]') -> str:
+        """ Identifies everything that can affect a verdict, so that
+        cached verdicts are discarded when the configuration changes.
+        """
+        return content_digest(json.dumps(
+            [file_mime_config, allowed_mime_types, self.error_contact,
+             self.max_sniff_bytes, self.text_sniff_bytes, self.archive_limits, libmagic_version()],
+            sort_keys=True).encode('utf-8'))
+
+    def _build_policy(self, file_mime_config: 'dict[str, typing.Any]',
+                      allowed_mime_types: 'list[str]|None' = None) -> TypePolicy:
+        allowed_mime_types = allowed_mime_types or self.allowed_mime_types
+        fingerprint = self._fingerprint(file_mime_config, allowed_mime_types)
+        verdict_cache = self.verdict_cache and VerdictCache(self.verdict_cache.store, fingerprint)
+        return TypePolicy(file_mime_config, allowed_mime_types, verdict_cache, fingerprint)
+
+    @property
+    def policy(self) -> TypePolicy:
+        """ The type policy in force. It is built on first use rather
+        than at startup, so that processes which never validate anything,
+        such as most CLI commands, don't pay for it.
+        """
+        policy = self._policy
+        if policy is None:
+            with self._policy_lock:
+                if self._policy is None:
+                    self._policy = self._build_policy(load_types_file(self.types_file_name))
+                policy = self._policy
+        return policy
+
+    def replace_policy(self, file_mime_config: 'dict[str, typing.Any]') -> None:
+        """ Compile a new type policy from types file contents, and use
+        it for validations that start from now on.
+
+        If the contents are invalid, then the current policy is kept.
+        """
+        # a single assignment, so validations see the old policy or the new
+        self._policy = self._build_policy(file_mime_config)
+
+    def current_policy(self, dataset: 'dict[str, typing.Any]|None' = None) -> TypePolicy:
+        """ Returns the type policy for a new validation of a resource
+        of 'dataset', a package dict, first checking whether the types
+        file has changed, if enabled.
+
+        If the types file has a profile for the dataset, then the policy
+        is that profile's.
+        """
+        if self.types_file_watcher:
+            self.types_file_watcher.check()
+        policy = self.policy
+        name = policy.profiles.select(dataset)
+        if name is None:
+            return policy
+        return self._profile_policy(policy, name)
+
+    def uses_profiles(self) -> bool:
+        """ Returns True if the types file has any policy profiles,
+        so that callers need only look up datasets when it matters.
+        """
+        return bool(self.policy.profiles)
+
+    def _profile_policy(self, policy: TypePolicy, name: str) -> TypePolicy:
+        """ Returns the compiled policy for a profile of 'policy',
+        compiling it if it isn't among those most recently used.
+        """
+        # the base policy's fingerprint changes with the types file
+        key = (policy.fingerprint, name)
+        with self._profile_lock:
+            profile_policy = self._profile_policies.get(key)
+            if profile_policy is not None:
+                self._profile_policies.move_to_end(key)
+                return profile_policy
+        file_mime_config, allowed_mime_types = profile_config(policy.file_mime_config, name)
+        LOG.debug("Compiling policy profile %s", name)
+        profile_policy = self._build_policy(file_mime_config, allowed_mime_types=allowed_mime_types)
+        with self._profile_lock:
+            # if another thread compiled it meanwhile, then use theirs
+            profile_policy = self._profile_policies.setdefault(key, profile_policy)
+            self._profile_policies.move_to_end(key)
+            while len(self._profile_policies) > self.profile_cache_size:
+                self._profile_policies.popitem(last=False)
+        return profile_policy
+
+    def validate_resource_mimetype(self, resource: 'dict[str, typing.Any]',
+                                   allow_deferral: bool = True,
+                                   dataset: 'dict[str, typing.Any]|None' = None) -> None:
+        """ Check that a resource's file extension, format, and any
+        upload contents are compatible, and set its MIME type.
+
+        If deferred validation is enabled and 'allow_deferral' is set,
+        then large uploads get only the checks that need the start of
+        the file, and are marked as pending deferred validation.
+
+        If given, 'dataset' is the package dict of the resource's dataset,
+        which selects the policy profile, if any.
+
+        Raises ValidationError if the resource is unacceptable.
+        """
+        self._validate_resource(resource, _Batch(self.sniffer, self.current_policy(dataset), allow_deferral))
+
+    def is_unchanged(self, current: 'dict[str, typing.Any]|None', resource: 'dict[str, typing.Any]',
+                     dataset: 'dict[str, typing.Any]|None' = None) -> bool:
+        """ Returns True if 'resource' updates 'current', the stored
+        resource, without a new upload or any change to the fields that
+        affect its type, and 'current' passed validation under the type
+        policy now in force; so it needn't be validated again.
+
+        Links are the exception: their contents can change at any time,
+        and may already have failed to match, so they are only fetched
+        again if a field affecting their type has changed. Otherwise,
+        a link that stopped matching would block every later edit of
+        its dataset, even ones that don't touch it.
+
+        'current' need only hold the stored validation fields and
+        those affecting the type.
+        """
+        if not current or _new_upload(resource) is not None:
+            return False
+        if self.checks_link(resource) and _type_fields(current) == _type_fields(resource):
+            LOG.debug("Link %s is unchanged", resource.get('id'))
+            self.metrics.increment('validations', {'outcome': 'unchanged'})
+            return True
+        fingerprint = current.get(FINGERPRINT_FIELD)
+        if not fingerprint or fingerprint != self._resource_fingerprint(self.current_policy(dataset), resource):
+            return False
+        LOG.debug("%s is unchanged since it was validated", resource.get('id'))
+        self.metrics.increment('validations', {'outcome': 'unchanged'})
+        return True
+
+    def _resource_fingerprint(self, policy: TypePolicy, resource: 'dict[str, typing.Any]') -> str:
+        """ Identifies the fields of a resource that affect its type,
+        along with the policy that it is checked against.
+        """
+        upload = _new_upload(resource)
+        # CKAN replaces the URL of an upload with its munged filename
+        url = munge_filename(upload.filename) if upload is not None else str(resource.get('url') or '')
+        if self.urls.classify(url) != REMOTE:
+            # an upload is stored under its filename, but shown as a
+            # download link; only its extension affects its type
+            url = type_suffix(url)
+        return content_digest(json.dumps(
+            [policy.fingerprint, url, str(resource.get('format') or '').lower(),
+             _cast_to_str(resource.get('mimetype'))]).encode('utf-8'))
+
+    def _stamp(self, resource: 'dict[str, typing.Any]', policy: TypePolicy) -> None:
+        """ Record that a resource has passed validation as it stands.
+        """
+        resource[FINGERPRINT_FIELD] = self._resource_fingerprint(policy, resource)
+
+    def validate_resources(self, resources: 'typing.Iterable[dict[str, typing.Any]]',
+                           allow_deferral: bool = True,
+                           dataset: 'dict[str, typing.Any]|None' = None) -> 'list[Verdict]':
+        """ Validate a batch of resources of one dataset, if given,
+        sharing one libmagic handle and format lookups among them.
+
+        Each resource is updated as by 'validate_resource_mimetype',
+        but errors are returned rather than raised, so that every
+        resource is checked. Returns a Verdict for each resource,
+        in order, with 'errors' set if it was rejected.
+
+        Any links to be checked are fetched together first, so that
+        the libmagic handle isn't held while waiting on their servers.
+        """
+        verdicts: 'list[Verdict]' = []
+        links: 'dict[str, RemoteContent|None]' = {}
+        if self.remote:
+            resources = list(resources)
+            with self.metrics.stage(metrics.STAGE_REMOTE_FETCH):
+                links = self.remote.fetch_all(
+                    str(resource['url']) for resource in resources if self.checks_link(resource))
+        with self.sniffer.lease() as sniffer:
+            batch = _Batch(sniffer, self.current_policy(dataset), allow_deferral, links)
+            for resource in resources:
+                try:
+                    self._validate_resource(resource, batch)
+                except ValidationError as e:
+                    verdicts.append(Verdict(resource.get('mimetype'), e.error_dict))
+                else:
+                    verdicts.append(Verdict(resource.get('mimetype')))
+        return verdicts
+
+    def _validate_resource(self, resource: 'dict[str, typing.Any]', batch: _Batch) -> None:
+        upload_field_storage = _new_upload(resource)
+        if upload_field_storage is not None:
+            validate = self._validate_upload
+            filename = upload_field_storage.filename
+            decided_by = metrics.DECIDED_CONTENT
+        elif self.urls.classify(str(resource.get('url', 'http://example.com'))) == REMOTE:
+            if self.remote and resource.get('url'):
+                self._validate_link(resource, str(resource['url']), batch)
+            else:
+                LOG.debug('%s [%s] is not an uploaded resource, skipping validation',
+                          resource.get('id', 'New resource'), resource.get('url'))
             return
         else:
             LOG.debug('No upload in progress for %s; just sanity-check',
                       resource.get('id', 'new resource'))
+            validate = self._validate_stored
             filename = str(resource.get('url'))
-            sniffed_mimetype = None
+            decided_by = metrics.DECIDED_STORED
+        try:
+            guesses = self._check_names(resource, filename, batch.policy)
+            validate(resource, upload_field_storage, batch, guesses)
+        except ValidationError as e:
+            self._count_rejection(filename, e, decided_by)
+            raise
+        self._count_acceptance(resource, decided_by)
+        self._stamp(resource, batch.policy)
 
-        if (self.allowed_extensions_pattern
-                and not self.allowed_extensions_pattern.search(filename)):
-            raise ValidationError(
-                {'upload': [self.invalid_upload_message]}
-            )
+    def checks_link(self, resource: 'dict[str, typing.Any]') -> bool:
+        """ Returns True if 'resource' links elsewhere, and its contents
+        will be fetched to check it.
+        """
+        return bool(self.remote and resource.get('url') and not resource.get('upload')
+                    and self.urls.classify(str(resource['url'])) == REMOTE)
+
+    def _validate_link(self, resource: 'dict[str, typing.Any]', url: str, batch: _Batch) -> None:
+        """ Check a resource that links elsewhere from the first bytes
+        at its URL. If they can't be fetched, the link is left unchecked.
+        """
+        assert self.remote
+        if url in batch.links:
+            content = batch.links[url]
+        else:
+            with self.metrics.stage(metrics.STAGE_REMOTE_FETCH):
+                content = self.remote.fetch(url)
+        self.metrics.increment('remote_fetches', {'result': 'failed' if content is None else 'fetched'})
+        if content is None:
+            LOG.debug("Unable to fetch %s, skipping validation", url)
+            return
+        try:
+            self._validate_remote_content(resource, url, content, batch)
+        except ValidationError as e:
+            self._count_rejection(url, e, metrics.DECIDED_REMOTE)
+            raise
+        self._count_acceptance(resource, metrics.DECIDED_REMOTE)
+        self._stamp(resource, batch.policy)
+
+    def _validate_remote_content(self, resource: 'dict[str, typing.Any]', url: str, content: RemoteContent,
+                                 batch: _Batch) -> None:
+        """ Check the types of a link against the first bytes at its URL.
+
+        The Content-Type reported by the server is used only if nothing
+        could be sniffed, since servers often report a generic or wrong
+        type, eg 'application/vnd.ms-excel' for CSV. Links aren't held to
+        the extensions and types allowed for uploads.
+        """
+        policy = batch.policy
+        resource_format = _cast_to_str(resource.get('format'))
+        with self.metrics.stage(metrics.STAGE_GUESS_TYPE):
+            guesses = _Guesses(policy.file_types.type_for_filename(urlsplit(url).path),
+                               policy.file_types.type_for_format(resource_format))
+        sniffed_mimetype = None
+        if content.head:
+            with self.metrics.stage(metrics.STAGE_SNIFF):
+                sniffed_mimetype = _sniffed_from_prefix(self._sniff_head(batch, content.head))
+            self.metrics.observe('sniff_bytes', len(content.head))
+        if sniffed_mimetype:
+            sniffed_mimetype, _ = self._sniff_text(
+                resource, policy, guesses, io.BytesIO(content.head), sniffed_mimetype,
+                min(len(content.head), self.text_sniff_bytes))
+        LOG.debug("First bytes of %s indicate MIME type %s; server reports %s",
+                  url, sniffed_mimetype, content.content_type)
+        try:
+            self._validate_types(resource, url, sniffed_mimetype or content.content_type, batch, guesses,
+                                 check_allowed=False)
+        except ValidationError as e:
+            # report the problem against the link rather than an upload
+            raise ValidationError({'url': e.error_dict['upload']})
+
+    def _count_rejection(self, filename: str, error: ValidationError, decided_by: str) -> None:
+        if isinstance(error, _EarlyRejection):
+            decided_by = error.stage
+        LOG.debug("Rejected %s at stage %s", filename, decided_by)
+        self.metrics.increment('validations', {
+            'outcome': 'rejected', 'reason': self._rejection_reason(error.error_dict),
+            'stage': decided_by})
+
+    def _count_acceptance(self, resource: 'dict[str, typing.Any]', decided_by: str) -> None:
+        self.metrics.increment('validations', {
+            'outcome': 'accepted', 'mimetype': str(resource.get('mimetype')),
+            'stage': decided_by})
+
+    def start_chunked_upload(self, resource: 'dict[str, typing.Any]', filename: str,
+                             dataset: 'dict[str, typing.Any]|None' = None) -> ChunkedUpload:
+        """ Check a resource whose upload, 'filename', is about to
+        arrive in chunks, as far as its filename and format allow.
+
+        Returns the state to pass with the first chunk.
+        Raises ValidationError if the resource is unacceptable.
+        """
+        try:
+            self._check_names(resource, filename, self.current_policy(dataset))
+        except ValidationError as e:
+            self._count_rejection(filename, e, metrics.DECIDED_CONTENT)
+            raise
+        return ChunkedUpload(filename)
+
+    def validate_chunk(self, resource: 'dict[str, typing.Any]', upload: ChunkedUpload,
+                       chunk: 'bytes|memoryview', offset: 'int|None' = None,
+                       dataset: 'dict[str, typing.Any]|None' = None) -> ChunkedUpload:
+        """ Check the next chunk of an upload, which starts at 'offset'
+        within it, if given. Once the first bytes have arrived, they are
+        sniffed, and the resource is rejected if its types conflict.
+
+        Returns the state to pass with the next chunk. Raises
+        ValidationError if the resource is unacceptable, or ValueError
+        if the chunk doesn't follow those already received.
+        """
+        batch = _Batch(self.sniffer, self.current_policy(dataset))
+        try:
+            guesses = self._check_names(resource, upload.filename, batch.policy)
+            upload = upload.add(chunk, offset)
+            max_size = guesses.extension_policy and guesses.extension_policy.max_size
+            if max_size is not None and upload.received > max_size:
+                raise _EarlyRejection(metrics.DECIDED_SIZE, {'upload': [self.oversized_upload_message]})
+            if upload.sniffed_mimetype is None and len(upload.head) >= HEAD_SIZE:
+                upload = self._sniff_chunked(resource, upload, batch, guesses)
+        except ValidationError as e:
+            self._count_rejection(upload.filename, e, metrics.DECIDED_CONTENT)
+            raise
+        return upload
+
+    def finish_chunked_upload(self, resource: 'dict[str, typing.Any]', upload: ChunkedUpload,
+                              dataset: 'dict[str, typing.Any]|None' = None) -> None:
+        """ Complete the checks on an upload whose chunks have all
+        arrived, and set the resource's MIME type.
+
+        An archive is checked from the last bytes of the upload if its
+        central directory is among them. If not, or if its type needs
+        more than the first bytes to sniff, the resource is marked as
+        pending deferred validation of the stored file.
+
+        Raises ValidationError if the resource is unacceptable.
+        """
+        batch = _Batch(self.sniffer, self.current_policy(dataset))
+        try:
+            guesses = self._check_names(resource, upload.filename, batch.policy)
+            if upload.sniffed_mimetype is None:
+                upload = self._sniff_chunked(resource, upload, batch, guesses)
+            else:
+                self._validate_types(resource, upload.filename, _sniffed_from_prefix(upload.sniffed_mimetype),
+                                     batch, guesses)
+            complete = self._check_archive_tail(resource, upload.filename, _sniffed_from_prefix(upload.sniffed_mimetype),
+                                                upload.tail, upload.received, batch.policy, guesses)
+        except ValidationError as e:
+            self._count_rejection(upload.filename, e, metrics.DECIDED_CONTENT)
+            raise
+        if not complete:
+            resource[STATUS_FIELD] = STATUS_PENDING
+            self.metrics.increment('deferrals')
+        self._count_acceptance(resource, metrics.DECIDED_CONTENT)
+        self._stamp(resource, batch.policy)
+
+    def _sniff_chunked(self, resource: 'dict[str, typing.Any]', upload: ChunkedUpload,
+                       batch: _Batch, guesses: _Guesses) -> ChunkedUpload:
+        """ Sniff and check the first bytes of a chunked upload,
+        as for the prefix of a deferred upload.
+        """
+        head = upload.head
+        with self.metrics.stage(metrics.STAGE_SNIFF):
+            sniffed_mimetype = self._sniff_head(batch, head)
+        self.metrics.observe('sniff_bytes', len(head))
+        if not sniffed_mimetype.startswith(CDFV2_CORRUPT):
+            sniffed_mimetype, _ = self._sniff_text(
+                resource, batch.policy, guesses, io.BytesIO(head), sniffed_mimetype,
+                min(len(head), self.text_sniff_bytes))
+        LOG.debug("First bytes of chunked upload %s indicate MIME type %s", upload.filename, sniffed_mimetype)
+        self._validate_types(resource, upload.filename, _sniffed_from_prefix(sniffed_mimetype), batch, guesses)
+        return upload.sniffed(sniffed_mimetype,
+                              _is_archive(batch.policy, guesses.filename_mimetype, sniffed_mimetype))
+
+    def _check_archive_tail(self, resource: 'dict[str, typing.Any]', filename: str, sniffed_mimetype: 'str|None',
+                            tail: bytes, size: int, policy: TypePolicy, guesses: _Guesses) -> bool:
+        """ Check the structure of an upload of 'size' bytes that is an
+        archive, from its last bytes, 'tail'.
+
+        Returns False if more of the upload is needed to be sure.
+        """
+        if sniffed_mimetype is None:
+            return False
+        if not _is_archive(policy, guesses.filename_mimetype, sniffed_mimetype):
+            return True
+        archive_type = sniffed_mimetype if sniffed_mimetype in policy.archive_mimetypes \
+            else guesses.filename_mimetype
+        if archive_type != 'application/zip':
+            # eg tar headers are spread throughout the file
+            return archive_type not in ARCHIVE_INSPECTORS
+        with self.metrics.stage(metrics.STAGE_ARCHIVE):
+            try:
+                summary = inspect_zip_tail(tail, size, self.archive_limits,
+                                           policy.archive_members.get(resource.get('mimetype') or '', []))
+            except ArchiveError as e:
+                LOG.debug("Invalid archive %s: %s", filename, e)
+                raise ValidationError({'upload': [self.invalid_archive_message]})
+        return summary is not None
+
+    def tee_upload(self, resource: 'dict[str, typing.Any]') -> 'TeeStream|None':
+        """ If upload digests are enabled, wrap the stream of a
+        resource's new upload, once it has been validated, so that
+        CKAN's uploader gathers its digest and last bytes while storing
+        it. Pass the result to 'check_stored_upload' afterwards.
+
+        Returns None if there is nothing to wrap.
+        """
+        upload_field_storage = _new_upload(resource)
+        if not self.upload_digests or upload_field_storage is None:
+            return None
+        tee = TeeStream(_get_underlying_file(upload_field_storage))
+        _set_underlying_file(upload_field_storage, tee)
+        return tee
+
+    def check_stored_upload(self, resource: 'dict[str, typing.Any]', tee: TeeStream,
+                            dataset: 'dict[str, typing.Any]|None' = None) -> 'dict[str, typing.Any]':
+        """ Complete the checks on a stored upload from what 'tee' saw
+        as it was stored, without reading it again.
+
+        The digest and size are recorded on the resource. Text with NUL
+        bytes beyond the first few is quarantined. A pending resource is
+        confirmed, or quarantined, if its first and last bytes are
+        enough to decide; otherwise it is left to deferred validation.
+
+        Returns the changes to make to the resource; none if the upload
+        wasn't read in one pass.
+        """
+        summary = tee.summary()
+        if summary is None:
+            LOG.debug("Upload for %s was not stored in one pass; no digest recorded", resource.get('id'))
+            self.metrics.increment('stored_uploads', {'result': 'incomplete'})
+            return {}
+        self.metrics.increment('stored_uploads', {'result': 'recorded'})
+        changes: 'dict[str, typing.Any]' = {'hash': summary.sha256, 'size': summary.size}
+        try:
+            if summary.first_null is not None and str(resource.get('mimetype')).startswith('text/'):
+                LOG.debug("Binary content follows a text header in %s", resource.get('url'))
+                raise ValidationError({'upload': [self.invalid_upload_message]})
+            if is_pending(resource):
+                changes.update(self._check_stored_summary(resource, summary, dataset))
+        except ValidationError as e:
+            LOG.warning("Quarantining resource %s: %s", resource.get('id'), e.error_dict)
+            changes.update({STATUS_FIELD: STATUS_QUARANTINED, ERRORS_FIELD: json.dumps(e.error_dict)})
+        if is_pending(resource) or STATUS_FIELD in changes:
+            self.metrics.increment('stored_checks', {'result': changes.get(STATUS_FIELD, STATUS_PENDING)})
+        return {key: value for key, value in changes.items() if resource.get(key) != value}
+
+    def _check_stored_summary(self, resource: 'dict[str, typing.Any]', summary: TeeSummary,
+                              dataset: 'dict[str, typing.Any]|None') -> 'dict[str, typing.Any]':
+        """ Check a pending resource from the summary of its stored
+        upload as its deferred validation would, ignoring its
+        provisional MIME type.
+
+        Returns the changes that confirm it, if its first and last bytes
+        are enough to be sure. Raises ValidationError if it is
+        unacceptable.
+        """
+        filename = str(resource.get('url') or '').rsplit('/', 1)[-1]
+        candidate: 'dict[str, typing.Any]' = {'url': filename, 'format': resource.get('format')}
+        batch = _Batch(self.sniffer, self.current_policy(dataset), allow_deferral=False)
+        guesses = self._check_names(candidate, filename, batch.policy)
+        sniffed_mimetype = _sniffed_from_prefix(self._sniff_head(batch, summary.head))
+        if sniffed_mimetype is None:
+            return {}
+        sniffed_mimetype, structured = self._sniff_text(
+            candidate, batch.policy, guesses, io.BytesIO(summary.head), sniffed_mimetype, len(summary.head))
+        if structured and summary.size > len(summary.head):
+            # deferred validation checks the structure of more of the text
+            return {}
+        self._validate_types(candidate, filename, sniffed_mimetype, batch, guesses)
+        if not self._check_archive_tail(candidate, filename, sniffed_mimetype, summary.tail,
+                                        summary.size, batch.policy, guesses):
+            return {}
+        return {STATUS_FIELD: STATUS_CONFIRMED, 'mimetype': candidate.get('mimetype')}
+
+    def _rejection_reason(self, errors: 'dict[str, typing.Any]') -> str:
+        messages = errors.get('upload') or errors.get('url')
+        if not messages:
+            return 'other'
+        return self.rejection_reasons.get(messages[0], 'mismatch')
+
+    def _check_names(self, resource: 'dict[str, typing.Any]', filename: str,
+                     policy: TypePolicy) -> _Guesses:
+        """ Run the checks that need only the filename and format,
+        so that a resource that would be rejected whatever its contents
+        is rejected without reading any upload.
+
+        Returns the types indicated by the filename and format.
+        Raises _EarlyRejection, naming the deciding stage, on failure.
+        """
+        with self.metrics.stage(metrics.STAGE_EXTENSION):
+            if not policy.extensions.is_allowed(filename):
+                raise _EarlyRejection(metrics.DECIDED_EXTENSION, {'upload': [self.invalid_upload_message]})
+            extension_policy = policy.extensions.policy_for(filename)
+
+        resource_format: 'str|None' = _cast_to_str(resource.get('format'))
+        with self.metrics.stage(metrics.STAGE_GUESS_TYPE):
+            guesses = _Guesses(policy.file_types.type_for_filename(filename),
+                               policy.file_types.type_for_format(resource_format),
+                               extension_policy)
+        LOG.debug("Upload filename [%s] indicates MIME type %s", filename, guesses.filename_mimetype)
+        LOG.debug("Upload format [%s] indicates MIME type %s", resource_format, guesses.format_mimetype)
+
+        if guesses.filename_mimetype or guesses.format_mimetype:
+            with self.metrics.stage(metrics.STAGE_FORMAT):
+                self._check_format(resource, guesses, policy)
+        return guesses
+
+    def _check_format(self, resource: 'dict[str, typing.Any]', guesses: _Guesses,
+                      policy: TypePolicy) -> None:
+        """ Reject a resource whose filename and format conflict,
+        or that could only be accepted as a disallowed type,
+        unless its contents might still make it acceptable.
+        """
+        filename_mimetype, format_mimetype, _ = guesses
+        is_archive = filename_mimetype in policy.archive_mimetypes
+        may_be_archive = is_archive or policy.may_be_archive(filename_mimetype)
+        # the types that each possible outcome would check against the allow list
+        outcomes: 'list[str|None]' = []
+        if may_be_archive:
+            # archives are allowed to declare any format
+            outcomes.append(format_mimetype or filename_mimetype or _cast_to_str(resource.get('mimetype')))
+        if not is_archive:
+            allow_override = _allow_override(policy, filename_mimetype, format_mimetype)
+            try:
+                candidate = self.coalesce_mime_types(
+                    [filename_mimetype, format_mimetype], allow_override=allow_override, policy=policy)
+            except ValidationError as e:
+                if not may_be_archive:
+                    raise _EarlyRejection(metrics.DECIDED_FORMAT, e.error_dict)
+            else:
+                # more specific contents may override a generic type
+                if allow_override and policy.type_index.is_generic(candidate):
+                    return
+                outcomes.append(candidate)
+
+        if not any(outcome in policy.allowed_mime_type_set for outcome in outcomes):
+            raise _EarlyRejection(metrics.DECIDED_ALLOW_LIST, {'upload': [self.invalid_upload_message]})
+
+    def _validate_stored(self, resource: 'dict[str, typing.Any]', upload_field_storage: typing.Any,
+                         batch: _Batch, guesses: _Guesses) -> None:
+        """ Sanity-check a resource whose file was uploaded earlier.
+        """
+        self._validate_types(resource, str(resource.get('url')), None, batch, guesses)
+
+    def _sniff_head(self, batch: _Batch, head: 'bytes|memoryview') -> str:
+        """ Sniff the type of an upload from its first bytes, 'head',
+        by signature if possible, or else with libmagic.
+        """
+        signatures = batch.policy.signatures
+        if signatures:
+            sniffed_mimetype = signatures.match(head)
+            self.metrics.increment('signature_lookups', {'result': 'hit' if sniffed_mimetype else 'miss'})
+            if sniffed_mimetype:
+                return sniffed_mimetype
+        return batch.sniffer.from_buffer(head)
+
+    def _sniff(self, resource: 'dict[str, typing.Any]', batch: _Batch, guesses: _Guesses,
+               upload_file: 'typing.IO[bytes]', head: 'bytes|memoryview') -> 'tuple[str, bool]':
+        """ Sniff the type of an upload from its first bytes, 'head',
+        checking the structure of text that libmagic is unsure about.
+
+        Returns the sniffed type, and whether more of the file
+        contents were needed to determine it.
+        """
+        bytes_sniffed = len(head)
+        with self.metrics.stage(metrics.STAGE_SNIFF):
+            sniffed_mimetype = self._sniff_head(batch, head)
+            full_content = False
+            # When on old libmagic/file lookup, it needs more than the first
+            # few bytes for type sniffing to be successful.
+            if sniffed_mimetype.startswith(CDFV2_CORRUPT):
+                self.metrics.increment('sniff_fallbacks')
+                bytes_sniffed = min(upload_file.seek(0, os.SEEK_END), self.max_sniff_bytes)
+                upload_file.seek(0, os.SEEK_SET)
+                sniffed_mimetype = batch.sniffer.from_stream(upload_file, self.max_sniff_bytes)
+                full_content = True
+        self.metrics.observe('sniff_bytes', bytes_sniffed)
+        if not full_content:
+            sniffed_mimetype, full_content = self._sniff_text(
+                resource, batch.policy, guesses, upload_file, sniffed_mimetype, self.text_sniff_bytes)
+
+        LOG.debug('Upload sniffing indicates MIME type %s',
+                  sniffed_mimetype)
+        return sniffed_mimetype, full_content
+
+    def _sniff_text(self, resource: 'dict[str, typing.Any]', policy: TypePolicy, guesses: _Guesses,
+                    upload_file: 'typing.IO[bytes]', sniffed_mimetype: str, max_bytes: int) -> 'tuple[str, bool]':
+        """ If libmagic reports text of an uncertain type, eg Fortran
+        source, and the filename, format or claimed type expect a
+        structured text type, eg CSV, then check the structure of up to
+        'max_bytes' of the upload. A confirmed type replaces the sniffed
+        one; otherwise the sniffed type stands.
+
+        Returns the type, and whether the upload was read to find it.
+        """
+        text_types = policy.text_types
+        if not max_bytes or not text_types or sniffed_mimetype not in text_types.uncertain_types:
+            return sniffed_mimetype, False
+        expected_mimetypes = [
+            mime_type for mime_type in (guesses.filename_mimetype, guesses.format_mimetype,
+                                        _cast_to_str(resource.get('mimetype')))
+            if mime_type in text_types.types and mime_type != sniffed_mimetype]
+        if not expected_mimetypes:
+            return sniffed_mimetype, False
+        with self.metrics.stage(metrics.STAGE_TEXT_SNIFF):
+            try:
+                candidates = text_types.classify(upload_file, max_bytes)
+            finally:
+                upload_file.seek(0, os.SEEK_SET)
+        confirmed_mimetype = next(
+            (candidate for candidate in candidates if candidate in expected_mimetypes), None)
+        self.metrics.increment('text_sniffs', {'result': 'confirmed' if confirmed_mimetype else 'unconfirmed'})
+        LOG.debug("Text structure indicates MIME types %s", candidates)
+        return confirmed_mimetype or sniffed_mimetype, True
+
+    def _validate_upload(self, resource: 'dict[str, typing.Any]', upload_field_storage: typing.Any,
+                         batch: _Batch, guesses: _Guesses) -> None:
+        filename: str = upload_field_storage.filename
+        upload_file = _get_underlying_file(upload_field_storage)
+        # a new upload supersedes any deferred validation of the old one
+        resource.pop(STATUS_FIELD, None)
+        resource.pop(ERRORS_FIELD, None)
+        max_size = guesses.extension_policy and guesses.extension_policy.max_size
+        if max_size is not None and _upload_size(upload_file) > max_size:
+            raise _EarlyRejection(metrics.DECIDED_SIZE, {'upload': [self.oversized_upload_message]})
+        with head_view(upload_file) as head:
+            self._validate_content(resource, filename, upload_file, head, batch, guesses)
+
+    def _validate_content(self, resource: 'dict[str, typing.Any]', filename: str, upload_file: 'typing.IO[bytes]',
+                          head: 'bytes|memoryview', batch: _Batch, guesses: _Guesses) -> None:
+        """ Check an upload, starting from its first bytes, 'head'.
+        """
+        if batch.allow_deferral and self._is_deferrable(upload_file):
+            self._validate_prefix(resource, filename, upload_file, head, batch, guesses)
+            return
+        verdict_cache = batch.policy.verdict_cache
+        if not verdict_cache:
+            self._validate_types(resource, filename, self._sniff(resource, batch, guesses, upload_file, head)[0],
+                                 batch, guesses, upload_file)
+            return
+
+        cache_key = _verdict_key(verdict_cache, resource, filename, content_digest(head))
+        full_content_key = None
+        verdict = verdict_cache.get(cache_key)
+        if verdict and verdict.full_content:
+            full_content_key = _verdict_key(verdict_cache, resource, filename, self._full_digest(upload_file))
+            verdict = verdict_cache.get(full_content_key)
+        self.metrics.increment('verdict_cache_lookups', {'result': 'hit' if verdict else 'miss'})
+        if verdict:
+            LOG.debug("Reusing cached verdict for %s: %s", filename, verdict)
+            _apply_verdict(resource, verdict)
+            return
+
+        sniffed_mimetype, full_content = self._sniff(resource, batch, guesses, upload_file, head)
+        if full_content or _is_archive(batch.policy, guesses.filename_mimetype, sniffed_mimetype):
+            # the prefix alone isn't enough to reproduce this verdict
+            if not full_content_key:
+                verdict_cache.set(cache_key, NEEDS_FULL_CONTENT)
+                full_content_key = _verdict_key(verdict_cache, resource, filename, self._full_digest(upload_file))
+            cache_key = full_content_key
+        try:
+            self._validate_types(resource, filename, sniffed_mimetype, batch, guesses, upload_file)
+        except ValidationError as e:
+            verdict_cache.set(cache_key, Verdict(resource.get('mimetype'), e.error_dict))
+            raise
+        verdict_cache.set(cache_key, Verdict(resource.get('mimetype')))
+
+    def _is_deferrable(self, upload_file: 'typing.IO[bytes]') -> bool:
+        if not self.deferred_min_size:
+            return False
+        return _upload_size(upload_file) >= self.deferred_min_size
+
+    def _validate_prefix(self, resource: 'dict[str, typing.Any]', filename: str, upload_file: 'typing.IO[bytes]',
+                         head: 'bytes|memoryview', batch: _Batch, guesses: _Guesses) -> None:
+        """ Check a large upload using only its first bytes, 'head',
+        and mark it as pending deferred validation.
+
+        Types that need more of the file to sniff are left to the
+        deferred check, as is inspection of archive structure.
+        """
+        with self.metrics.stage(metrics.STAGE_SNIFF):
+            sniffed_mimetype: 'str|None' = _sniffed_from_prefix(self._sniff_head(batch, head))
+        self.metrics.observe('sniff_bytes', len(head))
+        if sniffed_mimetype:
+            sniffed_mimetype, _ = self._sniff_text(
+                resource, batch.policy, guesses, upload_file, sniffed_mimetype,
+                min(len(head), self.text_sniff_bytes))
+        LOG.debug("Deferring full validation of %s; prefix sniffing indicates MIME type %s",
+                  filename, sniffed_mimetype)
+        self._validate_types(resource, filename, sniffed_mimetype, batch, guesses)
+        resource[STATUS_FIELD] = STATUS_PENDING
+        self.metrics.increment('deferrals')
+
+    def _full_digest(self, upload_file: 'typing.IO[bytes]') -> str:
+        with content_view(upload_file) as content:
+            if content is not None:
+                return content_digest(content)
+        digest = stream_digest(upload_file)
+        upload_file.seek(0, os.SEEK_SET)
+        return digest
+
+    def _validate_types(self, resource: 'dict[str, typing.Any]', filename: str, sniffed_mimetype: 'str|None',
+                        batch: _Batch, guesses: _Guesses, upload_file: 'typing.IO[bytes]|None' = None,
+                        check_allowed: bool = True) -> None:
+        """ Check that the filename, format, claimed and sniffed types
+        of a resource are compatible, and record the best match.
+        Archive uploads also have their structure checked, and unless
+        'check_allowed' is False, the match must be an allowed type.
+        """
+        filename_mimetype: 'str|None'  # type deduced from file extension
+        format_mimetype: 'str|None'  # type deduced from selected resource format
+        claimed_mimetype: 'str|None'  # type recorded in resource data
+        best_guess_mimetype: 'str|None'  # best type match from coalescing other guesses
+        policy = batch.policy
+        filename_mimetype, format_mimetype, extension_policy = guesses
+
+        if sniffed_mimetype and extension_policy and extension_policy.sniffed_types \
+                and not any(policy.type_index.equals(sniffed_mimetype, required)
+                            for required in extension_policy.sniffed_types):
+            LOG.debug("Sniffed type %s is not one required for %s", sniffed_mimetype, filename)
+            raise ValidationError({'upload': [self.invalid_upload_message]})
 
         claimed_mimetype = _cast_to_str(resource.get('mimetype'))
         LOG.debug("Upload claims to have MIME type %s", claimed_mimetype)
 
-        filename_mimetype = mimetypes.guess_type(
-            filename,
-            strict=False)[0]
-        LOG.debug("Upload filename [%s] indicates MIME type %s", filename, filename_mimetype)
-
         # If we're just sanity-checking, set a dummy sniffed type
         sniffed_mimetype = sniffed_mimetype or claimed_mimetype or filename_mimetype
 
-        resource_format: 'str|None' = _cast_to_str(resource.get('format'))
-        format_mimetype = mimetypes.guess_type(
-            'example.{}'.format(resource_format),
-            strict=False)[0]
-        LOG.debug("Upload format [%s] indicates MIME type %s", resource_format, format_mimetype)
-
         # Archives can declare any format, but only if they're well formed
-        if any(type_candidate in self.archive_mimetypes
-               for type_candidate in (filename_mimetype, sniffed_mimetype)):
-            valid_archive, subtype = self.is_valid_override(
-                filename_mimetype,
-                sniffed_mimetype)
-
-            if valid_archive:
-                # well-formed archives can specify any format they want,
-                # but the file itself is still ZIP
-                best_guess_mimetype = format_mimetype or filename_mimetype or claimed_mimetype
-                resource['mimetype'] = subtype
-            else:
-                raise ValidationError(
-                    {'upload': [
-                        self.mismatching_upload_message.format(
-                            filename_mimetype,
-                            sniffed_mimetype)
-                    ]}
-                )
+        if _is_archive(policy, filename_mimetype, sniffed_mimetype):
+            with self.metrics.stage(metrics.STAGE_ARCHIVE):
+                valid_archive, subtype = policy.type_index.valid_override(
+                    filename_mimetype,
+                    sniffed_mimetype)
+
+                if valid_archive:
+                    if upload_file is not None:
+                        self._inspect_archive(policy, upload_file, filename_mimetype, sniffed_mimetype, subtype)
+                    # well-formed archives can specify any format they want,
+                    # but the file itself is still ZIP
+                    best_guess_mimetype = format_mimetype or filename_mimetype or claimed_mimetype
+                    resource['mimetype'] = subtype
+                else:
+                    raise ValidationError(
+                        {'upload': [
+                            self.mismatching_upload_message.format(
+                                filename_mimetype,
+                                sniffed_mimetype)
+                        ]}
+                    )
         else:
-            # If the file extension or format matches a generic type,
-            # then sniffing should say the same.
-            # This is to prevent attacks based on browser sniffing.
-            allow_override = filename_mimetype not in self.generic_mimetypes\
-                and format_mimetype not in self.generic_mimetypes\
-                or filename_mimetype in self.archive_mimetypes
+            allow_override = _allow_override(policy, filename_mimetype, format_mimetype)
 
             try:
-                coalesced_type: 'str|None' = self.coalesce_mime_types(
-                    [filename_mimetype, format_mimetype, sniffed_mimetype,
-                     claimed_mimetype],
-                    allow_override=allow_override
-                )
+                with self.metrics.stage(metrics.STAGE_COALESCE):
+                    coalesced_type: 'str|None' = self.coalesce_mime_types(
+                        [filename_mimetype, format_mimetype, sniffed_mimetype,
+                         claimed_mimetype],
+                        allow_override=allow_override,
+                        policy=policy
+                    )
                 resource['mimetype'] = coalesced_type
                 best_guess_mimetype = coalesced_type
             except ValidationError as e:
@@ -206,12 +1005,32 @@ class ResourceTypeValidator:
                 raise e
 
         LOG.debug("Best guess at MIME type is %s, content type is %s", best_guess_mimetype, resource['mimetype'])
-        if not self.is_mimetype_allowed(best_guess_mimetype):
+        if not check_allowed:
+            return
+        with self.metrics.stage(metrics.STAGE_ALLOW_LIST):
+            mimetype_allowed = best_guess_mimetype in policy.allowed_mime_type_set
+        if not mimetype_allowed:
             raise ValidationError(
                 {'upload': [self.invalid_upload_message]}
             )
 
-    def coalesce_mime_types(self, mime_types: 'list[str|None]', allow_override: bool = True) -> 'str|None':
+    def _inspect_archive(self, policy: TypePolicy, upload_file: 'typing.IO[bytes]', filename_mimetype: 'str|None',
+                         sniffed_mimetype: 'str|None', subtype: 'str|None') -> None:
+        """ Check that an archive is within size limits, and contains
+        the members expected of its subtype, eg 'word/document.xml'
+        for a DOCX file, without decompressing it.
+        """
+        archive_type = sniffed_mimetype if sniffed_mimetype in policy.archive_mimetypes \
+            else filename_mimetype
+        try:
+            inspect_archive(upload_file, str(archive_type), self.archive_limits,
+                            policy.archive_members.get(subtype or '', []))
+        except ArchiveError as e:
+            LOG.debug("Invalid %s archive of type %s: %s", archive_type, subtype, e)
+            raise ValidationError({'upload': [self.invalid_archive_message]})
+
+    def coalesce_mime_types(self, mime_types: 'list[str|None]', allow_override: bool = True,
+                            policy: 'TypePolicy|None' = None) -> 'str|None':
         """ Compares a list of potential mime types and identifies
         the best candidate, ignoring any that are None.
 
@@ -224,16 +1043,19 @@ class ResourceTypeValidator:
         'application/xml' can override 'text/plain', but 'application/pdf'
         cannot). If False, then all types must exactly match, or
         ValidationError will be thrown.
+
+        'policy' defaults to the current type policy.
         """
+        type_index = (policy or self.policy).type_index
         best_candidate = None
         for mime_type in mime_types:
-            if not mime_type or self.type_equals(mime_type, best_candidate):
+            if not mime_type or type_index.equals(mime_type, best_candidate):
                 continue
             if not best_candidate:
                 best_candidate = mime_type
                 continue
             if allow_override:
-                is_valid, subtype = self.is_valid_override(
+                is_valid, subtype = type_index.valid_override(
                     best_candidate, mime_type)
                 if is_valid:
                     best_candidate = subtype
@@ -251,13 +1073,7 @@ class ResourceTypeValidator:
         """ Checks whether type1 and type2 are to be considered the same
         eg 'text/xml' and 'application/xml' are interchangeable.
         """
-        if type1 == type2:
-            return True
-        for type_list in self.equal_types:
-            if type1 in type_list and type2 in type_list:
-                return True
-        else:
-            return False
+        return self.policy.type_index.equals(type1, type2)
 
     def is_valid_override(self, mime_type1: 'str|None', mime_type2: 'str|None') -> 'tuple[bool, str|None]':
         """ Returns True if one of the two types can be considered a subtype
@@ -266,37 +1082,7 @@ class ResourceTypeValidator:
         If True, then the second return value is the more specific type,
         otherwise it is None.
         """
-        if self.type_equals(mime_type1, mime_type2):
-            return True, mime_type1
-
-        def matches_override_list(mime_type: 'str|None', override_list: 'list[str]'):
-            for override_type in override_list:
-                if override_type == '*'\
-                        or self.type_equals(override_type, mime_type):
-                    return True
-                if mime_type:
-                    override_parts = override_type.split('/', 1)
-                    if len(override_parts) == 2 and override_parts[1] == '*'\
-                            and override_parts[0] == mime_type.split('/')[0]:
-                        return True
-            else:
-                return False
-
-        for generic_type, override_list in six.iteritems(
-                self.allowed_overrides
-        ):
-            if self.type_equals(generic_type, mime_type1)\
-                    and matches_override_list(mime_type2, override_list):
-                return True, mime_type2
-            if self.type_equals(generic_type, mime_type2)\
-                    and matches_override_list(mime_type1, override_list):
-                return True, mime_type1
-        else:
-            return False, None
+        return self.policy.type_index.valid_override(mime_type1, mime_type2)
 
     def is_mimetype_allowed(self, mime_type: 'str|None') -> bool:
-        for allowed_mime_type in self.allowed_mime_types:
-            if allowed_mime_type == '*'\
-                    or self.type_equals(allowed_mime_type, mime_type):
-                return True
-        return False
+        return mime_type in self.policy.allowed_mime_type_set
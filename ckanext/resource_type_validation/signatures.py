@@ -0,0 +1,50 @@
+# encoding: utf-8
+""" Recognition of common file types from fixed leading bytes,
+ahead of libmagic.
+
+Only formats whose leading bytes alone decide libmagic's answer belong
+here; anything else, eg ZIP-based documents or CSV, must be left for
+libmagic, so that a match never disagrees with it.
+"""
+
+
+class SignatureTable:
+    """ Leading-byte signatures from a types file, each given as a
+    string of Latin-1 characters, ie with \\u00XX escapes for bytes
+    that aren't printable ASCII, eg
+
+        {"image/png": ["\\u0089PNG\\r\\n\\u001a\\n\\u0000\\u0000\\u0000\\rIHDR"]}
+    """
+
+    def __init__(self, signatures: 'dict[str, list[str]]'):
+        # signatures by first byte, longest first
+        self._by_first_byte: 'dict[int, list[tuple[bytes, str]]]' = {}
+        for mime_type, prefixes in signatures.items():
+            for prefix in prefixes:
+                signature = prefix.encode('latin-1')
+                if not signature:
+                    raise ValueError("Empty signature for {}".format(mime_type))
+                self._by_first_byte.setdefault(signature[0], []).append((signature, mime_type))
+        for candidates in self._by_first_byte.values():
+            candidates.sort(key=lambda candidate: len(candidate[0]), reverse=True)
+        self._max_length = max((len(signature) for candidates in self._by_first_byte.values()
+                                for signature, _ in candidates), default=0)
+
+    def __bool__(self) -> bool:
+        return bool(self._by_first_byte)
+
+    def match(self, head: 'bytes|memoryview') -> 'str|None':
+        """ Returns the type identified by the start of 'head', if any.
+        A head no longer than the signature is left to libmagic,
+        which wants at least one more byte to be sure.
+        """
+        if not head:
+            return None
+        candidates = self._by_first_byte.get(head[0])
+        if not candidates:
+            return None
+        start = bytes(head[:self._max_length + 1])
+        for signature, mime_type in candidates:
+            if len(start) > len(signature) and start.startswith(signature):
+                return mime_type
+        return None
@@ -0,0 +1,303 @@
+# encoding: utf-8
+""" Content sniffing via a bounded pool of reusable libmagic handles.
+
+Loading the compiled magic database is far more expensive than sniffing
+a small buffer, so handles are created lazily and then reused across
+requests rather than being rebuilt for every upload.
+
+Uploads held in memory are sniffed in place rather than from a copy, and
+uploads in regular files are sniffed by descriptor or mapped into memory
+when more than their first few bytes are needed.
+"""
+
+import abc
+from contextlib import contextmanager
+import ctypes
+import io
+from logging import getLogger
+import magic
+import mmap
+import os
+import stat
+import tempfile
+import threading
+import typing
+import weakref
+
+LOG = getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_MAX_SNIFF_BYTES = 16 * 1024 * 1024
+# needs to be at least 2048 bytes to recognise DOCX properly
+HEAD_SIZE = 2048
+FIRST_SNIFF_WINDOW = 64 * 1024
+SNIFF_WINDOW_GROWTH = 4
+
+# Older libmagic reports this when the OLE directory lies beyond the buffer
+CDFV2_CORRUPT = 'Composite Document File V2 Document, corrupt'
+
+_pools: 'weakref.WeakSet[MagicPool]' = weakref.WeakSet()
+
+
+def _reset_pools_after_fork() -> None:
+    """ Discard any handles and locks inherited from the parent process.
+    Another thread may have been holding them at the time of the fork.
+    """
+    for pool in list(_pools):
+        pool.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
+
+def libmagic_version() -> 'int|None':
+    """ Returns the version of the loaded libmagic library, if known.
+    """
+    try:
+        return int(magic.version())
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+def _unspooled(stream: typing.Any) -> typing.Any:
+    """ Returns the buffer or file currently behind a spooled temporary
+    file, as used by Werkzeug for uploads. Asking the spooled file itself
+    for a descriptor would first copy an in-memory upload to disk.
+    """
+    if isinstance(stream, tempfile.SpooledTemporaryFile):
+        # '_file' is private, but present from Python 3.6 to 3.13 at least;
+        # without it, the spooled file is used as it is
+        return typing.cast(typing.Any, getattr(stream, '_file', stream))
+    return stream
+
+
+def _regular_file_descriptor(stream: typing.Any) -> 'int|None':
+    """ Returns the OS file descriptor behind 'stream',
+    if it is backed by a regular file.
+    """
+    try:
+        fd = _unspooled(stream).fileno()
+        return fd if stat.S_ISREG(os.fstat(fd).st_mode) else None
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+@contextmanager
+def content_view(stream: typing.Any) -> 'typing.Iterator[memoryview|None]':
+    """ A view of the whole contents of 'stream' that does not copy them,
+    or None if there is no such view and the stream must be read.
+
+    In-memory streams expose their own buffer, and regular files are
+    mapped copy-on-write, so that their pages are shared with the page
+    cache and the view can be handed to libmagic. The file must not be
+    truncated while mapped, which uploads in temporary files never are.
+    """
+    stream = _unspooled(stream)
+    mapped = None
+    view = None
+    if isinstance(stream, io.BytesIO):
+        view = stream.getbuffer()
+    else:
+        fd = _regular_file_descriptor(stream)
+        if fd is not None:
+            # make any buffered writes visible to the mapping
+            stream.flush()
+        if fd is not None and os.fstat(fd).st_size:
+            try:
+                mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_COPY)
+                view = memoryview(mapped)
+            except (OSError, ValueError) as e:
+                LOG.debug("Unable to map upload, reading it instead: %s", e)
+    try:
+        yield view
+    finally:
+        _release(view, mapped)
+
+
+def _release(view: 'memoryview|None', mapped: 'mmap.mmap|None') -> None:
+    # anything still holding part of the view keeps it alive until collected
+    try:
+        if view is not None:
+            view.release()
+        if mapped is not None:
+            mapped.close()
+    except BufferError:
+        pass
+
+
+@contextmanager
+def head_view(stream: 'typing.IO[bytes]', size: int = HEAD_SIZE) -> 'typing.Iterator[memoryview|bytes]':
+    """ The first 'size' bytes of 'stream'. Uploads held in memory are
+    viewed in place; others are read, and the stream rewound, since
+    mapping a file costs more than reading its first few kilobytes.
+    """
+    if isinstance(_unspooled(stream), io.BytesIO):
+        with content_view(stream) as view:
+            assert view is not None
+            head = view[:size]
+            try:
+                yield head
+            finally:
+                _release(head, None)
+        return
+    head = stream.read(size)
+    stream.seek(0, os.SEEK_SET)
+    yield head
+
+
+def _c_buffer(buffer: 'bytes|memoryview') -> typing.Any:
+    """ Returns 'buffer' in a form that libmagic can read in place.
+    """
+    if isinstance(buffer, bytes) or buffer.readonly:
+        return bytes(buffer)
+    return (ctypes.c_char * buffer.nbytes).from_buffer(buffer)
+
+
+class Sniffer(abc.ABC):
+    """ Content sniffing with libmagic handles supplied by 'handle()'.
+    """
+
+    @abc.abstractmethod
+    def handle(self) -> 'typing.ContextManager[magic.Magic]':
+        """ Supply a libmagic handle for the duration of a sniff.
+        """
+
+    def from_buffer(self, buffer: 'bytes|memoryview') -> str:
+        """ Identify the MIME type of 'buffer'.
+        """
+        c_buffer = _c_buffer(buffer)
+        try:
+            with self.handle() as mime:
+                return mime.from_buffer(c_buffer)
+        finally:
+            # don't let a traceback hold the view open
+            del c_buffer
+
+    def from_descriptor(self, fd: int) -> str:
+        """ Identify the MIME type of the file open as 'fd', starting
+        from the beginning of the file. libmagic reads what it needs
+        directly, so the file is never loaded into Python memory.
+        """
+        position = os.lseek(fd, 0, os.SEEK_CUR)
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            with self.handle() as mime:
+                return mime.from_descriptor(fd)
+        finally:
+            os.lseek(fd, position, os.SEEK_SET)
+
+    def from_stream(self, stream: 'typing.IO[bytes]', max_bytes: int = DEFAULT_MAX_SNIFF_BYTES) -> str:
+        """ Identify the MIME type of a stream whose first few bytes
+        were not enough, with bounded memory use.
+
+        Streams backed by a regular file are sniffed by descriptor.
+        Others are sniffed from successively larger windows from the
+        start of the stream, up to 'max_bytes', until libmagic no longer
+        reports a truncated document.
+
+        The stream is left positioned at its start.
+        """
+        fd = _regular_file_descriptor(stream)
+        if fd is not None:
+            sniffed_mimetype = self.from_descriptor(fd)
+        else:
+            with content_view(stream) as view:
+                sniffed_mimetype = self._from_windows(stream, max_bytes, view)
+        stream.seek(0, os.SEEK_SET)
+        return sniffed_mimetype
+
+    def _from_windows(self, stream: 'typing.IO[bytes]', max_bytes: int, view: 'memoryview|None') -> str:
+        window = FIRST_SNIFF_WINDOW
+        while True:
+            window = min(window, max_bytes)
+            if view is not None:
+                buffer: 'bytes|memoryview' = view[:window]
+            else:
+                stream.seek(0, os.SEEK_SET)
+                buffer = stream.read(window)
+            sniffed_mimetype = self.from_buffer(buffer)
+            if not sniffed_mimetype.startswith(CDFV2_CORRUPT) \
+                    or len(buffer) < window or window >= max_bytes:
+                break
+            window *= SNIFF_WINDOW_GROWTH
+        LOG.debug("Sniffed %s bytes of stream as %s", len(buffer), sniffed_mimetype)
+        return sniffed_mimetype
+
+
+class MagicPool(Sniffer):
+    """ Thread-safe pool of at most 'size' libmagic handles.
+
+    Each handle is used by only one thread at a time, so up to 'size'
+    threads can sniff concurrently; any others wait for a free handle.
+    The pool is emptied in child processes after a fork, and new
+    handles are created there on demand.
+    """
+
+    def __init__(self, size: int = DEFAULT_POOL_SIZE,
+                 factory: 'typing.Callable[[], magic.Magic]|None' = None):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1, not {}".format(size))
+        self.size = size
+        self.factory = factory or (lambda: magic.Magic(mime=True))
+        self.reset()
+        _pools.add(self)
+
+    def reset(self) -> None:
+        """ Forget all handles, eg those inherited from a parent process.
+        """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._idle: 'list[magic.Magic]' = []
+        self.created = 0
+
+    @contextmanager
+    def handle(self) -> 'typing.Iterator[magic.Magic]':
+        """ Borrow a handle from the pool, creating it if necessary.
+        """
+        if self._pid != os.getpid():
+            # os.register_at_fork is unavailable on this platform
+            self.reset()
+        slots = self._slots
+        slots.acquire()
+        try:
+            with self._lock:
+                mime = self._idle.pop() if self._idle else None
+            if mime is None:
+                mime = self.factory()
+                with self._lock:
+                    self.created += 1
+                LOG.debug("Created libmagic handle %s of %s in process %s",
+                          self.created, self.size, self._pid)
+            try:
+                yield mime
+            finally:
+                # don't return handles to a pool that was reset underneath us
+                if slots is self._slots:
+                    with self._lock:
+                        self._idle.append(mime)
+        finally:
+            slots.release()
+
+    @contextmanager
+    def lease(self) -> 'typing.Iterator[LeasedSniffer]':
+        """ Hold a single handle for a series of sniffs,
+        eg over a batch of uploads, rather than returning it to
+        the pool after each one.
+        """
+        with self.handle() as mime:
+            yield LeasedSniffer(mime)
+
+
+class LeasedSniffer(Sniffer):
+    """ Sniffs with one handle, borrowed from a pool for its lifetime.
+    Like the handle, it must only be used by one thread at a time.
+    """
+
+    def __init__(self, mime: 'magic.Magic'):
+        self.mime = mime
+
+    @contextmanager
+    def handle(self) -> 'typing.Iterator[magic.Magic]':
+        yield self.mime
@@ -0,0 +1,106 @@
+# encoding: utf-8
+""" Gathering facts about an upload as CKAN stores it, rather than in
+passes of our own.
+
+Validation only needs the first bytes of most uploads, but a digest, an
+archive's central directory or a check for binary content hidden behind
+a text header need all of it. A TeeStream stands in for the upload's
+stream, so that CKAN's uploader, reading the upload to write it to
+storage, feeds each chunk through a SHA-256 digest, a count of bytes,
+a window of the first and last bytes, and a search for NUL bytes along
+the way.
+
+The results are only trusted if the reads covered the whole upload,
+in order; reads that overlap ones already seen, eg a second pass after
+seeking back to the start, are skipped.
+"""
+
+import hashlib
+import os
+import typing
+
+from .chunked import ARCHIVE_TAIL_SIZE
+from .sniffer import HEAD_SIZE
+
+
+class TeeSummary(typing.NamedTuple):
+    """ What a complete pass over an upload revealed.
+    """
+    sha256: str
+    size: int
+    head: bytes
+    tail: bytes
+    # offset of the first NUL byte, which text shouldn't contain
+    first_null: 'int|None'
+
+
+class TeeStream:
+    """ Wraps a binary stream, passing through everything but reads,
+    which are also fed to a running digest and statistics.
+    """
+
+    def __init__(self, stream: 'typing.IO[bytes]', head_size: int = HEAD_SIZE,
+                 tail_size: int = ARCHIVE_TAIL_SIZE):
+        self._stream = stream
+        self._head_size = head_size
+        self._tail_size = tail_size
+        self._digest = hashlib.sha256()
+        self._seen = 0
+        self._head = b''
+        self._tail = b''
+        self._first_null: 'int|None' = None
+        self._complete = False
+        self._broken = False
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self._stream, name)
+
+    def __iter__(self) -> 'typing.Iterator[bytes]':
+        # lines read this way aren't seen, so leave a gap if they're needed
+        return iter(self._stream)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._stream.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._stream.tell()
+
+    def read(self, size: 'int|None' = -1) -> bytes:
+        position = self._stream.tell()
+        data = self._stream.read(-1 if size is None else size)
+        self._feed(position, data, size is None or size < 0)
+        return data
+
+    def _feed(self, position: int, data: bytes, to_end: bool) -> None:
+        if self._broken:
+            return
+        if position > self._seen:
+            # bytes were skipped, so the digest can never cover them
+            self._broken = True
+            return
+        if not data:
+            self._complete = self._complete or position == self._seen
+            return
+        new = data[self._seen - position:]
+        if new:
+            self._update(new)
+        if to_end:
+            self._complete = True
+
+    def _update(self, data: bytes) -> None:
+        self._digest.update(data)
+        if len(self._head) < self._head_size:
+            self._head += data[:self._head_size - len(self._head)]
+        self._tail = (self._tail + data[-self._tail_size:])[-self._tail_size:]
+        if self._first_null is None:
+            null = data.find(b'\x00')
+            if null >= 0:
+                self._first_null = self._seen + null
+        self._seen += len(data)
+
+    def summary(self) -> 'TeeSummary|None':
+        """ Returns what was gathered, if the whole upload was read.
+        """
+        if self._broken or not self._complete:
+            return None
+        return TeeSummary(self._digest.hexdigest(), self._seen, self._head, self._tail, self._first_null)
@@ -0,0 +1,155 @@
+# encoding: utf-8
+
+'''Tests for structural inspection of archives.
+'''
+
+import io
+import os
+import tarfile
+import unittest
+import zipfile
+
+if __name__ == '__main__':
+    from archive import ArchiveError, ArchiveLimits, inspect_archive
+else:
+    from .archive import ArchiveError, ArchiveLimits, inspect_archive
+
+
+def _zip(members, compression=zipfile.ZIP_DEFLATED, prefix=b''):
+    stream = io.BytesIO()
+    stream.write(prefix)
+    with zipfile.ZipFile(stream, 'w', compression) as archive:
+        for name, content in members:
+            archive.writestr(name, content)
+    stream.seek(0)
+    return stream
+
+
+def _tar(members):
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w') as archive:
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    stream.seek(0)
+    return stream
+
+
+class UnreadableMembers(io.BytesIO):
+    """ Fails if anything but archive metadata is read.
+    """
+
+    def __init__(self, content, data_start, data_end):
+        super().__init__(content)
+        self.data_start = data_start
+        self.data_end = data_end
+
+    def read(self, size=-1):
+        position = self.tell()
+        if size < 0 or (position < self.data_end and position + size > self.data_start):
+            raise AssertionError("Read member data at {}".format(position))
+        return super().read(size)
+
+
+class TestArchiveInspection(unittest.TestCase):
+    """ Test that archives are checked using only their metadata.
+    """
+
+    def test_sample_archives(self):
+        """ Test that the sample archives have the members of their types.
+        """
+        for filename, required_members, entries in (
+                ('example.zip', [], 1),
+                ('example.kmz', ['*.kml'], 6),
+                ('zoning.gdb', ['*.gdbtable'], 65),
+                ('example.docx', ['[[]Content_Types].xml', 'word/document.xml'], 24)):
+            with open("test/resources/" + filename, "rb") as sample_file:
+                summary = inspect_archive(sample_file, 'application/zip',
+                                          ArchiveLimits(), required_members)
+                self.assertEqual(summary.entries, entries)
+                self.assertEqual(sample_file.tell(), 0)
+
+    def test_missing_members(self):
+        """ Test that an archive must contain every required member.
+        """
+        with open("test/resources/example.zip", "rb") as sample_file:
+            self.assertRaises(ArchiveError, inspect_archive, sample_file,
+                              'application/zip', ArchiveLimits(), ['word/document.xml'])
+        stream = _zip([('[Content_Types].xml', '<Types/>'), ('xl/workbook.xml', '<workbook/>')])
+        inspect_archive(stream, 'application/zip', ArchiveLimits(),
+                        ['[[]Content_Types].xml', 'xl/workbook.xml'])
+        self.assertRaises(ArchiveError, inspect_archive, stream, 'application/zip',
+                          ArchiveLimits(), ['[[]Content_Types].xml', 'word/document.xml'])
+
+    def test_member_data_not_read(self):
+        """ Test that member data is not read, apart from the final
+        64 KiB that may hold the end of central directory record.
+        """
+        content = _zip([('big.bin', os.urandom(1000000))], zipfile.ZIP_STORED).getvalue()
+        # member data follows the 30-byte local header and name
+        stream = UnreadableMembers(content, 30 + len('big.bin'), len(content) - 22 - 0xFFFF)
+        summary = inspect_archive(stream, 'application/zip', ArchiveLimits(), ['*.bin'])
+        self.assertEqual(summary.uncompressed_size, 1000000)
+
+    def test_prepended_data(self):
+        """ Test that data before the archive, eg a self-extractor stub,
+        does not prevent the central directory being found.
+        """
+        stream = _zip([('doc.kml', '<kml/>')], prefix=b'#!/bin/sh\n' * 100)
+        summary = inspect_archive(stream, 'application/zip', ArchiveLimits(), ['*.kml'])
+        self.assertEqual(summary.entries, 1)
+
+    def test_compression_ratio(self):
+        """ Test that highly compressed archives are rejected.
+        """
+        stream = _zip([('zeros.csv', b'\0' * 10000000)])
+        self.assertRaises(ArchiveError, inspect_archive, stream,
+                          'application/zip', ArchiveLimits(), [])
+        inspect_archive(stream, 'application/zip', ArchiveLimits(max_ratio=100000), [])
+
+    def test_entry_and_size_limits(self):
+        """ Test that too many entries, or too much uncompressed content,
+        are rejected.
+        """
+        stream = _zip([('{}.txt'.format(i), 'x' * 100) for i in range(11)],
+                      compression=zipfile.ZIP_STORED)
+        inspect_archive(stream, 'application/zip', ArchiveLimits(max_entries=11), [])
+        self.assertRaises(ArchiveError, inspect_archive, stream,
+                          'application/zip', ArchiveLimits(max_entries=10), [])
+        self.assertRaises(ArchiveError, inspect_archive, stream,
+                          'application/zip', ArchiveLimits(max_size=1000), [])
+
+    def test_malformed_zip(self):
+        """ Test that non-archives and truncated archives are rejected.
+        """
+        with open("test/resources/dummy.pdf", "rb") as sample_file:
+            self.assertRaises(ArchiveError, inspect_archive, sample_file,
+                              'application/zip', ArchiveLimits(), [])
+        content = _zip([('a.txt', 'a'), ('b.txt', 'b')]).getvalue()
+        directory_start = content.index(b'PK\x01\x02')
+        truncated = content[:directory_start + 10] + content[content.index(b'PK\x05\x06'):]
+        self.assertRaises(ArchiveError, inspect_archive, io.BytesIO(truncated),
+                          'application/zip', ArchiveLimits(), [])
+
+    def test_tar(self):
+        """ Test that tar member headers are checked in the same way.
+        """
+        stream = _tar([('zoning.gdb/a00000001.gdbtable', b'x' * 1000),
+                       ('zoning.gdb/a00000001.gdbtablx', b'y' * 1000)])
+        summary = inspect_archive(stream, 'application/x-tar', ArchiveLimits(), ['*.gdbtable'])
+        self.assertEqual(summary.entries, 2)
+        self.assertRaises(ArchiveError, inspect_archive, stream,
+                          'application/x-tar', ArchiveLimits(), ['*.kml'])
+        self.assertRaises(ArchiveError, inspect_archive, stream,
+                          'application/x-tar', ArchiveLimits(max_entries=1), [])
+
+    def test_unknown_archive_type(self):
+        """ Test that archives with no inspector are passed over.
+        """
+        self.assertIsNone(inspect_archive(io.BytesIO(b''), 'application/x-7z-compressed',
+                                          ArchiveLimits(), []))
+
+
+if __name__ == '__main__':
+    unittest.main()
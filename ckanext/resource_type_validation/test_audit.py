@@ -0,0 +1,110 @@
+# encoding: utf-8
+
+'''Tests for the offline audit of uploaded resources.
+'''
+
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+if __name__ == '__main__':
+    from audit import AuditRecord, Checkpoint, ReportWriter, run_audit
+else:
+    from .audit import AuditRecord, Checkpoint, ReportWriter, run_audit
+
+CONFIG = {'ckan.site_url': 'http://ckan:5000/'}
+
+SAMPLES = [
+    # id, sample file, format, stored mimetype
+    ('01', 'dummy.pdf', 'PDF', 'application/pdf'),
+    ('02', 'example.xls', 'XLS', 'application/vnd.ms-excel'),
+    ('03', 'foo.csv', 'CSV', 'text/plain'),
+    ('04', 'example.txt', 'PDF', 'text/plain'),
+    ('05', 'missing.csv', 'CSV', 'text/csv'),
+]
+
+
+class TestAudit(unittest.TestCase):
+    """ Test re-validation of stored uploads.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.records = [
+            AuditRecord(id, os.path.join("test/resources", filename),
+                        filename, resource_format, mimetype)
+            for id, filename, resource_format, mimetype in SAMPLES]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _audit(self, pages, report_format='jsonl', checkpoint_path=None, **kwargs):
+        report = io.StringIO()
+        counts = run_audit(pages, CONFIG, ReportWriter(report, report_format),
+                           Checkpoint(checkpoint_path), **kwargs)
+        return counts, report.getvalue()
+
+    def test_statuses(self):
+        """ Test that each kind of outcome is detected and reported.
+        """
+        counts, report = self._audit([self.records], include_all=True)
+        self.assertEqual(counts, {'ok': 2, 'mismatch': 1, 'rejected': 1, 'missing': 1})
+        results = {result['id']: result for result in map(json.loads, report.splitlines())}
+        self.assertEqual(results['03']['status'], 'mismatch')
+        self.assertEqual(results['03']['proposed_mimetype'], 'text/csv')
+        self.assertEqual(results['04']['status'], 'rejected')
+        self.assertIn('upload', results['04']['errors'])
+        self.assertEqual(results['05']['status'], 'missing')
+        self.assertNotIn('path', results['01'])
+
+    def test_worker_processes(self):
+        """ Test that a process pool gives the same outcome,
+        and that only problems are reported by default.
+        """
+        inline_counts, inline_report = self._audit([self.records[:3], self.records[3:]])
+        pool_counts, pool_report = self._audit([self.records[:3], self.records[3:]], workers=2)
+        self.assertEqual(pool_counts, inline_counts)
+        self.assertEqual(pool_report, inline_report)
+        self.assertEqual([json.loads(line)['id'] for line in pool_report.splitlines()],
+                         ['03', '04', '05'])
+
+    def test_csv_report(self):
+        """ Test that CSV reports have a single header row.
+        """
+        report_path = os.path.join(self.temp_dir, 'report.csv')
+        for page in ([self.records[:3]], [self.records[3:]]):
+            with open(report_path, 'a', newline='') as report:
+                run_audit(page, CONFIG, ReportWriter(report, 'csv'), Checkpoint(None))
+        with open(report_path, newline='') as report:
+            rows = list(csv.DictReader(report))
+        self.assertEqual([row['id'] for row in rows], ['03', '04', '05'])
+        self.assertIn('upload', json.loads(rows[1]['errors']))
+
+    def test_resume_from_checkpoint(self):
+        """ Test that an interrupted audit resumes after the last
+        completed page, keeping the running totals.
+        """
+        checkpoint_path = os.path.join(self.temp_dir, 'audit.checkpoint')
+
+        def interrupted_pages():
+            yield self.records[:2]
+            raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, self._audit,
+                          interrupted_pages(), checkpoint_path=checkpoint_path)
+        checkpoint = Checkpoint(checkpoint_path)
+        self.assertEqual(checkpoint.last_id, '02')
+        self.assertEqual(checkpoint.counts, {'ok': 2})
+
+        remaining = [record for record in self.records if record.id > checkpoint.last_id]
+        counts, report = self._audit([remaining], checkpoint_path=checkpoint_path)
+        self.assertEqual(counts, {'ok': 2, 'mismatch': 1, 'rejected': 1, 'missing': 1})
+        self.assertEqual(Checkpoint(checkpoint_path).last_id, '05')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# encoding: utf-8
+
+'''Tests for validating uploads as their chunks arrive.
+'''
+
+import hashlib
+import io
+import unittest
+import zipfile
+
+if __name__ == '__main__':
+    from chunked import ChunkedUpload
+    from deferred import STATUS_FIELD, STATUS_PENDING
+    from resource_type_validation import ResourceTypeValidator
+    from testing import sample
+else:
+    from .chunked import ChunkedUpload
+    from .deferred import STATUS_FIELD, STATUS_PENDING
+    from .resource_type_validation import ResourceTypeValidator
+    from .testing import sample
+
+from ckan.logic import ValidationError
+
+
+def _chunks(content, size):
+    return [content[offset:offset + size] for offset in range(0, len(content), size)]
+
+
+class TestChunkedUpload(unittest.TestCase):
+    '''Test the state kept between chunks.'''
+
+    def test_state(self):
+        upload = ChunkedUpload('example.csv')
+        for chunk in (b'a,b\n', b'\x00\xff' * 2000):
+            upload = ChunkedUpload.from_json(upload.add(chunk, upload.received).to_json())
+        self.assertEqual(upload.received, 4004)
+        self.assertEqual(upload.head, (b'a,b\n' + b'\x00\xff' * 2000)[:2048])
+        self.assertEqual(upload.chained_digest, hashlib.sha256(
+            hashlib.sha256(hashlib.sha256(b'a,b\n').digest()).digest()
+            + hashlib.sha256(b'\x00\xff' * 2000).digest()).hexdigest())
+        # unlike a digest of the content, it depends on the chunks
+        self.assertNotEqual(upload.chained_digest, hashlib.sha256(b'a,b\n' + b'\x00\xff' * 2000).hexdigest())
+        self.assertNotEqual(upload.chained_digest,
+                            ChunkedUpload('example.csv').add(b'a,b\n' + b'\x00\xff' * 2000).chained_digest)
+        self.assertRaises(ValueError, upload.add, b'x', 4000)
+
+        upload = upload.sniffed('text/csv', False)
+        self.assertEqual((upload.head, upload.tail), (b'', b''))
+        self.assertEqual(upload.add(b'more').tail, b'')
+
+
+class TestChunkedValidation(unittest.TestCase):
+    '''Test that chunked uploads are rejected as soon as possible.'''
+
+    def setUp(self):
+        self.validator = ResourceTypeValidator({'ckan.site_url': 'http://ckan:5000/'})
+
+    def _upload(self, resource, filename, content, chunk_size=1000):
+        upload = self.validator.start_chunked_upload(resource, filename)
+        for chunk in _chunks(content, chunk_size):
+            upload = self.validator.validate_chunk(resource, upload, chunk, upload.received)
+            upload = ChunkedUpload.from_json(upload.to_json())
+        self.validator.finish_chunked_upload(resource, upload)
+        return resource
+
+    def test_accepted(self):
+        resource = self._upload({'format': 'CSV'}, 'example.csv', b'id,name\n' + b'1,example\n' * 1000)
+        self.assertEqual(resource['mimetype'], 'text/csv')
+        self.assertNotIn(STATUS_FIELD, resource)
+        # small uploads are sniffed once complete
+        resource = self._upload({'format': 'CSV'}, 'fortran-bug.csv', sample('fortran-bug.csv'), 10)
+        self.assertEqual(resource['mimetype'], 'text/csv')
+
+    def test_rejected_after_first_chunk(self):
+        resource = {'format': 'CSV'}
+        self.assertRaises(ValidationError, self.validator.start_chunked_upload, resource, 'example.exe')
+        upload = self.validator.start_chunked_upload(resource, 'example.csv')
+        self.assertRaises(ValidationError, self.validator.validate_chunk, resource, upload, sample('dummy.pdf'))
+
+    def test_archive_checked_from_tail(self):
+        resource = self._upload({'format': 'DOCX'}, 'example.docx', sample('example.docx'))
+        self.assertEqual(resource['mimetype'],
+                         'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+        self.assertNotIn(STATUS_FIELD, resource)
+        self.assertRaises(ValidationError, self._upload, {'format': 'DOCX'}, 'example.docx', sample('example.zip'))
+
+    def test_large_archive_directory_deferred(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            for i in range(500):
+                zip_file.writestr('data/{}/{}.csv'.format('x' * 50, i), 'id,name\n')
+        resource = self._upload({'format': 'ZIP'}, 'example.zip', archive.getvalue(), 4096)
+        self.assertEqual(resource['mimetype'], 'application/zip')
+        self.assertEqual(resource[STATUS_FIELD], STATUS_PENDING)
+
+
+if __name__ == '__main__':
+    unittest.main()
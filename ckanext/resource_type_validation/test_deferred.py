@@ -0,0 +1,156 @@
+# encoding: utf-8
+
+'''Tests for deferred validation of large uploads.
+'''
+
+import unittest
+
+if __name__ == '__main__':
+    from deferred import ERRORS_FIELD, JOB_CONTEXT, STATUS_FIELD, \
+        complete_validation, validate_deferred_upload
+    from plugin import ResourceTypeValidationPlugin
+    from sniffer import CDFV2_CORRUPT
+    from testing import sample, upload_resource
+else:
+    from .deferred import ERRORS_FIELD, JOB_CONTEXT, STATUS_FIELD, \
+        complete_validation, validate_deferred_upload
+    from .plugin import ResourceTypeValidationPlugin
+    from .sniffer import CDFV2_CORRUPT
+    from .testing import sample, upload_resource
+
+from ckan.logic import ValidationError
+
+CONFIG = {
+    'ckan.site_url': 'http://ckan:5000/',
+    'ckanext.resource_validation.deferred_min_size': '10000',
+    'ckanext.resource_validation.deferred_queue': 'bulk',
+}
+
+
+class PrefixOnlySniffer:
+    """ Sniffer that cannot be asked to read past the prefix.
+    """
+
+    def __init__(self, sniffed_mimetype):
+        self.sniffed_mimetype = sniffed_mimetype
+
+    def from_buffer(self, buffer):
+        assert len(buffer) <= 2048
+        return self.sniffed_mimetype
+
+    def from_stream(self, stream, max_bytes):
+        raise AssertionError("Deferred uploads must not be read in full")
+
+
+def _sample_resource(filename, url, resource_format):
+    return upload_resource(url, sample(filename), resource_format)
+
+
+class TestDeferredValidation(unittest.TestCase):
+    """ Test the split between request-time and background checks.
+    """
+
+    def setUp(self):
+        self.plugin = ResourceTypeValidationPlugin()
+        self.plugin.configure(CONFIG)
+        self.validator = self.plugin.validator
+        self.jobs = []
+        self.plugin.enqueue_job = lambda *args, **kwargs: self.jobs.append((args, kwargs))
+
+    def test_defer_large_uploads(self):
+        """ Test that a large upload is checked only from its prefix,
+        and marked as pending.
+        """
+        self.validator.sniffer = PrefixOnlySniffer(CDFV2_CORRUPT)
+        resource = _sample_resource('example.xls', 'example.xls', 'XLS')
+        self.validator.validate_resource_mimetype(resource)
+        self.assertEqual(resource[STATUS_FIELD], 'pending')
+        self.assertEqual(resource['mimetype'], 'application/vnd.ms-excel')
+
+    def test_prefix_checks_still_apply(self):
+        """ Test that mismatches visible from the prefix are rejected
+        straight away.
+        """
+        resource = _sample_resource('example.xls', 'example.pdf', 'PDF')
+        self.assertRaises(ValidationError, self.validator.validate_resource_mimetype, resource)
+        self.assertNotIn(STATUS_FIELD, resource)
+
+    def test_small_uploads_inline(self):
+        """ Test that small uploads are validated in full, and that any
+        earlier deferred outcome is discarded.
+        """
+        resource = _sample_resource('foo.csv', 'foo.csv', 'CSV')
+        resource[STATUS_FIELD] = 'quarantined'
+        resource[ERRORS_FIELD] = '{}'
+        self.validator.validate_resource_mimetype(resource)
+        self.assertEqual(resource['mimetype'], 'text/csv')
+        self.assertNotIn(STATUS_FIELD, resource)
+        self.assertNotIn(ERRORS_FIELD, resource)
+
+    def test_confirm(self):
+        """ Test that the deferred check replaces the provisional type.
+        """
+        resource = {'id': 'abc', 'url': 'http://ckan:5000/dataset/x/resource/abc/download/dummy.pdf',
+                    'format': 'PDF', 'mimetype': 'text/plain', STATUS_FIELD: 'pending'}
+        self.assertEqual(complete_validation(self.validator, resource, "test/resources/dummy.pdf"),
+                         {STATUS_FIELD: 'confirmed', 'mimetype': 'application/pdf'})
+
+    def test_quarantine_archive(self):
+        """ Test that archive structure is checked only in the
+        deferred stage, and quarantines an invalid archive.
+        """
+        resource = _sample_resource('example.zip', 'example.docx', 'DOCX')
+        self.validator.validate_resource_mimetype(resource)
+        self.assertEqual(resource[STATUS_FIELD], 'pending')
+
+        resource['id'] = 'abc'
+        changes = complete_validation(self.validator, resource, "test/resources/example.zip")
+        self.assertEqual(changes[STATUS_FIELD], 'quarantined')
+        self.assertIn('upload', changes[ERRORS_FIELD])
+        self.assertNotIn('mimetype', changes)
+
+    def test_quarantine_missing_file(self):
+        changes = complete_validation(self.validator, {'id': 'abc', 'url': 'foo.csv', 'format': 'CSV'},
+                                      "test/resources/missing.csv")
+        self.assertEqual(changes[STATUS_FIELD], 'quarantined')
+
+    def test_enqueue_after_create(self):
+        """ Test that a job is queued once the pending resource is saved.
+        """
+        context = {}
+        resource = _sample_resource('example.xls', 'example.xls', 'XLS')
+        self.plugin.before_resource_create(context, resource)
+        self.assertEqual(self.jobs, [])
+        saved = {'id': 'abc', 'url': 'example.xls', STATUS_FIELD: 'pending'}
+        self.plugin.after_resource_create(context, saved)
+        self.assertEqual(self.jobs, [(
+            (validate_deferred_upload, ['abc']),
+            {'title': 'Validate type of resource abc', 'queue': 'bulk'})])
+
+        # later updates without a new upload don't queue it again
+        self.plugin.before_resource_update(context, saved, dict(saved))
+        self.plugin.after_resource_update(context, saved)
+        self.assertEqual(len(self.jobs), 1)
+
+    def test_status_is_protected(self):
+        """ Test that only the deferred job can change the outcome.
+        """
+        current = {'id': 'abc', 'url': 'example.xls', 'format': 'XLS',
+                   STATUS_FIELD: 'quarantined', ERRORS_FIELD: '{}'}
+        update = dict(current, **{STATUS_FIELD: 'confirmed'})
+        del update[ERRORS_FIELD]
+        self.plugin.before_resource_update({}, current, update)
+        self.assertEqual(update[STATUS_FIELD], 'quarantined')
+        self.assertEqual(update[ERRORS_FIELD], '{}')
+
+        update = dict(current, **{STATUS_FIELD: 'confirmed'})
+        self.plugin.before_resource_update({JOB_CONTEXT: True}, current, update)
+        self.assertEqual(update[STATUS_FIELD], 'confirmed')
+
+        created = {'url': 'example.xls', 'format': 'XLS', STATUS_FIELD: 'confirmed'}
+        self.plugin.before_resource_create({}, created)
+        self.assertNotIn(STATUS_FIELD, created)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# encoding: utf-8
+
+'''Tests for matching file extensions.
+'''
+
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+if __name__ == '__main__':
+    from extension_index import ExtensionIndex, ExtensionPolicy
+    from resource_type_validation import ResourceTypeValidator
+    from testing import upload_resource
+else:
+    from .extension_index import ExtensionIndex, ExtensionPolicy
+    from .resource_type_validation import ResourceTypeValidator
+    from .testing import upload_resource
+
+from ckan.logic import ValidationError
+
+TYPES_FILE = os.path.join(os.path.dirname(__file__), 'resources', 'resource_types.json')
+
+name_parts = ['', '.', 'csv', 'CSV', 'Csv', 'pdf', 'tar', 'gz', 'x', '/', '?a=1', '#', ' ', '\n']
+
+
+class TestExtensionIndex(unittest.TestCase):
+    '''Test extension lookups.'''
+
+    def test_same_as_pattern(self):
+        '''The index should agree with the regular expression it replaced.'''
+        with open(TYPES_FILE) as types_file:
+            allowed_extensions = json.load(types_file)['allowed_extensions']
+        pattern = re.compile(r'.*\.(' + '|'.join(allowed_extensions) + ')$', re.I)
+        index = ExtensionIndex(allowed_extensions)
+        for length in range(5):
+            for parts in itertools.product(name_parts, repeat=length):
+                filename = ''.join(parts)
+                self.assertEqual(index.is_allowed(filename), bool(pattern.search(filename)),
+                                 "Extension check differs for {!r}".format(filename))
+        for filename in ['http://example.com/dataset/foo/resource/bar/download/data.CSV',
+                         'http://example.com/data.csv?format=pdf', 'archive.tar.gz.pdf']:
+            self.assertEqual(index.is_allowed(filename), bool(pattern.search(filename)))
+
+    def test_any_extension(self):
+        index = ExtensionIndex([])
+        self.assertTrue(index.is_allowed('example.exe'))
+        self.assertTrue(index.is_allowed('example'))
+
+    def test_multi_part_extensions(self):
+        index = ExtensionIndex(['tar.gz', 'SHP.ZIP', 'csv'])
+        for filename in ['example.tar.gz', 'EXAMPLE.TAR.GZ', 'example.shp.zip', '.tar.gz',
+                         'example.csv', 'http://example.com/x.y/example.tar.gz']:
+            self.assertTrue(index.is_allowed(filename), filename)
+        for filename in ['example.gz', 'example.zip', 'tar.gz', 'example.tar.gz/', 'example.targz']:
+            self.assertFalse(index.is_allowed(filename), filename)
+
+    def test_policies(self):
+        '''The longest matching extension should decide the policy.'''
+        index = ExtensionIndex([], {
+            'zip': {'max_size': 100},
+            'shp.zip': {'max_size': '200', 'sniffed_types': ['application/zip']},
+        })
+        self.assertEqual(index.policy_for('example.zip'), ExtensionPolicy(100))
+        self.assertEqual(index.policy_for('example.SHP.zip'), ExtensionPolicy(200, ('application/zip',)))
+        self.assertIsNone(index.policy_for('example.csv'))
+        self.assertIsNone(ExtensionIndex(['zip']).policy_for('example.zip'))
+
+
+class TestExtensionPolicies(unittest.TestCase):
+    '''Test that validation applies extension policies.'''
+
+    def setUp(self):
+        with open(TYPES_FILE) as types_file:
+            types = json.load(types_file)
+        types['extension_policies'] = {
+            'txt': {'max_size': 16},
+            'xml': {'sniffed_types': ['application/xml']},
+        }
+        self.temp_dir = tempfile.mkdtemp()
+        types_file_name = os.path.join(self.temp_dir, 'resource_types.json')
+        with open(types_file_name, 'w') as types_file:
+            json.dump(types, types_file)
+        self.validator = ResourceTypeValidator({
+            'ckan.site_url': 'http://ckan:5000/',
+            'ckanext.resource_validation.types_file': types_file_name})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _validate(self, filename, resource_format, content):
+        resource = upload_resource(filename, content, resource_format)
+        self.validator.validate_resource_mimetype(resource)
+        return resource['mimetype']
+
+    def test_max_size(self):
+        self.assertEqual(self._validate('example.txt', 'TXT', b'hello world\n'), 'text/plain')
+        self.assertRaises(ValidationError, self._validate, 'example.txt', 'TXT', b'hello world\n' * 2)
+        self.assertEqual(self._validate('example.csv', 'CSV', b'a,b\n' * 10), 'text/csv')
+
+    def test_sniffed_types(self):
+        self.assertEqual(self._validate('example.xml', 'XML', b'<?xml version="1.0"?><root/>\n'),
+                         'application/xml')
+        self.assertRaises(ValidationError, self._validate, 'example.xml', 'XML', b'hello world\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# encoding: utf-8
+
+'''Tests that the file type registry agrees with the 'mimetypes'
+module, without modifying it.
+'''
+
+import json
+import mimetypes
+import os
+import unittest
+
+if __name__ == '__main__':
+    from file_types import FileTypeRegistry
+else:
+    from .file_types import FileTypeRegistry
+
+TYPES_FILE = os.path.join(os.path.dirname(__file__), 'resources', 'resource_types.json')
+
+sample_names = ['example', 'example.', '.csv', 'example.csv.gz', 'example.tar.gz',
+                'example.tgz', 'example.svgz', 'example.CSV.GZ', 'example.csv.Z',
+                'example.json.bz2', 'example.xyz.gz', 'example.gz',
+                'http://example.com/data.csv?download=true',
+                'http://example.com/data.csv#section', 'http://example.com/data',
+                'https://example.com/path.with.dots/data.xlsx', 'a:b.csv', 'example.csv:b',
+                'data:text/csv,1,2,3', 'DATA:text/plain;base64,Zm9v', 'data:,foo',
+                'example.pdf ', 'example.None', 'example.unknown-extension']
+
+sample_formats = [None, '', 'CSV', 'csv', 'PDF', 'xlsx', 'ZIP', 'gz', 'tgz', 'csv.gz',
+                  'TAR.GZ', 'text/csv', 'None', 'none', 'unknown', 'a:b', 'SVGZ']
+
+
+def known_extensions():
+    return set(mimetypes.types_map) | set(mimetypes.common_types)
+
+
+class TestFileTypeRegistry(unittest.TestCase):
+    '''Compare lookups against 'mimetypes.guess_type'.'''
+
+    def setUp(self):
+        mimetypes.init()
+        self.registry = FileTypeRegistry()
+
+    def assert_same_type(self, name, actual):
+        self.assertEqual(actual, mimetypes.guess_type(name, strict=False)[0],
+                         "Type of {} differs from mimetypes".format(name))
+
+    def test_known_extensions(self):
+        for extension in known_extensions():
+            if extension != extension.lower():
+                # some versions of mimetypes can't find these at all
+                continue
+            for variant in (extension, extension.upper(), extension.title()):
+                name = 'example' + variant
+                self.assert_same_type(name, self.registry.type_for_filename(name))
+                name = 'http://example.com/download/example' + variant + '?x=1'
+                self.assert_same_type(name, self.registry.type_for_filename(name))
+
+    def test_known_formats(self):
+        for extension in known_extensions():
+            if extension != extension.lower():
+                continue
+            for variant in (extension[1:], extension[1:].upper()):
+                self.assert_same_type('example.' + variant, self.registry.type_for_format(variant))
+
+    def test_mixed_case_extensions(self):
+        for extension in known_extensions():
+            if extension == extension.lower() or extension.lower() in known_extensions() \
+                    or extension.count('.') > 1:
+                continue
+            expected = mimetypes.types_map.get(extension) or mimetypes.common_types.get(extension)
+            for variant in (extension, extension.upper(), extension.lower()):
+                self.assertEqual(self.registry.type_for_filename('example' + variant), expected)
+                self.assertEqual(self.registry.type_for_format(variant[1:]), expected)
+
+    def test_sample_names(self):
+        for name in sample_names:
+            self.assert_same_type(name, self.registry.type_for_filename(name))
+
+    def test_sample_formats(self):
+        for resource_format in sample_formats:
+            self.assert_same_type('example.{}'.format(resource_format),
+                                  self.registry.type_for_format(resource_format))
+
+    def test_extra_types_are_isolated(self):
+        '''Registries with different extra types shouldn't affect
+        each other or the 'mimetypes' module.
+        '''
+        original = mimetypes.guess_type('example.ttf', strict=False)[0]
+        with open(TYPES_FILE) as types_file:
+            extras = json.load(types_file).get('extra_mimetypes', {})
+        configured = FileTypeRegistry(extras)
+        custom = FileTypeRegistry({'.TTF': 'text/x-custom', '.foo': 'application/x-foo'})
+
+        self.assertEqual(custom.type_for_filename('example.ttf'), 'text/x-custom')
+        self.assertEqual(custom.type_for_format('TTF'), 'text/x-custom')
+        self.assertEqual(custom.type_for_filename('EXAMPLE.FOO'), 'application/x-foo')
+        self.assertEqual(custom.type_for_filename('example.foo.gz'), 'application/x-foo')
+        self.assertIsNone(configured.type_for_filename('example.foo'))
+        for extension, mime_type in extras.items():
+            self.assertEqual(configured.type_for_filename('example' + extension), mime_type)
+        self.assertEqual(mimetypes.guess_type('example.ttf', strict=False)[0], original)
+        self.assertIsNone(mimetypes.guess_type('example.foo', strict=False)[0])
+        self.assertEqual(self.registry.type_for_filename('example.ttf'), original)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# encoding: utf-8
+
+'''Tests for validation metrics.
+'''
+
+import socket
+import unittest
+
+if __name__ == '__main__':
+    from metrics import Histogram, MetricsSink, PrometheusRegistry, StatsdSink
+    from resource_type_validation import ResourceTypeValidator
+    from sniffer import CDFV2_CORRUPT
+    from testing import upload_resource
+else:
+    from .metrics import Histogram, MetricsSink, PrometheusRegistry, StatsdSink
+    from .resource_type_validation import ResourceTypeValidator
+    from .sniffer import CDFV2_CORRUPT
+    from .testing import upload_resource
+
+from ckan.logic import ValidationError
+
+
+class TestMetricsSinks(unittest.TestCase):
+    """ Test the metrics backends.
+    """
+
+    def test_default_sink_discards(self):
+        validator = ResourceTypeValidator({})
+        self.assertIs(type(validator.metrics), MetricsSink)
+        with validator.metrics.stage('sniff'):
+            pass
+
+    def test_histogram_buckets(self):
+        """ Test that values fall into the first bucket that can hold them.
+        """
+        histogram = Histogram([1, 10])
+        for value in (0.5, 1, 5, 100):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 106.5)
+
+    def test_prometheus_text(self):
+        registry = PrometheusRegistry()
+        registry.timing('sniff', 0.003)
+        registry.observe('sniff_bytes', 2048)
+        registry.increment('validations', {'outcome': 'rejected', 'reason': 'say "what"'})
+        text = registry.render()
+        self.assertIn('# TYPE resource_type_validation_stage_seconds histogram\n', text)
+        self.assertIn('resource_type_validation_stage_seconds_bucket{stage="sniff",le="0.0025"} 0\n', text)
+        self.assertIn('resource_type_validation_stage_seconds_bucket{stage="sniff",le="0.005"} 1\n', text)
+        self.assertIn('resource_type_validation_stage_seconds_bucket{stage="sniff",le="+Inf"} 1\n', text)
+        self.assertIn('resource_type_validation_stage_seconds_count{stage="sniff"} 1\n', text)
+        self.assertIn('resource_type_validation_sniff_bytes_bucket{le="2048.0"} 1\n', text)
+        self.assertIn('resource_type_validation_validations_total'
+                      '{outcome="rejected",reason="say \\"what\\""} 1\n', text)
+
+    def test_statsd_datagrams(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        try:
+            sink = StatsdSink('127.0.0.1', receiver.getsockname()[1], 'rtv')
+            with sink.stage('coalesce'):
+                pass
+            sink.observe('sniff_bytes', 2048)
+            sink.increment('validations', {'outcome': 'accepted', 'mimetype': 'text/csv'})
+            lines = [receiver.recv(1024).decode('utf-8') for _ in range(3)]
+        finally:
+            receiver.close()
+        self.assertRegex(lines[0], r'^rtv\.stage\.coalesce:[0-9.]+\|ms$')
+        self.assertEqual(lines[1], 'rtv.sniff_bytes:2048|h')
+        self.assertEqual(lines[2], 'rtv.validations.text_csv.accepted:1|c')
+
+
+class TestValidationMetrics(unittest.TestCase):
+    """ Test that validation reports its stages and outcomes.
+    """
+
+    def setUp(self):
+        self.validator = ResourceTypeValidator({
+            'ckan.site_url': 'http://ckan:5000/',
+            'ckanext.resource_validation.metrics': 'prometheus'})
+        self.registry = self.validator.metrics
+
+    def test_stages_and_outcomes(self):
+        self.validator.validate_resource_mimetype(
+            upload_resource('foo.txt', b'hello world\n', 'TXT'))
+        self.assertRaises(ValidationError, self.validator.validate_resource_mimetype,
+                          upload_resource('foo.txt', b'hello world\n', 'PDF'))
+        with open("test/resources/example.zip", "rb") as sample_file:
+            self.assertRaises(ValidationError, self.validator.validate_resource_mimetype,
+                              upload_resource('foo.docx', sample_file.read(), 'DOCX'))
+
+        self.assertEqual(
+            {stage: histogram.count for stage, histogram in self.registry.stage_durations.items()},
+            {'sniff': 2, 'extension_check': 3, 'guess_type': 3, 'format_check': 3,
+             'coalesce': 1, 'archive': 1, 'allow_list': 1})
+        self.assertEqual(self.registry.distributions['sniff_bytes'].sum,
+                         12 + 2048)
+        self.assertEqual(self.registry.counters, {
+            ('signature_lookups', (('result', 'miss'),)): 2,
+            ('validations', (('mimetype', 'text/plain'), ('outcome', 'accepted'), ('stage', 'content'))): 1,
+            ('validations', (('outcome', 'rejected'), ('reason', 'mismatch'), ('stage', 'format'))): 1,
+            ('validations', (('outcome', 'rejected'), ('reason', 'invalid_archive'), ('stage', 'content'))): 1,
+        })
+
+    def test_sniff_fallback(self):
+        """ Test that the full-content sniffing fallback is counted,
+        along with the bytes made available to it.
+        """
+        class TruncatedDocumentSniffer:
+            def from_buffer(self, buffer):
+                return CDFV2_CORRUPT
+
+            def from_stream(self, stream, max_bytes):
+                return 'application/vnd.ms-excel'
+
+        self.validator.sniffer = TruncatedDocumentSniffer()
+        self.validator.validate_resource_mimetype(
+            upload_resource('example.xls', b'x' * 10000, 'XLS'))
+        self.assertEqual(self.registry.counters[('sniff_fallbacks', ())], 1)
+        self.assertEqual(self.registry.distributions['sniff_bytes'].sum, 10000)
+
+
+if __name__ == '__main__':
+    unittest.main()
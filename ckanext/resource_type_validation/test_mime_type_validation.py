@@ -3,6 +3,7 @@
 '''Tests for the ckanext.qgov extension MIME type validation.
 '''
 
+import io
 import unittest
 
 if __name__ == '__main__':
@@ -50,6 +51,8 @@ sample_files = [
     ('example.cdf', 'CDF', ['application/x-cdf', 'application/x-netcdf']),
     ('foo.csv', 'CSV', 'text/csv'),
     ('fortran-bug.csv', 'CSV', 'text/csv'),
+    ('fortran-bug-latin1.csv', 'CSV', 'text/csv'),
+    ('fortran-bug-semicolon.csv', 'CSV', 'text/csv'),
     ('example.docx', 'DOCX', 'application/'
      'vnd.openxmlformats-officedocument.wordprocessingml.document'),
     ('example.docx', 'DOCX', ['application/msword', 'application/'
@@ -116,6 +119,10 @@ sample_file_rejections = [
     # extension is ZIP, but file isn't really an archive
     ('eicar.com.pdf', 'example.zip', 'PDF'),
     ('eicar.com.pdf', 'example.zip', 'ZIP'),
+    # archives lacking the members expected of their type
+    ('example.zip', 'example.docx', 'DOCX'),
+    ('example.zip', 'example.kmz', 'KMZ'),
+    ('example.kmz', 'example.gdb', 'GDB'),
 ]
 
 sample_links = [
@@ -285,5 +292,109 @@ class TestMimeTypeValidation(unittest.TestCase):
         )
 
 
+class TestBatchValidation(unittest.TestCase):
+    """ Test validating several resources at once.
+    """
+
+    def setUp(self):
+        self.validator = ResourceTypeValidator({'ckan.site_url': 'http://ckan:5000/'})
+
+    def test_results_per_resource(self):
+        """ Test that every resource gets a result, in order,
+        and that rejections do not stop the batch.
+        """
+        sample_files = []
+        resources = []
+        for filename, url, specified_format in [
+                ('dummy.pdf', 'dummy.pdf', 'PDF'),
+                ('dummy.pdf', 'example.pdf', 'XML'),
+                ('foo.csv', 'foo.csv', 'CSV'),
+                ('example.zip', 'example.docx', 'DOCX')]:
+            sample_file = open("test/resources/" + filename, "rb")
+            sample_files.append(sample_file)
+            resources.append({'url': url, 'format': specified_format,
+                              'upload': FlaskFileStorage(filename=url, stream=sample_file)})
+        resources.append({'url': 'example.csv', 'format': 'PDF'})
+        try:
+            verdicts = self.validator.validate_resources(resources)
+        finally:
+            for sample_file in sample_files:
+                sample_file.close()
+
+        self.assertEqual([verdict.mimetype for verdict in verdicts],
+                         ['application/pdf', None, 'text/csv', None, None])
+        self.assertEqual([bool(verdict.errors) for verdict in verdicts],
+                         [False, True, False, True, True])
+        self.assertIn('upload', verdicts[1].errors)
+        self.assertEqual(resources[2]['mimetype'], 'text/csv')
+
+    def test_shared_handle(self):
+        """ Test that the batch holds one libmagic handle throughout.
+        """
+        resources = [{'url': 'foo.txt', 'format': 'TXT',
+                      'upload': FlaskFileStorage(filename='foo.txt', stream=io.BytesIO(b'hello world\n'))}
+                     for _ in range(5)]
+        verdicts = self.validator.validate_resources(resources)
+        self.assertEqual([verdict.mimetype for verdict in verdicts], ['text/plain'] * 5)
+        self.assertEqual(self.validator.sniffer.created, 1)
+
+    def test_empty_batch(self):
+        self.assertEqual(self.validator.validate_resources([]), [])
+
+
+class UnreadableUpload(io.BytesIO):
+    """ Upload stream that fails the test if it is read.
+    """
+
+    def read(self, *args):
+        raise AssertionError("Upload should have been rejected without reading it")
+
+
+class TestEarlyRejection(unittest.TestCase):
+    """ Test that resources unacceptable from their names alone
+    are rejected without reading the upload.
+    """
+
+    def setUp(self):
+        self.validator = ResourceTypeValidator({
+            'ckan.site_url': 'http://ckan:5000/',
+            'ckanext.resource_validation.metrics': 'prometheus',
+            'ckan.mimetypes_allowed': 'application/pdf,text/plain,text/csv,application/zip,application/rdf+xml,'
+                                      'application/vnd.openxmlformats-officedocument.wordprocessingml.document'})
+
+    def _validate(self, filename, resource_format, stream):
+        self.validator.validate_resource_mimetype({
+            'url': filename, 'format': resource_format,
+            'upload': FlaskFileStorage(filename=filename, stream=stream)})
+
+    def _stages(self):
+        return {dict(labels)['stage'] for (name, labels) in self.validator.metrics.counters
+                if name == 'validations'}
+
+    def test_reject_from_names(self):
+        for filename, resource_format, stage in [
+                ('example.exe', 'PDF', 'extension'),
+                ('example.pdf', 'CSV', 'format'),
+                ('example.xls', 'XLS', 'allow_list')]:
+            self.validator.metrics.counters.clear()
+            self.assertRaises(ValidationError, self._validate,
+                              filename, resource_format, UnreadableUpload(b'%PDF-1.4'))
+            self.assertEqual(self._stages(), {stage})
+
+    def test_contents_still_decide(self):
+        """ Test that uploads are read whenever the contents
+        could change the outcome.
+        """
+        # contents may be more specific than a generic type, eg RDF for XML,
+        # so the upload is read; this one is plain XML, which isn't allowed
+        with open("test/resources/example.rdf", "rb") as sample_file:
+            self.assertRaises(ValidationError, self._validate, 'example.xml', 'XML', sample_file)
+        self.assertEqual(self._stages(), {'content'})
+        # contents may be a ZIP archive, which can declare any format
+        with open("test/resources/example.docx", "rb") as sample_file:
+            self.assertRaises(ValidationError, self._validate, 'example.docx', 'PDF', sample_file)
+        self.assertEqual(self._stages(), {'content'})
+
+
 if __name__ == '__main__':
     unittest.main()
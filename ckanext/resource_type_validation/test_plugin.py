@@ -0,0 +1,187 @@
+# encoding: utf-8
+
+'''Tests for the plugin's action and resource hooks.
+'''
+
+import io
+import json
+import os
+import unittest
+from unittest import mock
+
+if __name__ == '__main__':
+    import deferred
+    from deferred import FINGERPRINT_FIELD
+    from plugin import ResourceTypeValidationPlugin
+    from remote import RemoteContent
+    from testing import sample, upload_resource
+else:
+    from . import deferred
+    from .deferred import FINGERPRINT_FIELD
+    from .plugin import ResourceTypeValidationPlugin
+    from .remote import RemoteContent
+    from .testing import sample, upload_resource
+
+from ckan.logic import ValidationError
+from werkzeug.datastructures import FileStorage as FlaskFileStorage
+
+
+class TestPackageUploads(unittest.TestCase):
+    """ Test validation of uploads arriving with a dataset.
+    """
+
+    def setUp(self):
+        self.plugin = ResourceTypeValidationPlugin()
+        self.plugin.configure({'ckan.site_url': 'http://ckan:5000/'})
+        self.calls = []
+
+    def _original_action(self, context, data_dict):
+        self.calls.append(data_dict)
+        return data_dict
+
+    def test_accept_uploads(self):
+        data_dict = {'resources': [
+            upload_resource('foo.txt', b'hello world\n', 'TXT'),
+            {'url': 'http://example.com/foo.csv', 'format': 'CSV'},
+            upload_resource('bar.txt', b'goodbye\n', 'TXT'),
+        ]}
+        self.plugin._validate_package_uploads(self._original_action, {}, data_dict)
+        self.assertEqual(self.calls, [data_dict])
+        self.assertEqual(data_dict['resources'][0]['mimetype'], 'text/plain')
+        self.assertNotIn('mimetype', data_dict['resources'][1])
+
+    def test_report_all_rejections(self):
+        """ Test that each rejected upload is reported against
+        its own position in the resource list.
+        """
+        data_dict = {'resources': [
+            upload_resource('foo.pdf', b'hello world\n', 'PDF'),
+            upload_resource('foo.txt', b'hello world\n', 'TXT'),
+            upload_resource('foo.txt', b'hello world\n', 'CSV'),
+        ]}
+        with self.assertRaises(ValidationError) as raised:
+            self.plugin._validate_package_uploads(self._original_action, {}, data_dict)
+        errors = raised.exception.error_dict['resources']
+        self.assertEqual([bool(error) for error in errors], [True, False, True])
+        self.assertIn('upload', errors[0])
+        self.assertEqual(self.calls, [])
+
+    def test_skip_uploads_already_validated(self):
+        """ Test that uploads checked by the resource hooks, before
+        resource_create calls package_update, are not checked again.
+        """
+        context = {}
+        resource = upload_resource('foo.txt', b'hello world\n', 'TXT')
+        self.plugin.before_resource_create(context, resource)
+        self.plugin.validator.sniffer = None
+        self.plugin._validate_package_uploads(
+            self._original_action, context, {'resources': [resource]})
+        self.assertEqual(len(self.calls), 1)
+
+    def test_statuses_fetched_together(self):
+        """ Test that the stored statuses of a dataset's resources are
+        looked up in one query, rather than one per resource.
+        """
+        resources = [dict(upload_resource('foo{}.txt'.format(i), b'hello world\n', 'TXT'), id=str(i))
+                     for i in range(3)]
+        with mock.patch.object(deferred, 'stored_statuses', return_value={}) as stored_statuses:
+            self.plugin._validate_package_uploads(self._original_action, {}, {'resources': resources})
+        stored_statuses.assert_called_once()
+        self.assertEqual(list(stored_statuses.call_args[0][0]), ['0', '1', '2'])
+
+
+class TestStoredLinks(unittest.TestCase):
+    """ Test that links already stored with a dataset are only
+    fetched again if they change.
+    """
+
+    def setUp(self):
+        self.plugin = ResourceTypeValidationPlugin()
+        self.plugin.configure({'ckan.site_url': 'http://ckan:5000/',
+                               'ckanext.resource_validation.remote_fetch_bytes': '2048'})
+        # the server now sends a PDF, though the link was stored as CSV
+        self.link = {'id': 'abc', 'url': 'http://example.com/data.csv', 'format': 'CSV', 'mimetype': 'text/csv'}
+        self.fetched = []
+
+        def fetch_all(urls):
+            self.fetched.extend(urls)
+            return {url: RemoteContent('application/pdf', sample('dummy.pdf')) for url in self.fetched}
+        self.plugin.validator.remote.fetch_all = fetch_all
+
+    def _update(self, data_dict):
+        with mock.patch.object(deferred, 'stored_statuses', return_value={'abc': dict(self.link)}):
+            return self.plugin._validate_package_uploads(lambda context, data_dict: data_dict, {}, data_dict)
+
+    def test_unrelated_edit(self):
+        data_dict = {'title': 'Updated', 'resources': [
+            dict(self.link), upload_resource('foo.txt', b'hello world\n', 'TXT')]}
+        self.assertEqual(self._update(data_dict), data_dict)
+        self.assertEqual(self.fetched, [])
+
+    def test_changed_link(self):
+        with self.assertRaises(ValidationError) as raised:
+            self._update({'resources': [dict(self.link, url='http://example.com/other.csv')]})
+        self.assertIn('url', raised.exception.error_dict['resources'][0])
+        self.assertEqual(self.fetched, ['http://example.com/other.csv'])
+
+
+class TestResourceUpdates(unittest.TestCase):
+    """ Test that updates are only validated if they could change
+    the outcome.
+    """
+
+    def setUp(self):
+        self.plugin = ResourceTypeValidationPlugin()
+        self.plugin.configure({'ckan.site_url': 'http://ckan:5000/',
+                               'ckanext.resource_validation.metrics': 'prometheus'})
+        resource = upload_resource('foo.txt', b'hello world\n', 'TXT')
+        resource[FINGERPRINT_FIELD] = 'forged'
+        self.plugin.before_resource_create({}, resource)
+        self.assertNotEqual(resource[FINGERPRINT_FIELD], 'forged')
+        # as shown once stored
+        self.current = dict(resource, url='http://ckan:5000/dataset/example/resource/abc/download/foo.txt')
+        del self.current['upload']
+
+    def _update(self, **changes):
+        data_dict = dict(self.current, **changes)
+        self.plugin.before_resource_update({}, self.current, data_dict)
+        return data_dict
+
+    def _skipped(self):
+        return self.plugin.validator.metrics.counters.get(('validations', (('outcome', 'unchanged'),)), 0)
+
+    def test_metadata_change_skipped(self):
+        data_dict = self._update(description='Updated', format='txt')
+        self.assertEqual(self._skipped(), 1)
+        self.assertEqual(data_dict[FINGERPRINT_FIELD], self.current[FINGERPRINT_FIELD])
+
+    def test_type_change_validated(self):
+        self.assertRaises(ValidationError, self._update, format='PDF')
+        self.assertRaises(ValidationError, self._update, **{'format': 'PDF', FINGERPRINT_FIELD: 'forged'})
+        self._update(upload=FlaskFileStorage(filename='foo.txt', stream=io.BytesIO(b'goodbye\n')))
+        self.assertEqual(self._skipped(), 0)
+
+    def test_upload_filename_stamped(self):
+        '''Test that an upload is stamped with the filename that CKAN
+        stores as its URL, rather than the URL it was submitted with.'''
+        resource = upload_resource('data.csv', b'id,name\n1,example\n', 'CSV')
+        resource['url'] = 'data.pdf'
+        self.plugin.before_resource_create({}, resource)
+        self.current = dict(resource, url='http://ckan:5000/dataset/example/resource/abc/download/data.csv')
+        del self.current['upload']
+        self._update(description='Updated')
+        self.assertEqual(self._skipped(), 1)
+        self.assertRaises(ValidationError, self._update, url='data.pdf')
+
+    def test_policy_change_validated(self):
+        types_file = os.path.join(os.path.dirname(__file__), 'resources', 'resource_types.json')
+        with open(types_file) as config_file:
+            file_mime_config = json.load(config_file)
+        file_mime_config['allowed_extensions'].remove('txt')
+        self.plugin.validator.replace_policy(file_mime_config)
+        self.assertRaises(ValidationError, self._update, description='Updated')
+        self.assertEqual(self._skipped(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# encoding: utf-8
+
+'''Tests for checking the types file, and building its policy lazily.
+'''
+
+import json
+import os
+import unittest
+
+if __name__ == '__main__':
+    from policy_check import check_types
+    from resource_type_validation import ResourceTypeValidator
+    from testing import csv_resource
+else:
+    from .policy_check import check_types
+    from .resource_type_validation import ResourceTypeValidator
+    from .testing import csv_resource
+
+
+TYPES_FILE = os.path.join(os.path.dirname(__file__), 'resources', 'resource_types.json')
+
+
+class TestCheckTypes(unittest.TestCase):
+    '''Test finding entries that contradict each other or do nothing.'''
+
+    def test_shipped_types_file(self):
+        with open(TYPES_FILE) as types_file:
+            self.assertEqual(check_types(json.load(types_file)), [])
+
+    def test_problems(self):
+        problems = check_types({
+            'allowed_extensions': ['csv', 'qqqz'],
+            'extension_policies': {'exe': {'max_size': 10}},
+            'allowed_overrides': {'text/plain': ['text/csv'], 'text/csv': ['text/*']},
+            'equal_types': [['text/x-one'], ['text/x-two', 'text/x-three'],
+                            ['text/x-two', 'text/x-three', 'text/x-four']],
+            'archive_types': ['application/zip'],
+            'archive_members': {'text/csv': ['*.csv']},
+        })
+        self.assertEqual(problems, [
+            "allowed_overrides: 'text/plain' and 'text/csv' override each other",
+            "equal_types: ['text/x-one'] has nothing to be equal to",
+            "equal_types: ['text/x-three', 'text/x-two'] is already within another entry",
+            "allowed_extensions: no MIME type is known for 'qqqz'",
+            "extension_policies: 'exe' is not an allowed extension",
+            "archive_members: 'text/csv' is not a subtype of any archive type",
+        ])
+
+
+class TestLazyPolicy(unittest.TestCase):
+    '''Test that the type policy is built on first use.'''
+
+    def test_built_on_first_use(self):
+        validator = ResourceTypeValidator({'ckan.site_url': 'http://ckan:5000/'})
+        self.assertIsNone(validator._policy, "The policy should be built on first use")
+        resource = csv_resource()
+        validator.validate_resource_mimetype(resource)
+        self.assertEqual(resource['mimetype'], 'text/csv')
+        self.assertIsNotNone(validator._policy)
+
+
+if __name__ == '__main__':
+    unittest.main()
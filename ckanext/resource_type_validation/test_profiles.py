@@ -0,0 +1,167 @@
+# encoding: utf-8
+
+'''Tests for policy profiles selected by organisation or dataset type.
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+if __name__ == '__main__':
+    from policy_check import check_types
+    import profiles
+    from profiles import ProfileSelector, profile_config
+    from resource_type_validation import ResourceTypeValidator
+    from testing import sample, upload_resource
+else:
+    from . import profiles
+    from .policy_check import check_types
+    from .profiles import ProfileSelector, profile_config
+    from .resource_type_validation import ResourceTypeValidator
+    from .testing import sample, upload_resource
+
+from ckan.logic import ValidationError
+
+TYPES_FILE = os.path.join(os.path.dirname(__file__), 'resources', 'resource_types.json')
+
+PROFILES = {
+    'spatial': {
+        'organizations': ['spatial-agency'],
+        'dataset_types': ['geospatial'],
+        'add': {'allowed_extensions': ['mbtiles'], 'extra_mimetypes': {'.mbtiles': 'application/vnd.sqlite3'}},
+    },
+    'office': {
+        'organizations': ['records-agency', 'org-id-2'],
+        'allowed_extensions': ['pdf', 'txt'],
+        'mimetypes_allowed': ['application/pdf', 'text/plain'],
+    },
+}
+
+
+def _dataset(organization=None, dataset_type='dataset', owner_org='org-id-1'):
+    return {'owner_org': owner_org, 'organization': {'name': organization} if organization else None,
+            'type': dataset_type}
+
+
+class TestProfileSelection(unittest.TestCase):
+    '''Test choosing and building the profile for a dataset.'''
+
+    def test_select(self):
+        selector = ProfileSelector(PROFILES)
+        self.assertIsNone(selector.select(None))
+        self.assertIsNone(selector.select(_dataset('other-agency')))
+        self.assertEqual(selector.select(_dataset('spatial-agency')), 'spatial')
+        self.assertEqual(selector.select(_dataset(owner_org='org-id-2')), 'office')
+        self.assertEqual(selector.select(_dataset(dataset_type='geospatial')), 'spatial')
+        # the organisation's profile comes first
+        self.assertEqual(selector.select(_dataset('records-agency', 'geospatial')), 'office')
+        self.assertFalse(ProfileSelector({}))
+
+    def test_profile_config(self):
+        file_mime_config = {'allowed_extensions': ['csv'], 'extra_mimetypes': {'.foo': 'text/plain'},
+                            'equal_types': [], 'profiles': PROFILES}
+        config, allowed_mime_types = profile_config(file_mime_config, 'spatial')
+        self.assertEqual(config, {'allowed_extensions': ['csv', 'mbtiles'], 'equal_types': [],
+                                  'extra_mimetypes': {'.foo': 'text/plain', '.mbtiles': 'application/vnd.sqlite3'}})
+        self.assertIsNone(allowed_mime_types)
+        config, allowed_mime_types = profile_config(file_mime_config, 'office')
+        self.assertEqual(config['allowed_extensions'], ['pdf', 'txt'])
+        self.assertEqual(allowed_mime_types, ['application/pdf', 'text/plain'])
+        self.assertEqual(file_mime_config['allowed_extensions'], ['csv'])
+
+    def test_check(self):
+        problems = check_types({'profiles': {
+            'first': {'organizations': ['agency']},
+            'second': {'organizations': ['agency'], 'allowed_extensions': ['qqqz']},
+        }})
+        self.assertEqual(problems, [
+            "profiles: organizations 'agency' is already in profile 'first'",
+            "profiles.second: allowed_extensions: no MIME type is known for 'qqqz'",
+        ])
+
+
+class TestProfileValidation(unittest.TestCase):
+    '''Test that each dataset is validated under its profile.'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        with open(TYPES_FILE) as types_file:
+            self.file_mime_config = json.load(types_file)
+        self.file_mime_config['profiles'] = PROFILES
+        types_file_name = os.path.join(self.temp_dir, 'resource_types.json')
+        with open(types_file_name, 'w') as types_file:
+            json.dump(self.file_mime_config, types_file)
+        self.validator = ResourceTypeValidator({
+            'ckan.site_url': 'http://ckan:5000/',
+            'ckanext.resource_validation.types_file': types_file_name,
+            'ckanext.resource_validation.profile_cache_size': '1',
+        })
+
+    def test_profiles_applied(self):
+        self.assertTrue(self.validator.uses_profiles())
+        csv_content = b'id,name\n1,example\n'
+        self.validator.validate_resource_mimetype(upload_resource('example.csv', csv_content, 'CSV'))
+        self.assertRaises(ValidationError, self.validator.validate_resource_mimetype,
+                          upload_resource('example.mbtiles', b'SQLite format 3\x00' + bytes(100), ''))
+
+        office = _dataset('records-agency')
+        self.assertRaises(ValidationError, self.validator.validate_resource_mimetype,
+                          upload_resource('example.csv', csv_content, 'CSV'), dataset=office)
+        resource = upload_resource('example.txt', b'hello world\n', 'TXT')
+        self.validator.validate_resource_mimetype(resource, dataset=office)
+        self.assertEqual(resource['mimetype'], 'text/plain')
+
+        verdicts = self.validator.validate_resources(
+            [upload_resource('example.mbtiles', b'SQLite format 3\x00' + bytes(100), ''),
+             upload_resource('example.csv', csv_content, 'CSV')],
+            dataset=_dataset(dataset_type='geospatial'))
+        self.assertEqual([verdict.errors for verdict in verdicts], [None, None])
+
+    def test_compiled_once(self):
+        office = _dataset('records-agency')
+        policy = self.validator.current_policy(office)
+        self.assertIsNot(policy, self.validator.current_policy())
+        self.assertIs(self.validator.current_policy(office), policy)
+        self.assertIs(self.validator.current_policy(_dataset(owner_org='org-id-2')), policy)
+
+        # only the most recently used profile is kept
+        self.validator.current_policy(_dataset('spatial-agency'))
+        self.assertIsNot(self.validator.current_policy(office), policy)
+
+        # nor is a profile of a replaced types file used
+        policy = self.validator.current_policy(office)
+        self.file_mime_config['equal_types'].append(['text/x-one', 'text/x-two'])
+        self.validator.replace_policy(self.file_mime_config)
+        self.assertIsNot(self.validator.current_policy(office), policy)
+
+    def test_fingerprint_per_profile(self):
+        '''Test that a resource moved to a dataset under another
+        profile is validated again.'''
+        resource = upload_resource('example.txt', b'hello world\n', 'TXT')
+        office = _dataset('records-agency')
+        self.validator.validate_resource_mimetype(resource, dataset=office)
+        del resource['upload']
+        self.assertTrue(self.validator.is_unchanged(resource, dict(resource), office))
+        self.assertFalse(self.validator.is_unchanged(resource, dict(resource), _dataset('spatial-agency')))
+
+    def test_documented_example(self):
+        '''Test that the example profiles in the documentation accept
+        the files they are meant for.'''
+        doc = profiles.__doc__
+        start = doc.index('"profiles": {')
+        end = doc.index('\n    }\n', start) + len('\n    }')
+        self.file_mime_config['profiles'] = json.loads('{' + doc[start:end] + '}')['profiles']
+        self.validator.replace_policy(self.file_mime_config)
+        office = _dataset('records-agency')
+        for filename, resource_format in (('dummy.pdf', 'PDF'), ('example.docx', 'DOCX'), ('example.xlsx', 'XLSX')):
+            resource = upload_resource(filename, sample(filename), resource_format)
+            self.validator.validate_resource_mimetype(resource, dataset=office)
+        self.assertRaises(ValidationError, self.validator.validate_resource_mimetype,
+                          upload_resource('example.txt', b'hello world\n', 'TXT'), dataset=office)
+
+
+if __name__ == '__main__':
+    unittest.main()
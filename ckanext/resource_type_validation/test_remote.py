@@ -0,0 +1,275 @@
+# encoding: utf-8
+
+'''Tests for checking link resources from the first bytes at their URLs.
+'''
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import threading
+import time
+import unittest
+
+if __name__ == '__main__':
+    from remote import RemoteFetcher
+    from resource_type_validation import ResourceTypeValidator
+    from testing import sample
+else:
+    from .remote import RemoteFetcher
+    from .resource_type_validation import ResourceTypeValidator
+    from .testing import sample
+
+from ckan.logic import ValidationError
+
+CSV_CONTENT = b'id,name\n' + b'1,example\n' * 1000
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class StandInServer(ThreadingHTTPServer):
+    """ Local server for links, which honours Range and If-None-Match,
+    and records the requests it receives.
+    """
+    daemon_threads = True
+
+    def __init__(self, files):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.files = files
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.delay = 0.0
+        # seconds between each byte of a body
+        self.drip = 0.0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            self._respond(server.files.get(self.path))
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _respond(self, file):
+        if file is None:
+            self._send(404, {}, b'')
+            return
+        content_type, body, etag = file
+        if etag and self.headers.get('If-None-Match') == etag:
+            self._send(304, {'ETag': etag}, b'')
+            return
+        headers = {'Content-Type': content_type, 'ETag': etag}
+        status = 200
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start, end = byte_range.split('=')[1].split('-')
+            body = body[int(start):int(end) + 1]
+            status = 206
+        self._send(status, headers, body)
+
+    def _send(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            if value:
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not self.server.drip:
+            self.wfile.write(body)
+            return
+        try:
+            for i in range(len(body)):
+                self.wfile.write(body[i:i + 1])
+                self.wfile.flush()
+                time.sleep(self.server.drip)
+        except ConnectionError:
+            # the fetcher gave up
+            self.close_connection = True
+
+
+class RemoteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({
+            '/data.csv': ('text/csv; charset=utf-8', CSV_CONTENT, '"v1"'),
+            '/report.csv': ('application/octet-stream', sample('dummy.pdf'), None),
+            '/slow.csv': ('text/csv', CSV_CONTENT, None),
+        })
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+
+class TestRemoteFetcher(RemoteTestCase):
+    '''Test fetching and caching the start of links.'''
+
+    def test_ranged_and_cached(self):
+        clock = FakeClock()
+        fetcher = RemoteFetcher(100, cache_ttl=60, allow_private=True, clock=clock)
+        url = self.server.url('/data.csv')
+        content = fetcher.fetch(url)
+        self.assertEqual(content.content_type, 'text/csv')
+        self.assertEqual(content.head, CSV_CONTENT[:100])
+        self.assertEqual(self.server.requests[0][1]['Range'], 'bytes=0-99')
+
+        self.assertEqual(fetcher.fetch(url), content)
+        self.assertEqual(len(self.server.requests), 1)
+        # once stale, an unchanged link is revalidated rather than fetched
+        clock.now += 61
+        self.assertEqual(fetcher.fetch(url), content)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1][1]['If-None-Match'], '"v1"')
+
+    def test_failures(self):
+        fetcher = RemoteFetcher(100, timeout=0.2, allow_private=True)
+        self.assertIsNone(fetcher.fetch(self.server.url('/missing.csv')))
+        self.assertIsNone(fetcher.fetch(self.server.url('/missing.csv')))
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertIsNone(fetcher.fetch('ftp://127.0.0.1/data.csv'))
+
+        self.server.delay = 1
+        start = time.monotonic()
+        self.assertIsNone(fetcher.fetch(self.server.url('/slow.csv')))
+        self.assertLess(time.monotonic() - start, 0.9)
+
+    def test_deadline(self):
+        '''Test that a server sending a byte at a time can't hold a fetch
+        for longer than the timeout, though each byte comes in time.'''
+        fetcher = RemoteFetcher(100, timeout=0.3, allow_private=True)
+        self.server.drip = 0.05
+        start = time.monotonic()
+        self.assertIsNone(fetcher.fetch(self.server.url('/data.csv')))
+        self.assertLess(time.monotonic() - start, 0.6)
+
+    def test_without_read1(self):
+        '''Test that a body can be read from urllib3 1.26 responses,
+        which lack 'read1'.'''
+
+        class OldResponse:
+            connection = None
+
+            def __init__(self, body):
+                self.body = io.BytesIO(body)
+
+            def read(self, amt=None, decode_content=None):
+                assert decode_content is False
+                return self.body.read(amt)
+
+        fetcher = RemoteFetcher(100)
+        self.assertEqual(fetcher._read_head(OldResponse(CSV_CONTENT), time.monotonic() + 1), CSV_CONTENT[:100])
+        self.assertEqual(fetcher._read_head(OldResponse(b'id\n'), time.monotonic() + 1), b'id\n')
+
+    def test_private_address_refused(self):
+        fetcher = RemoteFetcher(100)
+        self.assertIsNone(fetcher.fetch(self.server.url('/data.csv')))
+        self.assertEqual(self.server.requests, [])
+
+    def test_fetch_all(self):
+        '''Test that a batch of links is fetched concurrently,
+        but with at most 'max_connections' at once to a host.'''
+        self.server.files.update(
+            ('/{}.csv'.format(i), ('text/csv', CSV_CONTENT, None)) for i in range(8))
+        fetcher = RemoteFetcher(100, max_connections=2, allow_private=True)
+        self.server.delay = 0.05
+        urls = [self.server.url('/{}.csv'.format(i)) for i in range(8)]
+        contents = fetcher.fetch_all(urls)
+        self.assertEqual(len(self.server.requests), 8)
+        self.assertEqual(self.server.max_active, 2)
+        self.assertEqual(sorted(contents), sorted(urls))
+        for url in urls:
+            self.assertEqual(contents[url].content_type, 'text/csv')
+            self.assertEqual(fetcher.fetch(url).content_type, 'text/csv')
+        self.assertEqual(len(self.server.requests), 8)
+
+
+class TestLinkValidation(RemoteTestCase):
+    '''Test that links are checked like uploads when enabled.'''
+
+    def setUp(self):
+        super().setUp()
+        self.validator = ResourceTypeValidator({
+            'ckan.site_url': 'http://ckan:5000/',
+            'ckanext.resource_validation.remote_fetch_bytes': '2048',
+            'ckanext.resource_validation.remote_allow_private': 'true',
+            'ckanext.resource_validation.metrics': 'prometheus'})
+
+    def test_accepted(self):
+        resource = {'url': self.server.url('/data.csv'), 'format': 'CSV'}
+        self.validator.validate_resource_mimetype(resource)
+        self.assertEqual(resource['mimetype'], 'text/csv')
+        self.assertEqual(self.validator.metrics.counters[
+            ('validations', (('mimetype', 'text/csv'), ('outcome', 'accepted'), ('stage', 'remote')))], 1)
+
+    def test_rejected(self):
+        resource = {'url': self.server.url('/report.csv'), 'format': 'CSV'}
+        with self.assertRaises(ValidationError) as context:
+            self.validator.validate_resource_mimetype(resource)
+        self.assertIn('url', context.exception.error_dict)
+
+    def test_unavailable(self):
+        resource = {'url': self.server.url('/missing.csv'), 'format': 'PDF'}
+        self.validator.validate_resource_mimetype(resource)
+        self.assertNotIn('mimetype', resource)
+        self.assertEqual(self.validator.metrics.counters[('remote_fetches', (('result', 'failed'),))], 1)
+
+    def test_batch(self):
+        verdicts = self.validator.validate_resources([
+            {'url': self.server.url('/data.csv'), 'format': 'CSV'},
+            {'url': self.server.url('/report.csv'), 'format': 'CSV'},
+        ])
+        self.assertEqual(verdicts[0].mimetype, 'text/csv')
+        self.assertIsNone(verdicts[0].errors)
+        self.assertIn('url', verdicts[1].errors)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_fetched_before_lease(self):
+        '''Test that a link is fetched before a libmagic handle is
+        leased for the batch, even when it's the only one.'''
+        leased = []
+        lease = self.validator.sniffer.lease
+
+        @contextmanager
+        def recording_lease():
+            with lease() as sniffer:
+                leased.append(len(self.server.requests))
+                yield sniffer
+
+        self.validator.sniffer.lease = recording_lease
+        verdicts = self.validator.validate_resources([{'url': self.server.url('/data.csv'), 'format': 'CSV'}])
+        self.assertEqual(verdicts[0].mimetype, 'text/csv')
+        self.assertEqual(leased, [1])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_disabled(self):
+        validator = ResourceTypeValidator({'ckan.site_url': 'http://ckan:5000/'})
+        resource = {'url': self.server.url('/report.csv'), 'format': 'CSV'}
+        validator.validate_resource_mimetype(resource)
+        self.assertFalse(validator.checks_link(resource))
+        self.assertEqual(self.server.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# encoding: utf-8
+
+'''Tests for recognising file types by signature.
+'''
+
+import json
+import os
+import random
+import unittest
+
+if __name__ == '__main__':
+    from resource_type_validation import ResourceTypeValidator
+    from signatures import SignatureTable
+    from sniffer import MagicPool
+    from testing import sample, upload_resource
+else:
+    from .resource_type_validation import ResourceTypeValidator
+    from .signatures import SignatureTable
+    from .sniffer import MagicPool
+    from .testing import sample, upload_resource
+
+
+TYPES_FILE = os.path.join(os.path.dirname(__file__), 'resources', 'resource_types.json')
+RESOURCES_DIR = 'test/resources'
+
+
+def _default_signatures():
+    with open(TYPES_FILE) as types_file:
+        return json.load(types_file)['signatures']
+
+
+class TestSignatureTable(unittest.TestCase):
+    '''Test signature lookups.'''
+
+    def test_match(self):
+        table = SignatureTable({'application/zip': ['PK\u0003\u0004'],
+                                'application/x-special': ['PK\u0003\u0004special']})
+        self.assertEqual(table.match(b'PK\x03\x04data'), 'application/zip')
+        self.assertEqual(table.match(memoryview(b'PK\x03\x04special!')), 'application/x-special')
+        # libmagic wants more than the signature itself
+        self.assertIsNone(table.match(b'PK\x03\x04'))
+        self.assertIsNone(table.match(b'PK\x03\x05data'))
+        self.assertIsNone(table.match(b''))
+        self.assertFalse(SignatureTable({}))
+        self.assertRaises(ValueError, SignatureTable, {'text/plain': ['']})
+
+    def test_never_disagrees_with_libmagic(self):
+        '''Test that every sample, and synthetic files starting with
+        each default signature, are either left to libmagic or
+        recognised as libmagic would.
+        '''
+        table = SignatureTable(_default_signatures())
+        pool = MagicPool(1)
+        hits = []
+        for filename in sorted(os.listdir(RESOURCES_DIR)):
+            path = os.path.join(RESOURCES_DIR, filename)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as sample_file:
+                head = sample_file.read(2048)
+            sniffed_mimetype = table.match(head)
+            if sniffed_mimetype:
+                hits.append(filename)
+                self.assertEqual(sniffed_mimetype, pool.from_buffer(head), filename)
+        self.assertIn('dummy.pdf', hits)
+        self.assertIn('example.png', hits)
+        self.assertIn('sample_0.JPEG', hits)
+
+        rng = random.Random(0)
+        tails = [b'\x00', b'\x00' * 2048, b'hello world\n' * 100,
+                 b'\x10\x00\x00\x00CR\x02\x00' + b'\x00' * 100]
+        tails += [bytes(rng.getrandbits(8) for _ in range(length)) for length in (1, 8, 100, 2048) * 10]
+        for mime_type, prefixes in _default_signatures().items():
+            for prefix in prefixes:
+                for tail in tails:
+                    head = prefix.encode('latin-1') + tail
+                    self.assertIn(table.match(head), (None, pool.from_buffer(head)), head[:16])
+
+
+class TestSignatureValidation(unittest.TestCase):
+    '''Test that validation uses signatures ahead of libmagic.'''
+
+    def setUp(self):
+        self.validator = ResourceTypeValidator({
+            'ckan.site_url': 'http://ckan:5000/',
+            'ckanext.resource_validation.metrics': 'prometheus'})
+        self.registry = self.validator.metrics
+
+    def _validate(self, filename, resource_format):
+        resource = upload_resource(filename, sample(filename), resource_format)
+        self.validator.validate_resource_mimetype(resource)
+        return resource['mimetype']
+
+    def test_hits_skip_libmagic(self):
+        class NoSniffer:
+            def from_buffer(self, buffer):
+                raise AssertionError("libmagic should not be needed")
+
+        sniffer = self.validator.sniffer
+        self.validator.sniffer = NoSniffer()
+        self.assertEqual(self._validate('example.png', 'PNG'), 'image/png')
+        self.validator.sniffer = sniffer
+        self.assertEqual(self._validate('example.txt', 'TXT'), 'text/plain')
+        self.assertEqual(self.registry.counters[('signature_lookups', (('result', 'hit'),))], 1)
+        self.assertEqual(self.registry.counters[('signature_lookups', (('result', 'miss'),))], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
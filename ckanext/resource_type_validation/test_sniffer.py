@@ -0,0 +1,321 @@
+# encoding: utf-8
+
+'''Tests for the pooled libmagic sniffer.
+'''
+
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+if __name__ == '__main__':
+    from sniffer import CDFV2_CORRUPT, MagicPool, Sniffer, _unspooled, content_view, head_view
+else:
+    from .sniffer import CDFV2_CORRUPT, MagicPool, Sniffer, _unspooled, content_view, head_view
+
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+# Sniff a file and report the peak RSS of the process. Unless told to
+# use the descriptor, hide it and never recognise the contents, so that
+# every window up to the cap is read.
+PEAK_RSS_SCRIPT = '''
+import io
+import resource
+import sys
+sys.path.insert(0, sys.argv[1])
+from ckanext.resource_type_validation.sniffer import CDFV2_CORRUPT, MagicPool
+
+
+class Unrecognised:
+    def from_buffer(self, buffer):
+        return CDFV2_CORRUPT
+
+
+class NoDescriptor(io.RawIOBase):
+    def __init__(self, raw):
+        self.raw = raw
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        return self.raw.seek(offset, whence)
+
+    def readinto(self, buffer):
+        return self.raw.readinto(buffer)
+
+
+with open(sys.argv[2], 'rb') as raw:
+    if sys.argv[3] == '1':
+        MagicPool(1).from_stream(raw, 4 * 1024 * 1024)
+    else:
+        MagicPool(1, factory=Unrecognised).from_stream(
+            io.BufferedReader(NoDescriptor(raw)), 4 * 1024 * 1024)
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+class NoDescriptor(io.RawIOBase):
+    """ Seekable stream that hides the descriptor of the file behind it.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        return self.raw.seek(offset, whence)
+
+    def readinto(self, buffer):
+        return self.raw.readinto(buffer)
+
+
+class WindowRecorder:
+    """ Fake libmagic handle that reports a corrupt document
+    until it sees at least 'needed' bytes.
+    """
+
+    def __init__(self, needed, windows):
+        self.needed = needed
+        self.windows = windows
+
+    def from_buffer(self, buffer):
+        self.windows.append(len(buffer))
+        if len(buffer) < self.needed:
+            return CDFV2_CORRUPT + ', reason: short sector chain'
+        return 'application/vnd.ms-excel'
+
+
+class TestMagicPool(unittest.TestCase):
+    """ Test that libmagic handles are reused and bounded.
+    """
+
+    def test_sniff_types(self):
+        """ Test that pooled handles identify content correctly.
+        """
+        pool = MagicPool(2)
+        with open("test/resources/dummy.pdf", "rb") as sample_file:
+            self.assertEqual(pool.from_buffer(sample_file.read(2048)),
+                             'application/pdf')
+        self.assertEqual(pool.from_buffer(b'hello world\n'), 'text/plain')
+
+    def test_reuse_handles(self):
+        """ Test that sequential sniffs share a single handle.
+        """
+        pool = MagicPool(4)
+        for _ in range(10):
+            pool.from_buffer(b'hello world\n')
+        self.assertEqual(pool.created, 1)
+
+    def test_bounded_size(self):
+        """ Test that concurrent threads never create more handles
+        than the pool size.
+        """
+        active = []
+        peak = []
+
+        class SlowHandle:
+            def from_buffer(self, buffer):
+                active.append(1)
+                peak.append(len(active))
+                time.sleep(0.01)
+                active.pop()
+                return 'text/plain'
+
+        pool = MagicPool(2, factory=SlowHandle)
+        threads = [threading.Thread(target=pool.from_buffer, args=(b'',))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(pool.created, 2)
+        self.assertLessEqual(max(peak), 2)
+
+    def test_lease(self):
+        """ Test that a lease holds one handle for several sniffs,
+        and frees it for the pool afterward.
+        """
+        pool = MagicPool(1)
+        with pool.lease() as sniffer:
+            self.assertEqual(sniffer.from_buffer(b'hello world\n'), 'text/plain')
+            with open("test/resources/example.doc", "rb") as sample_file:
+                self.assertEqual(sniffer.from_stream(sample_file), 'application/msword')
+            self.assertEqual(pool._idle, [])
+        self.assertEqual(pool.from_buffer(b'hello world\n'), 'text/plain')
+        self.assertEqual(pool.created, 1)
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, Sniffer)
+
+    def test_invalid_size(self):
+        """ Test that a pool must allow at least one handle.
+        """
+        self.assertRaises(ValueError, MagicPool, 0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "Requires os.fork")
+    def test_rebuild_after_fork(self):
+        """ Test that child processes start with an empty pool.
+        """
+        pool = MagicPool(2)
+        pool.from_buffer(b'hello world\n')
+        self.assertEqual(pool.created, 1)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                if pool.created == 0 \
+                        and pool.from_buffer(b'hello world\n') == 'text/plain':
+                    status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(pool.created, 1)
+
+
+class TestBoundedSniffing(unittest.TestCase):
+    """ Test sniffing beyond the first few bytes of an upload
+    without loading the whole upload into memory.
+    """
+
+    def test_sniff_by_descriptor(self):
+        """ Test that file-backed streams are sniffed by descriptor,
+        and that the stream is rewound afterward.
+        """
+        pool = MagicPool(1)
+        with open("test/resources/example.doc", "rb") as sample_file:
+            sample_file.read(100)
+            self.assertEqual(pool.from_stream(sample_file), 'application/msword')
+            self.assertEqual(sample_file.tell(), 0)
+            self.assertEqual(sample_file.read(4), b'\xd0\xcf\x11\xe0')
+
+    def test_escalating_windows(self):
+        """ Test that in-memory streams are read in growing windows
+        only until the type is recognised.
+        """
+        windows = []
+        pool = MagicPool(1, factory=lambda: WindowRecorder(200000, windows))
+        stream = io.BytesIO(b'x' * 10000000)
+        self.assertEqual(pool.from_stream(stream), 'application/vnd.ms-excel')
+        self.assertEqual(windows, [65536, 262144])
+        self.assertEqual(stream.tell(), 0)
+
+    def test_window_cap(self):
+        """ Test that no more than the configured number of bytes
+        is read into memory.
+        """
+        windows = []
+        pool = MagicPool(1, factory=lambda: WindowRecorder(10000000, windows))
+        sniffed_mimetype = pool.from_stream(io.BytesIO(b'x' * 10000000), 1000000)
+        self.assertTrue(sniffed_mimetype.startswith(CDFV2_CORRUPT))
+        self.assertEqual(windows, [65536, 262144, 1000000])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "Requires Linux ru_maxrss")
+    def test_peak_rss_is_flat(self):
+        """ Test that peak memory does not grow with file size,
+        both with and without a file descriptor.
+        """
+        with open("test/resources/example.xls", "rb") as sample_file:
+            header = sample_file.read(2048)
+        for use_descriptor in ('1', '0'):
+            peaks = []
+            for size in (16, 512):
+                with tempfile.NamedTemporaryFile(suffix='.xls') as large_file:
+                    large_file.write(header)
+                    large_file.truncate(size * 1024 * 1024)
+                    large_file.flush()
+                    output = subprocess.check_output([
+                        sys.executable, '-c', PEAK_RSS_SCRIPT,
+                        REPOSITORY_ROOT, large_file.name, use_descriptor])
+                peaks.append(int(output))
+            # ru_maxrss is in KiB; allow for noise, but nowhere near
+            # the 496 MiB difference in file size.
+            self.assertLess(peaks[1] - peaks[0], 32 * 1024, (use_descriptor, peaks))
+
+
+class TestContentViews(unittest.TestCase):
+    """ Test sniffing uploads in place rather than from copies.
+    """
+
+    def test_mapped_file(self):
+        pool = MagicPool(1)
+        with open("test/resources/example.doc", "rb") as sample_file:
+            content = sample_file.read()
+            sample_file.seek(0)
+            with head_view(sample_file) as head:
+                self.assertEqual(head, content[:2048])
+            self.assertEqual(sample_file.tell(), 0)
+            with content_view(sample_file) as view:
+                self.assertEqual(view, content)
+                self.assertEqual(pool.from_buffer(view), 'application/msword')
+            self.assertRaises(ValueError, len, view)
+
+    def test_in_memory(self):
+        stream = io.BytesIO(b'a,b\n1,2\n')
+        with head_view(stream, 4) as head:
+            self.assertIsInstance(head, memoryview)
+            self.assertEqual(head, b'a,b\n')
+            self.assertEqual(MagicPool(1).from_buffer(head), 'text/plain')
+        # the buffer is released, so the stream can grow again
+        stream.seek(0, os.SEEK_END)
+        stream.write(b'3,4\n')
+
+    def test_spooled_file(self):
+        """ Test that spooled uploads are viewed where they are,
+        without being rolled over to disk.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=1024) as stream:
+            stream.write(b'<?xml version="1.0"?><root/>\n')
+            stream.seek(0)
+            with head_view(stream) as head:
+                self.assertEqual(MagicPool(1).from_buffer(head), 'text/xml')
+            self.assertEqual(MagicPool(1).from_stream(stream), 'text/xml')
+            self.assertFalse(stream._rolled)
+            stream.seek(0, os.SEEK_END)
+            stream.write(b'x' * 2048)
+            stream.seek(0)
+            with content_view(stream) as view:
+                self.assertIsInstance(view, memoryview)
+                self.assertEqual(view[:5], b'<?xml')
+
+    def test_spooled_file_without_buffer(self):
+        """ Test that a spooled file is used as it is if it doesn't
+        keep its buffer where expected.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=1024) as stream:
+            self.assertIsInstance(_unspooled(stream), io.BytesIO)
+            buffer = stream._file
+            del stream._file
+            try:
+                self.assertIs(_unspooled(stream), stream)
+            finally:
+                stream._file = buffer
+
+    def test_unmappable(self):
+        """ Test that other streams are read and rewound.
+        """
+        with tempfile.TemporaryFile() as empty_file:
+            with head_view(empty_file) as head:
+                self.assertEqual(head, b'')
+        with open("test/resources/example.doc", "rb") as sample_file:
+            stream = io.BufferedReader(NoDescriptor(sample_file))
+            with head_view(stream, 4) as head:
+                self.assertEqual(head, b'\xd0\xcf\x11\xe0')
+            self.assertEqual(stream.tell(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+# encoding: utf-8
+
+'''Tests for gathering facts about uploads as they are stored.
+'''
+
+import hashlib
+import io
+import os
+import unittest
+from unittest import mock
+import zipfile
+
+if __name__ == '__main__':
+    from deferred import ERRORS_FIELD, STATUS_FIELD, STATUS_PENDING, record_stored_changes
+    from plugin import ResourceTypeValidationPlugin
+    from resource_type_validation import ResourceTypeValidator
+    from tee import TeeStream
+    from testing import upload_resource
+else:
+    from .deferred import ERRORS_FIELD, STATUS_FIELD, STATUS_PENDING, record_stored_changes
+    from .plugin import ResourceTypeValidationPlugin
+    from .resource_type_validation import ResourceTypeValidator
+    from .tee import TeeStream
+    from .testing import upload_resource
+
+from ckan.plugins import toolkit
+
+
+CONFIG = {
+    'ckan.site_url': 'http://ckan:5000/',
+    'ckanext.resource_validation.deferred_min_size': '10000',
+    'ckanext.resource_validation.upload_digests': 'true',
+}
+
+
+def _store(stream, chunk_size=1000):
+    ''' Read a stream as CKAN's uploader does: measure it, then copy it
+    from the start in chunks.
+    '''
+    stream.seek(0, os.SEEK_END)
+    stream.tell()
+    stream.seek(0, os.SEEK_SET)
+    stored = b''
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            return stored
+        stored += data
+
+
+def _saved(resource):
+    ''' The resource as shown once saved, without its upload.
+    '''
+    saved = {key: value for key, value in resource.items() if key != 'upload'}
+    saved.update({'id': 'abc', 'url': 'http://ckan:5000/dataset/x/resource/abc/download/' + resource['url'],
+                  'last_modified': '2024-01-01T00:00:00'})
+    return saved
+
+
+class TestTeeStream(unittest.TestCase):
+    '''Test the facts gathered from reads of the wrapped stream.'''
+
+    def test_single_pass(self):
+        content = bytes(range(1, 256)) * 100 + b'\x00' + b'x' * 20000
+        tee = TeeStream(io.BytesIO(content))
+        # eg sniffing the whole upload, then storing it
+        self.assertEqual(tee.read(), content)
+        tee.seek(0)
+        self.assertEqual(_store(tee), content)
+        summary = tee.summary()
+        self.assertEqual(summary.sha256, hashlib.sha256(content).hexdigest())
+        self.assertEqual(summary.size, len(content))
+        self.assertEqual(summary.head, content[:2048])
+        self.assertEqual(summary.tail, content[-16 * 1024:])
+        self.assertEqual(summary.first_null, 25500)
+
+        tee = TeeStream(io.BytesIO(content))
+        _store(tee, 4096)
+        self.assertEqual(tee.summary(), summary)
+
+    def test_incomplete(self):
+        tee = TeeStream(io.BytesIO(b'a,b\n1,2\n'))
+        tee.read(4)
+        self.assertIsNone(tee.summary())
+        # skipped bytes can't be digested afterwards
+        tee.seek(6)
+        tee.read()
+        self.assertIsNone(tee.summary())
+        tee.seek(0)
+        tee.read()
+        self.assertIsNone(tee.summary())
+
+
+class TestStoredUpload(unittest.TestCase):
+    '''Test the checks made from what was seen while storing an upload.'''
+
+    def setUp(self):
+        self.validator = ResourceTypeValidator(CONFIG)
+
+    def _store_upload(self, resource):
+        self.validator.validate_resource_mimetype(resource)
+        tee = self.validator.tee_upload(resource)
+        self.assertIs(resource['upload'].stream, tee)
+        content = _store(resource['upload'].stream)
+        return tee, content
+
+    def test_digest(self):
+        resource = upload_resource('example.csv', b'id,name\n1,example\n', 'CSV')
+        tee, content = self._store_upload(resource)
+        self.assertEqual(self.validator.check_stored_upload(_saved(resource), tee),
+                         {'hash': hashlib.sha256(content).hexdigest(), 'size': len(content)})
+
+        resource = upload_resource('example.csv', b'id,name\n1,example\n', 'CSV')
+        self.assertIsNone(ResourceTypeValidator({'ckan.site_url': 'http://ckan:5000/'}).tee_upload(resource))
+
+    def test_confirm_archive(self):
+        '''Test that a pending archive is confirmed from its last bytes.'''
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            for i in range(50):
+                zip_file.writestr('data/{}.csv'.format(i), os.urandom(500))
+        resource = upload_resource('example.zip', archive.getvalue(), 'ZIP')
+        tee, _ = self._store_upload(resource)
+        saved = _saved(resource)
+        self.assertEqual(saved[STATUS_FIELD], STATUS_PENDING)
+        changes = self.validator.check_stored_upload(saved, tee)
+        self.assertEqual(changes[STATUS_FIELD], 'confirmed')
+        # only what differs is changed
+        self.assertEqual(saved['mimetype'], 'application/zip')
+        self.assertNotIn('mimetype', changes)
+
+    def test_quarantine(self):
+        '''Test that binary content after a text header is quarantined.'''
+        resource = upload_resource('example.txt', b'hello world\n' * 1000 + b'\x00\x01\x02', 'TXT')
+        tee, _ = self._store_upload(resource)
+        saved = _saved(resource)
+        self.assertEqual(saved[STATUS_FIELD], STATUS_PENDING)
+        changes = self.validator.check_stored_upload(saved, tee)
+        self.assertEqual(changes[STATUS_FIELD], 'quarantined')
+        self.assertIn('upload', changes[ERRORS_FIELD])
+        self.assertIn('hash', changes)
+
+    def test_incomplete(self):
+        resource = upload_resource('example.csv', b'id,name\n1,example\n', 'CSV')
+        self.validator.validate_resource_mimetype(resource)
+        tee = self.validator.tee_upload(resource)
+        tee.read(4)
+        self.assertEqual(self.validator.check_stored_upload(_saved(resource), tee), {})
+
+
+class FakeActions:
+    """ Stands in for CKAN's actions, recording each call.
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.calls = []
+
+    def __call__(self, name):
+        def action(context, data_dict):
+            self.calls.append((name, data_dict))
+            return {'name': 'site-user'} if name == 'get_site_user' else self.resource
+        return action
+
+    def names(self):
+        return [name for name, _ in self.calls]
+
+
+class TestStoredUploadRecording(unittest.TestCase):
+    '''Test that what was seen while storing an upload is recorded
+    without updating its dataset again during the request.'''
+
+    def setUp(self):
+        self.plugin = ResourceTypeValidationPlugin()
+        self.plugin.configure(CONFIG)
+        self.jobs = []
+        self.plugin.enqueue_job = lambda *args, **kwargs: self.jobs.append(args)
+
+    def _create(self, resource):
+        context = {}
+        self.plugin.before_resource_create(context, resource)
+        content = _store(resource['upload'].stream)
+        saved = _saved(resource)
+        actions = FakeActions(saved)
+        with mock.patch.object(toolkit, 'get_action', actions):
+            self.plugin.after_resource_create(context, saved)
+        # no package_update, nor resource_patch calling it, within the request
+        self.assertEqual(actions.calls, [])
+        return saved, content
+
+    def test_single_upload(self):
+        saved, content = self._create(upload_resource('example.csv', b'id,name\n1,example\n', 'CSV'))
+        changes = {'hash': hashlib.sha256(content).hexdigest(), 'size': len(content)}
+        self.assertEqual(self.jobs, [(record_stored_changes, ['abc', changes, saved['last_modified']])])
+
+        actions = FakeActions(saved)
+        with mock.patch.object(toolkit, 'get_action', actions):
+            record_stored_changes('abc', changes, saved['last_modified'])
+        self.assertEqual(actions.names(), ['get_site_user', 'resource_show', 'resource_patch'])
+        self.assertEqual(actions.calls[-1][1], dict(changes, id='abc'))
+
+    def test_replaced(self):
+        '''Test that the checks of an upload since replaced are discarded.'''
+        saved, _ = self._create(upload_resource('example.csv', b'id,name\n1,example\n', 'CSV'))
+        actions = FakeActions(dict(saved, last_modified='2024-01-02T00:00:00'))
+        with mock.patch.object(toolkit, 'get_action', actions):
+            record_stored_changes(*self.jobs[0][1])
+        self.assertNotIn('resource_patch', actions.names())
+
+
+if __name__ == '__main__':
+    unittest.main()
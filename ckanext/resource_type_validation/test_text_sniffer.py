@@ -0,0 +1,161 @@
+# encoding: utf-8
+
+'''Tests for classifying text uploads by their structure.
+'''
+
+import io
+import json
+import unittest
+
+if __name__ == '__main__':
+    from resource_type_validation import ResourceTypeValidator
+    from testing import sample, upload_resource
+    from text_sniffer import TextClassifier
+else:
+    from .resource_type_validation import ResourceTypeValidator
+    from .testing import sample, upload_resource
+    from .text_sniffer import TextClassifier
+
+from ckan.logic import ValidationError
+
+CLASSIFIER_CONFIG = {
+    'uncertain_types': ['text/plain'],
+    'delimiters': {',': 'text/csv', '\t': 'text/tab-separated-values'},
+    'json_types': {'*': 'application/json', 'FeatureCollection': 'application/geo+json'},
+    'xml_roots': {'*': 'application/xml', 'kml': 'application/vnd.google-earth.kml+xml'},
+}
+
+
+class TrickleStream(io.RawIOBase):
+    """ Stream that returns at most three bytes per read,
+    so that text arrives split at awkward places.
+    """
+
+    def __init__(self, content):
+        self.content = io.BytesIO(content)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.content.read(min(len(buffer), 3))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class TestTextClassifier(unittest.TestCase):
+    '''Test recognition of delimited, JSON and XML text.'''
+
+    def setUp(self):
+        self.classifier = TextClassifier(CLASSIFIER_CONFIG)
+
+    def _classify(self, content, max_bytes=65536):
+        results = [self.classifier.classify(io.BytesIO(content), max_bytes),
+                   self.classifier.classify(TrickleStream(content), max_bytes)]
+        self.assertEqual(results[0], results[1])
+        return results[0]
+
+    def test_delimited(self):
+        self.assertEqual(self._classify(sample('foo.csv')), ['text/csv'])
+        self.assertEqual(self._classify(sample('fortran-bug.csv')), ['text/csv'])
+        self.assertEqual(self._classify(sample('Sample.tsv')), ['text/tab-separated-values'])
+        self.assertEqual(self._classify(b'a,b\r\n"c\r\nd",e\r\n\r\nf,g'), ['text/csv'])
+        # one record, one column, or ragged records are not enough
+        self.assertEqual(self._classify(b'a,b\n'), [])
+        self.assertEqual(self._classify(b'a\nb\nc\n'), [])
+        self.assertEqual(self._classify(b'a,b\nc,d,e\n'), [])
+        self.assertEqual(self._classify(sample('example.txt')), [])
+
+    def test_json(self):
+        self.assertEqual(self._classify(sample('sample.geojson')),
+                         ['application/geo+json', 'application/json'])
+        self.assertEqual(self._classify(json.dumps({'type': 'Topology', 'arcs': [[1, 2]]}).encode('utf-8')),
+                         ['application/json'])
+        self.assertEqual(self._classify(b'\xef\xbb\xbf [1, -2.5e3, "\\u00e9", {"a": null}]\n'), ['application/json'])
+        self.assertEqual(self._classify(b'{"a": 1,}'), [])
+        self.assertEqual(self._classify(b'[1, 2] 3'), [])
+        self.assertEqual(self._classify(b'{"a": [1, 2'), [])
+
+    def test_xml(self):
+        self.assertEqual(self._classify(sample('example.kml')),
+                         ['application/vnd.google-earth.kml+xml', 'application/xml'])
+        self.assertEqual(self._classify(sample('example.wfs')), ['application/xml'])
+        self.assertEqual(self._classify(b'\n<?xml version="1.0"?>\n<<'), [])
+
+    def test_not_text(self):
+        self.assertEqual(self._classify(b'a,b\nc,\x00\n'), [])
+        self.assertEqual(self._classify(b'a,b\nc,\xff\n'), [])
+        self.assertEqual(self._classify(b''), [])
+
+    def test_budget(self):
+        '''Test that classification stops once it is sure,
+        and that a valid start of a document is enough when the
+        budget runs out.
+        '''
+        content = b'id,name\n' + b'1,example\n' * 100000
+        stream = io.BytesIO(content)
+        self.assertEqual(self.classifier.classify(stream), ['text/csv'])
+        self.assertLess(stream.tell(), 65536)
+
+        content = json.dumps([{'id': i, 'name': 'example'} for i in range(10000)]).encode('utf-8')
+        self.assertEqual(self._classify(content, 1000), ['application/json'])
+        self.assertEqual(self._classify(content[:-1], len(content)), [])
+        self.assertEqual(self._classify(b'[' + b'1,' * 1000 + b'}', 1000), ['application/json'])
+        # a line cut short by the budget doesn't count against consistency
+        self.assertEqual(self._classify(b'a,b\nc,d\ne,f,g\n', 13), ['text/csv'])
+
+
+class TestTextSniffValidation(unittest.TestCase):
+    '''Test that text structure confirms the expected types
+    that libmagic is unsure about.'''
+
+    def setUp(self):
+        self.config = {
+            'ckan.site_url': 'http://ckan:5000/',
+            'ckanext.resource_validation.metrics': 'prometheus'}
+
+    def _validate(self, validator, filename, content, resource_format):
+        resource = upload_resource(filename, content, resource_format)
+        validator.validate_resource_mimetype(resource)
+        return resource
+
+    def test_confirmed(self):
+        validator = ResourceTypeValidator(self.config)
+        self.assertEqual(self._validate(validator, 'fortran-bug.csv', sample('fortran-bug.csv'), 'CSV')['mimetype'],
+                         'text/csv')
+        # libmagic's guess stands if the structure isn't clear
+        self.assertEqual(self._validate(validator, 'notes.csv', b'hello world\n', 'CSV')['mimetype'], 'text/csv')
+        # and is not checked if nothing more specific is expected
+        self._validate(validator, 'notes.txt', b'hello world\n', 'TXT')
+        self.assertEqual(validator.metrics.counters[('text_sniffs', (('result', 'confirmed'),))], 1)
+        self.assertEqual(validator.metrics.counters[('text_sniffs', (('result', 'unconfirmed'),))], 1)
+        self.assertEqual(validator.metrics.stage_durations['text_sniff'].count, 2)
+
+    def test_unconfirmed_override(self):
+        '''Test that CSV that the structure check can't confirm, eg
+        Latin-1 or semicolon-delimited, is still allowed to override
+        libmagic's guess of Fortran source.'''
+        validator = ResourceTypeValidator(self.config)
+        for filename in ('fortran-bug-latin1.csv', 'fortran-bug-semicolon.csv'):
+            self.assertEqual(self._validate(validator, filename, sample(filename), 'CSV')['mimetype'], 'text/csv')
+        self.assertEqual(validator.metrics.counters[('text_sniffs', (('result', 'unconfirmed'),))], 2)
+
+    def test_disabled(self):
+        self.config['ckanext.resource_validation.text_sniff_bytes'] = '0'
+        validator = ResourceTypeValidator(self.config)
+        self.assertEqual(self._validate(validator, 'fortran-bug.csv', sample('fortran-bug.csv'), 'CSV')['mimetype'],
+                         'text/csv')
+        self.assertNotIn(('text_sniffs', (('result', 'unconfirmed'),)), validator.metrics.counters)
+        self.assertRaises(ValidationError, self._validate, validator, 'notes.pdf', b'hello world\n', 'PDF')
+
+    def test_deferred(self):
+        '''Test that deferred uploads are checked from their first bytes.'''
+        self.config['ckanext.resource_validation.deferred_min_size'] = '1'
+        validator = ResourceTypeValidator(self.config)
+        resource = self._validate(validator, 'fortran-bug.csv', sample('fortran-bug.csv'), 'CSV')
+        self.assertEqual(resource['mimetype'], 'text/csv')
+        self.assertEqual(resource['upload'].stream.tell(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# encoding: utf-8
+
+'''Tests that the compiled type index agrees with a direct scan
+of the type configuration.
+'''
+
+import itertools
+import json
+import os
+import unittest
+
+if __name__ == '__main__':
+    from type_index import TypeIndex
+else:
+    from .type_index import TypeIndex
+
+TYPES_FILE = os.path.join(os.path.dirname(__file__), 'resources', 'resource_types.json')
+
+extra_types = [None, '', '*', 'text', 'text/*', 'image/png', 'text/html',
+               'application/pdf', 'foo/bar']
+
+allow_lists = ['*', 'application/pdf,text/xml', 'text/*,application/msword',
+               'application/CDFV2-unknown,application/x-sqlite3']
+
+
+class ReferenceTypes:
+    """ Uncompiled type relationships, scanning the configuration
+    on every call.
+    """
+
+    def __init__(self, equal_types, allowed_overrides):
+        self.equal_types = equal_types
+        self.allowed_overrides = allowed_overrides
+
+    def type_equals(self, type1, type2):
+        if type1 == type2:
+            return True
+        for type_list in self.equal_types:
+            if type1 in type_list and type2 in type_list:
+                return True
+        return False
+
+    def matches_override_list(self, mime_type, override_list):
+        for override_type in override_list:
+            if override_type == '*' or self.type_equals(override_type, mime_type):
+                return True
+            if mime_type:
+                override_parts = override_type.split('/', 1)
+                if len(override_parts) == 2 and override_parts[1] == '*'\
+                        and override_parts[0] == mime_type.split('/')[0]:
+                    return True
+        return False
+
+    def is_valid_override(self, mime_type1, mime_type2):
+        if self.type_equals(mime_type1, mime_type2):
+            return True, mime_type1
+        for generic_type, override_list in self.allowed_overrides.items():
+            if self.type_equals(generic_type, mime_type1)\
+                    and self.matches_override_list(mime_type2, override_list):
+                return True, mime_type2
+            if self.type_equals(generic_type, mime_type2)\
+                    and self.matches_override_list(mime_type1, override_list):
+                return True, mime_type1
+        return False, None
+
+    def is_mimetype_allowed(self, allowed_mime_types, mime_type):
+        for allowed_mime_type in allowed_mime_types:
+            if allowed_mime_type == '*'\
+                    or self.type_equals(allowed_mime_type, mime_type):
+                return True
+        return False
+
+
+def _config_types(config):
+    types = set(config.get('generic_types', []))
+    types.update(config.get('archive_types', []))
+    types.update(config.get('extra_mimetypes', {}).values())
+    for generic_type, override_list in config.get('allowed_overrides', {}).items():
+        types.add(generic_type)
+        types.update(override_list)
+    for type_list in config.get('equal_types', []):
+        types.update(type_list)
+    return sorted(types) + extra_types
+
+
+class TestTypeIndex(unittest.TestCase):
+    """ Test that every type relationship is answered the same way
+    by the compiled index and by scanning the configuration.
+    """
+
+    def assert_equivalent(self, config):
+        equal_types = config.get('equal_types', [])
+        allowed_overrides = config.get('allowed_overrides', {})
+        index = TypeIndex(equal_types, allowed_overrides)
+        reference = ReferenceTypes(equal_types, allowed_overrides)
+        types = _config_types(config)
+
+        for type1, type2 in itertools.product(types, repeat=2):
+            self.assertEqual(index.equals(type1, type2),
+                             reference.type_equals(type1, type2),
+                             (type1, type2))
+            self.assertEqual(index.valid_override(type1, type2),
+                             reference.is_valid_override(type1, type2),
+                             (type1, type2))
+
+        for allow_list in allow_lists:
+            allowed_mime_types = allow_list.split(',')
+            allowed_set = index.type_set(allowed_mime_types, prefixes=False)
+            for mime_type in types:
+                self.assertEqual(
+                    mime_type in allowed_set,
+                    reference.is_mimetype_allowed(allowed_mime_types, mime_type),
+                    (allow_list, mime_type))
+
+    def test_default_config(self):
+        """ Test every type pair from the built-in configuration.
+        """
+        with open(TYPES_FILE) as types_file:
+            self.assert_equivalent(json.load(types_file))
+
+    def test_overlapping_equal_types(self):
+        """ Test that equality is not made transitive across lists,
+        and that the first matching generic type wins.
+        """
+        self.assert_equivalent({
+            'equal_types': [['a/a', 'b/b'], ['b/b', 'c/c'], ['d/d', 'e/e']],
+            'allowed_overrides': {
+                'e/e': ['c/*', 'x/x'],
+                'b/b': ['d/d', 'f/*'],
+                'd/d': ['a/a', '*'],
+            },
+            'generic_types': ['x/*', 'f/f'],
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# encoding: utf-8
+
+'''Tests for hot reloading of the types file.
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+if __name__ == '__main__':
+    from resource_type_validation import ResourceTypeValidator
+    from testing import csv_resource
+    from type_policy import load_types_file
+else:
+    from .resource_type_validation import ResourceTypeValidator
+    from .testing import csv_resource
+    from .type_policy import load_types_file
+
+from ckan.logic import ValidationError
+
+TYPES_FILE = os.path.join(os.path.dirname(__file__), 'resources', 'resource_types.json')
+
+
+class ReplacingSniffer:
+    """ Sniffer that swaps in a new type policy part way through
+    a validation.
+    """
+
+    def __init__(self, validator, file_mime_config, sniffed_mimetype):
+        self.validator = validator
+        self.file_mime_config = file_mime_config
+        self.sniffed_mimetype = sniffed_mimetype
+
+    def from_buffer(self, buffer):
+        self.validator.replace_policy(self.file_mime_config)
+        return self.sniffed_mimetype
+
+
+class TestTypesFileReload(unittest.TestCase):
+    '''Test that types file changes reach the validator.'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.types_file = os.path.join(self.temp_dir, 'resource_types.json')
+        shutil.copy(TYPES_FILE, self.types_file)
+        self.validator = ResourceTypeValidator({
+            'ckan.site_url': 'http://ckan:5000/',
+            'ckanext.resource_validation.types_file': self.types_file,
+            'ckanext.resource_validation.types_file_poll_interval': '60',
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_types(self, content):
+        # replace the file as a deployment would, so the change is visible
+        # even within the file system's timestamp resolution
+        new_file = self.types_file + '.new'
+        with open(new_file, 'w') as types_file:
+            types_file.write(content)
+        os.replace(new_file, self.types_file)
+
+    def _check_now(self):
+        watcher = self.validator.types_file_watcher
+        watcher.next_check = 0
+        return watcher.check()
+
+    def test_reload_on_change(self):
+        '''Test that a changed types file replaces the policy.'''
+        old_policy = self.validator.policy
+        self.assertIsNone(self._check_now())
+
+        types = load_types_file(TYPES_FILE)
+        types['extra_mimetypes'] = {'.foo': 'text/plain'}
+        self._write_types(json.dumps(types))
+        self.validator.types_file_watcher.check()
+        self.assertIs(self.validator.policy, old_policy, "Checks should be rate limited")
+
+        thread = self._check_now()
+        thread.join()
+        self.assertIsNot(self.validator.policy, old_policy)
+        self.assertEqual(self.validator.policy.file_types.type_for_filename('example.foo'), 'text/plain')
+        self.assertIsNone(old_policy.file_types.type_for_filename('example.foo'))
+        self.assertIsNone(self._check_now())
+
+    def test_broken_file_keeps_policy(self):
+        '''Test that an invalid types file is ignored until fixed.'''
+        old_policy = self.validator.policy
+        self._write_types('{"allowed_overrides": ')
+        self._check_now().join()
+        self.assertIs(self.validator.policy, old_policy)
+        self.assertIsNone(self._check_now(), "Broken file should not be retried")
+
+        self._write_types('{}')
+        self._check_now().join()
+        self.assertIsNot(self.validator.policy, old_policy)
+        self.assertRaises(ValidationError, self.validator.validate_resource_mimetype, csv_resource())
+
+    def test_in_flight_validation_keeps_policy(self):
+        '''Test that a validation finishes with the policy it started with.'''
+        self.validator.sniffer = ReplacingSniffer(self.validator, {}, 'text/plain')
+        resource = csv_resource()
+        self.validator.validate_resource_mimetype(resource)
+        self.assertEqual(resource['mimetype'], 'text/csv')
+
+        # the empty policy doesn't let CSV override plain text
+        self.assertRaises(ValidationError, self.validator.validate_resource_mimetype, csv_resource())
+
+
+if __name__ == '__main__':
+    unittest.main()
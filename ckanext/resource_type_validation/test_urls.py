@@ -0,0 +1,89 @@
+# encoding: utf-8
+
+'''Tests for classifying resource URLs.
+'''
+
+import unittest
+
+if __name__ == '__main__':
+    from resource_type_validation import ResourceTypeValidator
+    from urls import FILENAME, LOCAL_DOWNLOAD, REMOTE, UrlClassifier
+else:
+    from .resource_type_validation import ResourceTypeValidator
+    from .urls import FILENAME, LOCAL_DOWNLOAD, REMOTE, UrlClassifier
+
+from ckan.logic import ValidationError
+
+
+class TestUrlClassifier(unittest.TestCase):
+    '''Test the kinds of resource URL.'''
+
+    def test_site_urls(self):
+        for site_url in ('http://ckan:5000', 'http://ckan:5000/', 'HTTPS://CKAN:5000'):
+            urls = UrlClassifier(site_url)
+            for url, kind in [
+                    ('http://ckan:5000/dataset/foo/resource/1234/download/example.csv', LOCAL_DOWNLOAD),
+                    ('https://CKAN:5000/dataset/foo/resource/1234/download', LOCAL_DOWNLOAD),
+                    ('http://ckan:5000/Dataset/foo/Resource/1234/Download/x.csv', LOCAL_DOWNLOAD),
+                    ('http://ckan:5000/dataset/foo', REMOTE),
+                    ('http://ckan:5000/dataset/foo/resource/1234', REMOTE),
+                    ('http://ckan:5000/dataset//resource/1234/download/x.csv', REMOTE),
+                    ('http://ckan:5001/dataset/foo/resource/1234/download/x.csv', REMOTE),
+                    ('http://example.com/dataset/foo/resource/1234/download/x.csv', REMOTE),
+                    ('HTTP://example.com/foo.csv', REMOTE),
+                    ('ftp://example.com/foo.csv', REMOTE),
+                    ('file:///tmp/foo.csv', REMOTE),
+                    ('example.csv', FILENAME),
+                    ('data:text/csv,a,b', FILENAME),
+                    ('C:\\Users\\example.csv', FILENAME),
+                    ('', FILENAME)]:
+                self.assertEqual(urls.classify(url), kind, "{} under {}".format(url, site_url))
+
+    def test_path_prefix_and_mirrors(self):
+        '''Test that site path prefixes and mirrors are honoured,
+        and that neither is interpreted as a pattern.
+        '''
+        urls = UrlClassifier('https://example.com/data+(portal)',
+                             ['https://cdn.example.com', 'http://mirror.example.com/ckan/'])
+        for url, kind in [
+                ('https://example.com/data+(portal)/dataset/foo/resource/1/download/x.csv', LOCAL_DOWNLOAD),
+                ('https://example.com/dataaaportal/dataset/foo/resource/1/download/x.csv', REMOTE),
+                ('https://example.com/dataset/foo/resource/1/download/x.csv', REMOTE),
+                ('https://cdn.example.com/dataset/foo/resource/1/download/x.csv', LOCAL_DOWNLOAD),
+                ('http://mirror.example.com/ckan/dataset/foo/resource/1/download/x.csv', LOCAL_DOWNLOAD),
+                ('http://mirror.example.com/dataset/foo/resource/1/download/x.csv', REMOTE)]:
+            self.assertEqual(urls.classify(url), kind, url)
+
+    def test_memoised(self):
+        urls = UrlClassifier('http://ckan:5000', cache_size=2)
+        for _ in range(3):
+            urls.classify('http://example.com/foo.csv')
+        self.assertEqual(urls.classify.cache_info().hits, 2)
+
+
+class TestLinkValidation(unittest.TestCase):
+    '''Test which resources without uploads are sanity-checked.'''
+
+    def setUp(self):
+        self.validator = ResourceTypeValidator({
+            'ckan.site_url': 'http://ckan:5000/',
+            'ckanext.resource_validation.mirror_urls': 'https://cdn.example.com'})
+
+    def test_download_links_checked(self):
+        for url in ('http://ckan:5000/dataset/foo/resource/1234/download/example.csv',
+                    'https://cdn.example.com/dataset/foo/resource/1234/download/example.csv'):
+            resource = {'url': url, 'format': 'PDF'}
+            self.assertRaises(ValidationError, self.validator.validate_resource_mimetype, resource)
+            resource['format'] = 'CSV'
+            self.validator.validate_resource_mimetype(resource)
+            self.assertEqual(resource['mimetype'], 'text/csv')
+
+    def test_remote_links_skipped(self):
+        resource = {'url': 'https://example.com/dataset/foo/resource/1234/download/example.csv',
+                    'format': 'PDF'}
+        self.validator.validate_resource_mimetype(resource)
+        self.assertIsNone(resource.get('mimetype'))
+
+
+if __name__ == '__main__':
+    unittest.main()
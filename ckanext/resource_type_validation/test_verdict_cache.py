@@ -0,0 +1,303 @@
+# encoding: utf-8
+
+'''Tests for caching of validation verdicts.
+'''
+
+from contextlib import contextmanager
+import io
+import multiprocessing
+import os
+import tempfile
+import unittest
+from unittest import mock
+import zipfile
+
+if __name__ == '__main__':
+    from resource_type_validation import ResourceTypeValidator
+    from testing import upload_resource
+    from verdict_cache import MemoryVerdictStore, RedisVerdictStore, \
+        SqliteVerdictStore, Verdict, VerdictCache, VerdictStore, build_verdict_cache
+else:
+    from .resource_type_validation import ResourceTypeValidator
+    from .testing import upload_resource
+    from .verdict_cache import MemoryVerdictStore, RedisVerdictStore, \
+        SqliteVerdictStore, Verdict, VerdictCache, VerdictStore, build_verdict_cache
+
+from ckan.logic import ValidationError
+
+
+class FakeRedis:
+    """ Local stand-in for a Redis client.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.expiry = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value.encode('utf-8')
+        self.expiry[key] = ex
+
+
+class CountingSniffer:
+    """ Wraps a sniffer to count how often it is called.
+    """
+
+    def __init__(self, sniffer, responses=None):
+        self.sniffer = sniffer
+        self.responses = list(responses or [])
+        self.calls = 0
+
+    def from_buffer(self, buffer):
+        self.calls += 1
+        if self.responses:
+            return self.responses.pop(0)
+        return self.sniffer.from_buffer(buffer)
+
+    def from_stream(self, stream, max_bytes):
+        self.calls += 1
+        if self.responses:
+            return self.responses.pop(0)
+        return self.sniffer.from_stream(stream, max_bytes)
+
+    @contextmanager
+    def lease(self):
+        yield self
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def _share_verdicts(store, worker):
+    """ Write verdicts from a worker process, reading back those of
+    the workers before it, and exit with an error on any mismatch.
+    """
+    for i in range(100):
+        store.set('{}-{}'.format(worker, i), Verdict('text/csv'))
+        if worker and store.get('{}-{}'.format(worker - 1, i)) not in (None, Verdict('text/csv')):
+            os._exit(1)
+
+
+class TestVerdictStores(unittest.TestCase):
+    """ Test the verdict storage backends.
+    """
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, VerdictStore)
+
+    def test_memory_lru_eviction(self):
+        """ Test that the least recently used verdict is evicted first.
+        """
+        store = MemoryVerdictStore(2)
+        store.set('a', Verdict('text/csv'))
+        store.set('b', Verdict('application/pdf'))
+        self.assertEqual(store.get('a'), Verdict('text/csv'))
+        store.set('c', Verdict('text/plain'))
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('a'), Verdict('text/csv'))
+        self.assertEqual(store.get('c'), Verdict('text/plain'))
+
+    def test_redis_round_trip(self):
+        """ Test that verdicts survive serialisation to a shared store.
+        """
+        client = FakeRedis()
+        store = RedisVerdictStore(client, ttl=60)
+        verdict = Verdict(None, {'upload': ['Mismatched file type']})
+        store.set('a', verdict)
+        self.assertEqual(store.get('a'), verdict)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(list(client.expiry.values()), [60])
+
+    def test_sqlite_lru_eviction(self):
+        """ Test that the least recently used verdicts are evicted,
+        and that the rest survive a restart.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'verdicts.sqlite3')
+            clock = FakeClock()
+            store = SqliteVerdictStore(path, 2, clock)
+            store.set('a', Verdict('text/csv'))
+            clock.now = 1
+            store.set('b', Verdict(None, {'upload': ['Mismatched file type']}))
+            clock.now = 100
+            self.assertEqual(store.get('a'), Verdict('text/csv'))
+            clock.now = 101
+            store.set('c', Verdict('text/plain'))
+            self.assertEqual(len(store), 2)
+            self.assertIsNone(store.get('b'))
+
+            store = SqliteVerdictStore(path, 2, clock)
+            self.assertEqual(store.get('a'), Verdict('text/csv'))
+            self.assertEqual(store.get('c'), Verdict('text/plain'))
+
+    def test_sqlite_shared_between_processes(self):
+        """ Test that verdicts written by one worker process are seen
+        by the others, including workers forked after the store was used.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = SqliteVerdictStore(os.path.join(temp_dir, 'verdicts.sqlite3'))
+            store.set('parent', Verdict('application/pdf'))
+            context = multiprocessing.get_context('fork')
+            workers = [context.Process(target=_share_verdicts, args=(store, worker)) for worker in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.assertEqual([worker.exitcode for worker in workers], [0] * 4)
+            self.assertEqual(len(store), 401)
+            self.assertEqual(store.get('3-99'), Verdict('text/csv'))
+
+    def test_sqlite_opened_on_first_use(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'verdicts.sqlite3')
+            store = SqliteVerdictStore(path)
+            self.assertFalse(os.path.exists(path))
+            self.assertIsNone(store.get('a'))
+            self.assertEqual(os.stat(path).st_mode & 0o077, 0)
+
+    def test_sqlite_owned_by_another_user(self):
+        """ Test that a database that another user could have
+        planted verdicts in is not used.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'verdicts.sqlite3')
+            SqliteVerdictStore(path).set('a', Verdict('text/csv'))
+            cache = VerdictCache(SqliteVerdictStore(path), 'abc')
+            with mock.patch('os.geteuid', return_value=os.stat(path).st_uid + 1):
+                with self.assertLogs(level='WARNING'):
+                    self.assertIsNone(cache.get('a'))
+
+    def test_sqlite_path(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = build_verdict_cache({'ckanext.resource_validation.verdict_cache': 'sqlite',
+                                         'ckan.storage_path': temp_dir}, 'abc')
+            self.assertEqual(os.path.dirname(cache.store.path), temp_dir)
+        self.assertRaises(ValueError, build_verdict_cache,
+                          {'ckanext.resource_validation.verdict_cache': 'sqlite'}, 'abc')
+
+    def test_key_components(self):
+        """ Test that each part of the key distinguishes verdicts.
+        """
+        cache = VerdictCache(MemoryVerdictStore(), 'abc')
+        key = cache.key('digest', 'foo.csv', 'CSV', None)
+        self.assertEqual(key, cache.key('digest', 'bar.csv', 'CSV', None))
+        for other_key in (cache.key('other', 'foo.csv', 'CSV', None),
+                          cache.key('digest', 'foo.txt', 'CSV', None),
+                          cache.key('digest', 'foo.csv.gz', 'CSV', None),
+                          cache.key('digest', 'foo.csv', 'TXT', None),
+                          cache.key('digest', 'foo.csv', 'CSV', 'text/csv'),
+                          VerdictCache(MemoryVerdictStore(), 'def').key(
+                              'digest', 'foo.csv', 'CSV', None)):
+            self.assertNotEqual(key, other_key)
+
+
+class TestCachedValidation(unittest.TestCase):
+    """ Test that repeated uploads reuse earlier verdicts.
+    """
+
+    def setUp(self):
+        self.validator = ResourceTypeValidator({
+            'ckan.site_url': 'http://ckan:5000/',
+            'ckanext.resource_validation.verdict_cache': 'memory'})
+
+    def test_cache_disabled_by_default(self):
+        self.assertIsNone(ResourceTypeValidator({}).verdict_cache)
+
+    def test_reuse_accepted_verdict(self):
+        """ Test that an identical re-upload is not sniffed again.
+        """
+        sniffer = CountingSniffer(self.validator.sniffer)
+        self.validator.sniffer = sniffer
+        with open("test/resources/example.txt", "rb") as sample_file:
+            content = sample_file.read()
+        for _ in range(3):
+            resource = upload_resource('example.txt', content, 'TXT')
+            self.validator.validate_resource_mimetype(resource)
+            self.assertEqual(resource['mimetype'], 'text/plain')
+        self.assertEqual(sniffer.calls, 1)
+
+    def test_reuse_rejected_verdict(self):
+        """ Test that a cached rejection is raised again.
+        """
+        sniffer = CountingSniffer(self.validator.sniffer)
+        self.validator.sniffer = sniffer
+        with open("test/resources/example.txt", "rb") as sample_file:
+            content = sample_file.read()
+        for _ in range(2):
+            resource = upload_resource('example.pdf', content, 'PDF')
+            self.assertRaises(ValidationError,
+                              self.validator.validate_resource_mimetype,
+                              resource)
+            self.assertIsNone(resource.get('mimetype'))
+        self.assertEqual(sniffer.calls, 1)
+
+    def test_format_change_is_not_a_hit(self):
+        """ Test that the same content with a different format
+        is validated from scratch.
+        """
+        sniffer = CountingSniffer(self.validator.sniffer)
+        self.validator.sniffer = sniffer
+        self.validator.validate_resource_mimetype(
+            upload_resource('foo.txt', b'hello world\n', 'TXT'))
+        self.validator.validate_resource_mimetype(
+            upload_resource('foo.txt', b'hello world\n', None))
+        self.assertEqual(sniffer.calls, 2)
+
+    def test_full_content_verdicts(self):
+        """ Test that verdicts needing the whole file are keyed on
+        the whole file, not just the sniffed prefix.
+        """
+        corrupt = 'Composite Document File V2 Document, corrupt'
+        self.validator.sniffer = CountingSniffer(
+            self.validator.sniffer,
+            [corrupt, 'text/plain', corrupt, 'application/pdf'])
+        prefix = b'x' * 4096
+        resource = upload_resource('foo.txt', prefix + b'one', 'TXT')
+        self.validator.validate_resource_mimetype(resource)
+        self.assertEqual(resource['mimetype'], 'text/plain')
+
+        # same prefix, different content, so the earlier verdict must not apply
+        resource = upload_resource('foo.txt', prefix + b'two', 'TXT')
+        self.assertRaises(ValidationError,
+                          self.validator.validate_resource_mimetype,
+                          resource)
+
+        # identical content is a hit on the full-content digest
+        resource = upload_resource('foo.txt', prefix + b'one', 'TXT')
+        self.validator.validate_resource_mimetype(resource)
+        self.assertEqual(resource['mimetype'], 'text/plain')
+        self.assertEqual(self.validator.sniffer.calls, 4)
+
+    def test_archive_verdicts(self):
+        """ Test that archive verdicts are keyed on the whole archive,
+        since the central directory lies beyond the sniffed prefix.
+        """
+        padding = os.urandom(4096)
+        valid_stream = io.BytesIO()
+        with zipfile.ZipFile(valid_stream, 'w', zipfile.ZIP_STORED) as archive:
+            archive.writestr('padding.bin', padding)
+            archive.writestr('[Content_Types].xml', '<Types/>')
+            archive.writestr('word/document.xml', '<document/>')
+        invalid_stream = io.BytesIO()
+        with zipfile.ZipFile(invalid_stream, 'w', zipfile.ZIP_STORED) as archive:
+            archive.writestr('padding.bin', padding)
+        self.assertEqual(valid_stream.getvalue()[:2048], invalid_stream.getvalue()[:2048])
+
+        resource = upload_resource('example.docx', valid_stream.getvalue(), 'DOCX')
+        self.validator.validate_resource_mimetype(resource)
+        self.assertRaises(ValidationError,
+                          self.validator.validate_resource_mimetype,
+                          upload_resource('example.docx', invalid_stream.getvalue(), 'DOCX'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+# encoding: utf-8
+
+'''Factories shared by the tests.
+'''
+
+import io
+
+from werkzeug.datastructures import FileStorage as FlaskFileStorage
+
+RESOURCES_DIR = 'test/resources/'
+
+
+def sample(filename):
+    ''' The contents of a file from the test resources.
+    '''
+    with open(RESOURCES_DIR + filename, 'rb') as sample_file:
+        return sample_file.read()
+
+
+def upload_resource(filename, content, resource_format):
+    ''' A resource with 'content' uploaded as 'filename'.
+    '''
+    return {'url': filename, 'format': resource_format,
+            'upload': FlaskFileStorage(filename=filename, stream=io.BytesIO(content))}
+
+
+def csv_resource():
+    ''' A small, valid CSV upload.
+    '''
+    return upload_resource('example.csv', b'a,b\n1,2\n', 'CSV')
@@ -0,0 +1,389 @@
+# encoding: utf-8
+""" Classification of text uploads from their structure, for when
+libmagic's guess from the first couple of kilobytes is unreliable,
+eg a short CSV file reported as Fortran source.
+
+The upload is read in chunks up to a byte budget, stopping as soon as
+the answer is clear: at the root element of an XML document, after
+enough consistently delimited records, or after the chunk holding a
+recognised top-level "type" of a JSON document. Other JSON is checked
+to its end or to the budget. The result is a list of candidate types,
+most specific first, or an empty list if the upload doesn't clearly
+have any of the configured structures.
+"""
+
+import codecs
+import csv
+import functools
+import itertools
+import json
+import re
+import typing
+from xml.etree.ElementTree import Element, ParseError, XMLPullParser
+
+DEFAULT_MAX_BYTES = 64 * 1024
+CHUNK_SIZE = 16 * 1024
+# consistently delimited records needed to stop before the end of the file
+CONFIDENT_RECORDS = 10
+# the key of the type for any JSON document or XML root element
+ANY = '*'
+
+_LINE = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)')
+_WHITESPACE = ' \t\r\n\ufeff'
+
+
+class _BudgetReader:
+    """ Reads a stream in chunks, stopping after 'max_bytes',
+    and notes whether there was more to read.
+    """
+
+    def __init__(self, stream: 'typing.IO[bytes]', max_bytes: int):
+        self.stream = stream
+        self.remaining = max_bytes
+        self.truncated = False
+
+    def chunks(self) -> 'typing.Iterator[bytes]':
+        while self.remaining > 0:
+            chunk = self.stream.read(min(CHUNK_SIZE, self.remaining))
+            if not chunk:
+                return
+            self.remaining -= len(chunk)
+            yield chunk
+        if not self.truncated:
+            self.truncated = bool(self.stream.read(1))
+
+    def texts(self, first: bytes) -> 'typing.Iterator[str]':
+        """ Decode UTF-8 chunks, starting with 'first';
+        raises UnicodeDecodeError if they aren't text.
+        """
+        decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        for chunk in itertools.chain([first], self.chunks()):
+            text = decoder.decode(chunk)
+            if '\x00' in text:
+                raise UnicodeDecodeError('utf-8', chunk, 0, len(chunk), "NUL in text")
+            yield text
+        if not self.truncated:
+            yield decoder.decode(b'', final=True)
+
+
+class TextClassifier:
+    """ The text structures to look for, from the 'text_sniffing'
+    section of a types file, eg
+
+        {
+          "uncertain_types": ["text/plain", "text/x-fortran"],
+          "delimiters": {",": "text/csv", "\\t": "text/tab-separated-values"},
+          "json_types": {"*": "application/json", "FeatureCollection": "application/geo+json"},
+          "xml_roots": {"*": "application/xml", "kml": "application/vnd.google-earth.kml+xml"}
+        }
+
+    'uncertain_types' are the libmagic guesses worth checking. JSON types
+    are keyed on the top-level "type" member, and XML types on the
+    local name of the root element.
+    """
+
+    def __init__(self, config: 'dict[str, typing.Any]'):
+        self.uncertain_types = frozenset(config.get('uncertain_types', ()))
+        self.delimiters: 'dict[str, str]' = dict(config.get('delimiters', {}))
+        self.json_types: 'dict[str, str]' = dict(config.get('json_types', {}))
+        self.xml_roots: 'dict[str, str]' = dict(config.get('xml_roots', {}))
+        # every type that classification can produce
+        self.types = frozenset(itertools.chain(
+            self.delimiters.values(), self.json_types.values(), self.xml_roots.values()))
+
+    def __bool__(self) -> bool:
+        return bool(self.uncertain_types and self.types)
+
+    def classify(self, stream: 'typing.IO[bytes]', max_bytes: int = DEFAULT_MAX_BYTES) -> 'list[str]':
+        """ Returns the candidate types for the text in 'stream',
+        reading no more than 'max_bytes' of it. The caller is
+        responsible for restoring the stream position.
+        """
+        reader = _BudgetReader(stream, max_bytes)
+        first = b''
+        start = ''
+        # read up to the first character that isn't whitespace
+        for chunk in reader.chunks():
+            first += chunk
+            start = first.decode('utf-8', 'ignore').lstrip(_WHITESPACE)[:1]
+            if start:
+                break
+        try:
+            if start == '<':
+                return self._classify_xml(reader, first)
+            if start in ('{', '['):
+                return self._classify_json(reader, first)
+            return self._classify_delimited(reader, first)
+        except UnicodeDecodeError:
+            return []
+
+    def _classify_xml(self, reader: _BudgetReader, first: bytes) -> 'list[str]':
+        if not self.xml_roots:
+            return []
+        parser: 'XMLPullParser[Element]' = XMLPullParser(events=('start',))
+        try:
+            # tolerate blank lines before the XML declaration, as libmagic does
+            for chunk in itertools.chain([first.lstrip(b' \t\r\n')], reader.chunks()):
+                parser.feed(chunk)
+                # only the start events asked for, which carry elements
+                events = typing.cast('typing.Iterator[tuple[str, Element]]', parser.read_events())
+                for _, element in events:
+                    return _candidates(self.xml_roots, element.tag.rpartition('}')[2])
+        except ParseError:
+            pass
+        return []
+
+    def _classify_json(self, reader: _BudgetReader, first: bytes) -> 'list[str]':
+        if not self.json_types:
+            return []
+        scanner = _JsonScanner()
+        for text in reader.texts(first):
+            if not scanner.feed(text):
+                return []
+            if scanner.type in self.json_types:
+                return _candidates(self.json_types, scanner.type)
+        if not scanner.finish(reader.truncated):
+            return []
+        return _candidates(self.json_types, scanner.type)
+
+    def _classify_delimited(self, reader: _BudgetReader, first: bytes) -> 'list[str]':
+        if not self.delimiters:
+            return []
+        lines = itertools.tee(_lines(reader, first), len(self.delimiters))
+        checks = [_DelimitedRecords(delimiter, delimiter_lines)
+                  for delimiter, delimiter_lines in zip(self.delimiters, lines)]
+        while True:
+            active = [check for check in checks if check.consistent]
+            if not active or len(active) == 1 and active[0].records >= CONFIDENT_RECORDS:
+                break
+            if not any([check.advance() for check in active]):
+                break
+        matches = [check for check in checks if check.consistent and check.records >= 2]
+        if len(matches) != 1:
+            return []
+        return [self.delimiters[matches[0].delimiter]]
+
+
+def _candidates(types: 'dict[str, str]', key: 'str|None') -> 'list[str]':
+    candidates = [types[name] for name in (key, ANY) if name in types]
+    return list(dict.fromkeys(candidates))
+
+
+def _lines(reader: _BudgetReader, first: bytes) -> 'typing.Iterator[str]':
+    """ Complete lines of text; a line cut short by the budget is dropped.
+    """
+    pending = ''
+    for text in reader.texts(first):
+        pending += text
+        end = 0
+        for match in _LINE.finditer(pending):
+            # a carriage return at the end may yet be followed by a line feed
+            if match.end() == len(pending) and pending.endswith('\r'):
+                break
+            yield match.group()
+            end = match.end()
+        pending = pending[end:]
+    if pending and not reader.truncated:
+        yield pending
+
+
+class _DelimitedRecords:
+    """ Whether the records read so far with 'delimiter'
+    all have the same number of fields, at least two.
+    """
+
+    def __init__(self, delimiter: str, lines: 'typing.Iterator[str]'):
+        self.delimiter = delimiter
+        self.reader: 'typing.Iterator[list[str]]|None' = csv.reader(lines, delimiter=delimiter, strict=True)
+        self.fields = 0
+        self.records = 0
+
+    @property
+    def consistent(self) -> bool:
+        return self.reader is not None
+
+    def advance(self) -> bool:
+        """ Read the next record; returns False at the end,
+        or once the records are inconsistent.
+        """
+        if self.reader is None:
+            return False
+        try:
+            record: 'list[str]|None' = next(self.reader)
+        except StopIteration:
+            return False
+        except csv.Error:
+            record = None
+        if record == []:
+            # blank line
+            return True
+        if record is not None and not self.fields:
+            self.fields = len(record)
+        if record is None or self.fields < 2 or len(record) != self.fields:
+            # drop the reader, so that nothing buffers lines for it
+            self.reader = None
+            return False
+        self.records += 1
+        return True
+
+
+_JSON_STRING = r'"(?:[^"\\\x00-\x1f]|\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4}))*"'
+_JSON_NUMBER = r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?'
+_JSON_SCALAR = '(?:{}|{}|true|false|null)'.format(_JSON_STRING, _JSON_NUMBER)
+# an array of scalars, eg coordinates
+_JSON_FLAT_ARRAY = r'\[[ \t\r\n]*(?:{0}(?:[ \t\r\n]*,[ \t\r\n]*{0})*[ \t\r\n]*)?\]'.format(_JSON_SCALAR)
+_JSON_SIMPLE_VALUE = '(?:{}|{})'.format(_JSON_SCALAR, _JSON_FLAT_ARRAY)
+_JSON_TOKEN = r'''[ \t\r\n]*(?:
+    (?P<array>{array})
+    | (?P<punctuation>[{{}}\[\]:,])
+    | (?P<string>{string})
+    | (?P<number>{number})
+    | (?P<literal>true|false|null)
+)'''.format(array=_JSON_FLAT_ARRAY, string=_JSON_STRING, number=_JSON_NUMBER)
+# Shortcuts for the bulk of most documents: an object member with a
+# simple value, and a run of simple array elements, each with the comma
+# that follows it, so that more must come before the end of the parent.
+_JSON_MEMBER = r'[ \t\r\n]*({})[ \t\r\n]*:[ \t\r\n]*({})[ \t\r\n]*,'.format(
+    _JSON_STRING, _JSON_SIMPLE_VALUE)
+_JSON_ELEMENTS = r'(?:[ \t\r\n]*{}[ \t\r\n]*,)+'.format(_JSON_SIMPLE_VALUE)
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+_PARTIAL_JSON_TOKEN = r'''[ \t\r\n]*(?:
+    "(?:[^"\\\x00-\x1f]|\\(?:["\\/bfnrt]|u[0-9a-fA-F]{0,4}))*\\?
+    | -?[0-9]*(?:\.[0-9]*)?(?:[eE][-+]?[0-9]*)?
+    | t(?:r(?:ue?)?)? | f(?:a(?:l(?:se?)?)?)? | n(?:u(?:ll?)?)?
+)'''
+
+
+class _JsonPatterns(typing.NamedTuple):
+    token: 'typing.Pattern[str]'
+    member: 'typing.Pattern[str]'
+    elements: 'typing.Pattern[str]'
+    partial_token: 'typing.Pattern[str]'
+
+
+@functools.lru_cache(maxsize=None)
+def _json_patterns() -> _JsonPatterns:
+    """ Compiled on first use rather than on import, since they are
+    large enough to add noticeably to startup.
+    """
+    return _JsonPatterns(re.compile(_JSON_TOKEN, re.VERBOSE), re.compile(_JSON_MEMBER),
+                         re.compile(_JSON_ELEMENTS), re.compile(_PARTIAL_JSON_TOKEN, re.VERBOSE))
+
+
+# what the scanner expects next
+_VALUE = 'value'
+_VALUE_OR_END = 'value_or_end'
+_KEY = 'key'
+_KEY_OR_END = 'key_or_end'
+_COLON = 'colon'
+_COMMA_OR_END = 'comma_or_end'
+_DONE = 'done'
+
+
+class _JsonScanner:
+    """ Incremental check of JSON syntax, fed text a chunk at a time,
+    noting the top-level "type" member of an object, if any.
+    """
+
+    def __init__(self):
+        self.stack: 'list[str]' = []
+        self.expecting = _VALUE
+        self.pending = ''
+        self.key: 'str|None' = None
+        self.type: 'str|None' = None
+        self.patterns = _json_patterns()
+
+    @property
+    def done(self) -> bool:
+        return self.expecting == _DONE
+
+    def feed(self, text: str) -> bool:
+        """ Scan the next chunk of text; returns False on a syntax error.
+        """
+        buffer = self.pending + text
+        position = 0
+        while True:
+            end = self._shortcut(buffer, position)
+            if end is not None:
+                position = end
+                continue
+            match = self.patterns.token.match(buffer, position)
+            # a number at the end may continue in the next chunk
+            if not match or match.lastgroup == 'number' and _NUMBER_TAIL.fullmatch(buffer, match.end()):
+                break
+            if not self._token(match.lastgroup, match.group(match.lastgroup)):
+                return False
+            position = match.end()
+        self.pending = buffer[position:]
+        return self.patterns.partial_token.fullmatch(self.pending) is not None
+
+    def finish(self, truncated: bool) -> bool:
+        """ Returns True if the text was valid JSON, or if it was cut
+        short by the budget, a valid start of some JSON.
+        """
+        if truncated:
+            return True
+        if self.pending.strip(_WHITESPACE):
+            if not self.feed(' ') or self.pending.strip(_WHITESPACE):
+                return False
+        return self.done
+
+    def _shortcut(self, buffer: str, position: int) -> 'int|None':
+        """ Scan a simple member or run of elements at 'position', if
+        that's what is expected there; returns where it ends.
+        """
+        if self.expecting in (_KEY, _KEY_OR_END):
+            match = self.patterns.member.match(buffer, position)
+            if match:
+                self._key(match.group(1))
+                self._value(match.group(2))
+                self.expecting = _KEY
+        elif self.expecting in (_VALUE, _VALUE_OR_END) and self.stack and self.stack[-1] == '[':
+            match = self.patterns.elements.match(buffer, position)
+            if match:
+                self.expecting = _VALUE
+        else:
+            return None
+        return match.end() if match else None
+
+    def _token(self, kind: str, token: str) -> bool:
+        expecting = self.expecting
+        if kind == 'punctuation':
+            return self._punctuation(token)
+        if expecting in (_KEY, _KEY_OR_END) and kind == 'string':
+            self._key(token)
+            self.expecting = _COLON
+            return True
+        if expecting in (_VALUE, _VALUE_OR_END):
+            self._value(token)
+            self._end_value()
+            return True
+        return False
+
+    def _key(self, token: str) -> None:
+        if len(self.stack) == 1:
+            self.key = json.loads(token)
+
+    def _value(self, token: str) -> None:
+        if len(self.stack) == 1 and self.stack[0] == '{' and self.key == 'type' and token.startswith('"'):
+            self.type = json.loads(token)
+
+    def _punctuation(self, token: str) -> bool:
+        expecting = self.expecting
+        if token in '{[' and expecting in (_VALUE, _VALUE_OR_END):
+            self.stack.append(token)
+            self.expecting = _KEY_OR_END if token == '{' else _VALUE_OR_END
+        elif token == ':' and expecting == _COLON:
+            self.expecting = _VALUE
+        elif token == ',' and expecting == _COMMA_OR_END:
+            self.expecting = _KEY if self.stack[-1] == '{' else _VALUE
+        elif token == '}' and expecting in (_KEY_OR_END, _COMMA_OR_END) and self.stack[-1] == '{' \
+                or token == ']' and expecting in (_VALUE_OR_END, _COMMA_OR_END) and self.stack[-1] == '[':
+            self.stack.pop()
+            self._end_value()
+        else:
+            return False
+        return True
+
+    def _end_value(self) -> None:
+        self.expecting = _COMMA_OR_END if self.stack else _DONE
@@ -0,0 +1,106 @@
+# encoding: utf-8
+""" Precompiled relationships between MIME types, so that equality,
+override and allow-list checks are set lookups rather than scans of
+the configuration.
+"""
+
+import typing
+
+
+class TypeSet:
+    """ A collection of MIME types, expanded to include all equal types.
+
+    '*' matches any type. If 'prefixes' is set, then 'prefix/*'
+    also matches any type with that prefix.
+    """
+
+    def __init__(self, index: 'TypeIndex', types: 'typing.Iterable[str]', prefixes: bool = True):
+        self.any_type = False
+        exact: 'set[str|None]' = set()
+        wildcard_prefixes: 'set[str]' = set()
+        for mime_type in types:
+            if mime_type == '*':
+                self.any_type = True
+            exact.update(index.equivalents(mime_type))
+            if prefixes:
+                parts = mime_type.split('/', 1)
+                if len(parts) == 2 and parts[1] == '*':
+                    wildcard_prefixes.add(parts[0])
+        self.exact = frozenset(exact)
+        self.prefixes = frozenset(wildcard_prefixes)
+
+    def __contains__(self, mime_type: 'str|None') -> bool:
+        if self.any_type or mime_type in self.exact:
+            return True
+        return bool(mime_type and self.prefixes
+                    and mime_type.split('/')[0] in self.prefixes)
+
+
+class TypeIndex:
+    """ Compiled form of the 'equal_types' and 'allowed_overrides'
+    configuration.
+
+    Types are equal if they are identical or share a list in
+    'equal_types'. As with the configuration itself, this relation is
+    not transitive across different lists.
+    """
+
+    def __init__(self, equal_types: 'list[list[str]]',
+                 allowed_overrides: 'dict[str, list[str]]'):
+        # map each type to the ids of the equal_types lists containing it
+        classes: 'dict[str, set[int]]' = {}
+        for class_id, type_list in enumerate(equal_types):
+            for mime_type in type_list:
+                classes.setdefault(mime_type, set()).add(class_id)
+        members: 'dict[int, set[str]]' = {}
+        for mime_type, class_ids in classes.items():
+            for class_id in class_ids:
+                members.setdefault(class_id, set()).add(mime_type)
+        self._classes: 'dict[str|None, frozenset[int]]' = {
+            mime_type: frozenset(class_ids) for mime_type, class_ids in classes.items()}
+        self._equivalents: 'dict[str|None, frozenset[str|None]]' = {
+            mime_type: frozenset().union(*(members[class_id] for class_id in class_ids))
+            for mime_type, class_ids in classes.items()}
+
+        # Overrides are checked in configuration order, so keep each
+        # generic type's position as well as its compiled subtypes.
+        self._override_sets = [TypeSet(self, override_list)
+                               for override_list in allowed_overrides.values()]
+        generic_ids: 'dict[str|None, list[int]]' = {}
+        for generic_id, generic_type in enumerate(allowed_overrides):
+            for mime_type in self.equivalents(generic_type):
+                generic_ids.setdefault(mime_type, []).append(generic_id)
+        self._generic_ids: 'dict[str|None, frozenset[int]]' = {
+            mime_type: frozenset(ids) for mime_type, ids in generic_ids.items()}
+
+    def equivalents(self, mime_type: 'str|None') -> 'frozenset[str|None]':
+        """ Returns all types that are equal to 'mime_type', including itself.
+        """
+        return self._equivalents.get(mime_type) or frozenset((mime_type,))
+
+    def equals(self, type1: 'str|None', type2: 'str|None') -> bool:
+        if type1 == type2:
+            return True
+        classes1 = self._classes.get(type1)
+        return bool(classes1 and classes1.intersection(self._classes.get(type2, ())))
+
+    def is_generic(self, mime_type: 'str|None') -> bool:
+        """ Returns True if more specific types can override 'mime_type'.
+        """
+        return mime_type in self._generic_ids
+
+    def valid_override(self, mime_type1: 'str|None', mime_type2: 'str|None') -> 'tuple[bool, str|None]':
+        if self.equals(mime_type1, mime_type2):
+            return True, mime_type1
+        generics1 = self._generic_ids.get(mime_type1, frozenset())
+        generics2 = self._generic_ids.get(mime_type2, frozenset())
+        for generic_id in sorted(generics1 | generics2):
+            override_set = self._override_sets[generic_id]
+            if generic_id in generics1 and mime_type2 in override_set:
+                return True, mime_type2
+            if generic_id in generics2 and mime_type1 in override_set:
+                return True, mime_type1
+        return False, None
+
+    def type_set(self, types: 'typing.Iterable[str]', prefixes: bool = True) -> TypeSet:
+        return TypeSet(self, types, prefixes)
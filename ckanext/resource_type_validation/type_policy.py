@@ -0,0 +1,165 @@
+# encoding: utf-8
+""" The type policy compiled from the types file, and hot reloading of it.
+
+A TypePolicy is immutable once built, so a validation that starts with
+one policy can finish with it even if the types file changes meanwhile.
+A TypesFileWatcher polls the file's metadata and, when it changes,
+compiles a replacement policy in a background thread, which the
+validator then swaps in with a single assignment.
+"""
+
+import json
+from logging import getLogger
+import os
+import threading
+import time
+import typing
+
+from .extension_index import ExtensionIndex
+from .file_types import FileTypeRegistry
+from .profiles import ProfileSelector
+from .signatures import SignatureTable
+from .text_sniffer import TextClassifier
+from .type_index import TypeIndex
+from .verdict_cache import VerdictCache
+
+LOG = getLogger(__name__)
+
+
+def load_types_file(path: str) -> 'dict[str, typing.Any]':
+    with open(path) as types_file:
+        return json.load(types_file)
+
+
+class CompiledTypes:
+    """ The parts of a type policy that depend only on the types file,
+    so that the file can be checked without a full policy; see policy_check.
+    """
+
+    def __init__(self, file_mime_config: 'dict[str, typing.Any]'):
+        # Add allowed upload types that don't seem to be standard,
+        # without affecting anything else in the process.
+        self.file_types = FileTypeRegistry(file_mime_config.get('extra_mimetypes', {}))
+
+        allowed_extensions = file_mime_config.get('allowed_extensions', [])
+        if allowed_extensions:
+            LOG.debug("Allowed file extensions: %s", allowed_extensions)
+        self.extensions = ExtensionIndex(allowed_extensions, file_mime_config.get('extension_policies', {}))
+
+        self.allowed_overrides: 'dict[str, list[str]]' = file_mime_config.get('allowed_overrides', {})
+        self.equal_types: 'list[list[str]]' = file_mime_config.get('equal_types', [])
+        self.archive_mimetypes: 'list[str]' = file_mime_config.get('archive_types', [])
+        self.archive_members: 'dict[str, list[str]]' = file_mime_config.get('archive_members', {})
+        self.signatures = SignatureTable(file_mime_config.get('signatures', {}))
+        self.text_types = TextClassifier(file_mime_config.get('text_sniffing', {}))
+        self.generic_mimetypes: 'list[str]' = list(file_mime_config.get(
+            'generic_types', self.allowed_overrides.keys()))
+        self.type_index = TypeIndex(self.equal_types, self.allowed_overrides)
+        self.profiles = ProfileSelector(file_mime_config.get('profiles', {}))
+
+
+class TypePolicy:
+    """ Type relationships and allowed types from a types file,
+    compiled for fast lookups.
+    """
+
+    def __init__(self, file_mime_config: 'dict[str, typing.Any]', allowed_mime_types: 'list[str]',
+                 verdict_cache: 'VerdictCache|None' = None, fingerprint: str = ''):
+        compiled = CompiledTypes(file_mime_config)
+        self.file_types = compiled.file_types
+        self.extensions = compiled.extensions
+        self.allowed_overrides = compiled.allowed_overrides
+        self.equal_types = compiled.equal_types
+        self.archive_mimetypes = compiled.archive_mimetypes
+        self.archive_members = compiled.archive_members
+        self.signatures = compiled.signatures
+        self.text_types = compiled.text_types
+        self.generic_mimetypes = compiled.generic_mimetypes
+        self.type_index = compiled.type_index
+        self.profiles = compiled.profiles
+        self.file_mime_config = file_mime_config
+
+        self.allowed_mime_type_set = self.type_index.type_set(
+            allowed_mime_types, prefixes=False)
+        self.verdict_cache = verdict_cache
+        # identifies everything besides the resource that affects a verdict
+        self.fingerprint = fingerprint
+        self._may_be_archive: 'dict[str|None, bool]' = {}
+
+    def may_be_archive(self, filename_mimetype: 'str|None') -> bool:
+        """ Returns True if a file with this extension type could be
+        accepted as an archive, depending on its contents.
+        """
+        result = self._may_be_archive.get(filename_mimetype)
+        if result is None:
+            result = self._may_be_archive[filename_mimetype] = any(
+                self.type_index.valid_override(filename_mimetype, archive_type)[0]
+                for archive_type in self.archive_mimetypes)
+        return result
+
+
+Signature = typing.Tuple[int, int, int]
+
+
+class TypesFileWatcher:
+    """ Notices changes to a types file, checking its metadata
+    at most once per 'interval' seconds.
+
+    Checks are made by the validator as it works, rather than by a
+    thread of our own, so that they continue in forked web workers.
+    """
+
+    def __init__(self, path: str, interval: float,
+                 on_change: 'typing.Callable[[dict[str, typing.Any]], None]',
+                 clock: 'typing.Callable[[], float]' = time.monotonic):
+        self.path = path
+        self.interval = interval
+        self.on_change = on_change
+        self.clock = clock
+        self.signature = self._signature()
+        self.next_check = clock() + interval
+        self._lock = threading.Lock()
+        self._reloading = False
+
+    def _signature(self) -> 'Signature|None':
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            LOG.warning("Unable to check types file %s: %s", self.path, e)
+            return None
+        # the inode changes when a new file is moved into place
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def check(self) -> 'threading.Thread|None':
+        """ Start reloading the types file in the background if it has
+        changed since it was last loaded and the interval has passed.
+
+        Returns the thread doing the reload, if any.
+        """
+        now = self.clock()
+        if now < self.next_check or self._reloading:
+            return None
+        with self._lock:
+            if now < self.next_check or self._reloading:
+                return None
+            self.next_check = now + self.interval
+            signature = self._signature()
+            if signature is None or signature == self.signature:
+                return None
+            self._reloading = True
+        thread = threading.Thread(target=self._reload, args=(signature,),
+                                  name='resource-types-reload', daemon=True)
+        thread.start()
+        return thread
+
+    def _reload(self, signature: Signature) -> None:
+        try:
+            self.on_change(load_types_file(self.path))
+            LOG.info("Reloaded types file %s", self.path)
+        except Exception as e:
+            LOG.error("Unable to reload types file %s; keeping the previous configuration: %s",
+                      self.path, e)
+        finally:
+            # a broken file is retried only once it changes again
+            self.signature = signature
+            self._reloading = False
@@ -0,0 +1,62 @@
+# encoding: utf-8
+""" Classification of resource URLs, to decide whether a resource
+without an upload in progress refers to an earlier upload.
+
+A URL is parsed once, and its host and path compared with those of the
+site URL and any mirrors, so that neither the site URL nor the resource
+URL is ever treated as a regular expression.
+"""
+
+import functools
+import typing
+from urllib.parse import urlsplit
+
+# URL kinds
+LOCAL_DOWNLOAD = 'local_download'  # download link for an upload to this site
+REMOTE = 'remote'  # link to somewhere else
+FILENAME = 'filename'  # bare filename or path, as stored for uploads
+
+DEFAULT_CACHE_SIZE = 10000
+
+
+def _base(url: str) -> 'tuple[str, str]':
+    """ Returns the host and path prefix of a base URL.
+    """
+    parts = urlsplit(url.strip())
+    return parts.netloc.lower(), parts.path.rstrip('/')
+
+
+class UrlClassifier:
+    """ Sorts resource URLs into local download links, remote links,
+    and bare filenames, remembering recent answers.
+    """
+
+    def __init__(self, site_url: str, mirror_urls: 'typing.Iterable[str]' = (),
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        # download links may use any of these hosts, under their own path prefixes
+        self.path_prefixes: 'dict[str, set[str]]' = {}
+        for base_url in [site_url] + list(mirror_urls):
+            if base_url:
+                host, prefix = _base(base_url)
+                self.path_prefixes.setdefault(host, set()).add(prefix)
+        self.classify = functools.lru_cache(maxsize=cache_size)(self._classify)
+
+    def _classify(self, url: str) -> str:
+        parts = urlsplit(url)
+        if not parts.scheme or not url[len(parts.scheme) + 1:].startswith('//'):
+            return FILENAME
+        prefixes = self.path_prefixes.get(parts.netloc.lower())
+        if prefixes and any(_is_download_path(parts.path, prefix) for prefix in prefixes):
+            return LOCAL_DOWNLOAD
+        return REMOTE
+
+
+def _is_download_path(path: str, prefix: str) -> bool:
+    """ Returns True if 'path' is a resource download path under 'prefix',
+    ie '{prefix}/{dataset type}/{dataset}/resource/{id}/download[/...]'
+    """
+    if not path.startswith(prefix + '/'):
+        return False
+    segments = path[len(prefix) + 1:].split('/', 5)
+    return len(segments) >= 5 and all(segments[:2]) and segments[2].lower() == 'resource' \
+        and bool(segments[3]) and segments[4].lower() == 'download'
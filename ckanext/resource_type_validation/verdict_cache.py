@@ -0,0 +1,295 @@
+# encoding: utf-8
+""" Cache of validation verdicts for uploads that have been seen before,
+so that identical re-uploads need not be sniffed and coalesced again.
+
+Verdicts are keyed on a digest of the sniffed content, the parts of the
+filename that affect its guessed type, the resource format and claimed
+MIME type, and a fingerprint of the validation configuration.
+"""
+
+import abc
+from collections import OrderedDict
+import hashlib
+import json
+from logging import getLogger
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+LOG = getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 86400
+# name of the 'sqlite' cache's database under ckan.storage_path, by default
+DEFAULT_CACHE_FILE = 'resource_type_validation_verdicts.sqlite3'
+# seconds to wait for another process to finish writing
+SQLITE_TIMEOUT = 1.0
+# seconds between recording the use of a verdict, so that hits rarely write
+SQLITE_TOUCH_INTERVAL = 60
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class Verdict(typing.NamedTuple):
+    """ The outcome of validating a resource.
+
+    'mimetype' is the type assigned to the resource, if any, and
+    'errors' is the ValidationError content if it was rejected.
+    'full_content' marks a verdict that depends on more than the
+    sniffed prefix, and must be looked up by a full-content digest.
+    """
+    mimetype: 'str|None' = None
+    errors: 'dict[str, typing.Any]|None' = None
+    full_content: bool = False
+
+    def to_json(self) -> str:
+        return json.dumps(self._asdict())
+
+    @classmethod
+    def from_json(cls, value: 'str|bytes') -> 'Verdict':
+        return cls(**json.loads(value))
+
+
+NEEDS_FULL_CONTENT = Verdict(full_content=True)
+
+
+class VerdictStore(abc.ABC):
+    """ Storage backend for verdicts.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str) -> 'Verdict|None':
+        """ Returns the verdict stored under 'key', if any.
+        """
+
+    @abc.abstractmethod
+    def set(self, key: str, verdict: Verdict) -> None:
+        """ Store 'verdict' under 'key'.
+        """
+
+
+class MemoryVerdictStore(VerdictStore):
+    """ In-process store that evicts the least recently used verdict
+    once 'max_entries' is reached.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, Verdict]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> 'Verdict|None':
+        with self._lock:
+            verdict = self._entries.get(key)
+            if verdict is not None:
+                self._entries.move_to_end(key)
+            return verdict
+
+    def set(self, key: str, verdict: Verdict) -> None:
+        with self._lock:
+            self._entries[key] = verdict
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class RedisVerdictStore(VerdictStore):
+    """ Store shared between processes and hosts via Redis.
+
+    Entries expire after 'ttl' seconds; overall size is capped by the
+    server's own 'maxmemory' eviction policy.
+    """
+
+    key_prefix = 'ckanext-resource-type-validation:verdict:'
+
+    def __init__(self, client: typing.Any = None, ttl: int = DEFAULT_CACHE_TTL):
+        self._client = client
+        self.ttl = ttl
+
+    @property
+    def client(self) -> typing.Any:
+        if self._client is None:
+            from ckan.lib.redis import connect_to_redis
+            self._client = connect_to_redis()
+        return self._client
+
+    def get(self, key: str) -> 'Verdict|None':
+        value = self.client.get(self.key_prefix + key)
+        return None if value is None else Verdict.from_json(value)
+
+    def set(self, key: str, verdict: Verdict) -> None:
+        self.client.set(self.key_prefix + key, verdict.to_json(), ex=self.ttl)
+
+
+def _check_owner(path: str) -> None:
+    """ Create the database at 'path' if need be, readable only by us,
+    and refuse one that belongs to another user, who could have planted
+    verdicts in it.
+    """
+    descriptor = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    try:
+        owner = os.fstat(descriptor).st_uid
+    finally:
+        os.close(descriptor)
+    if hasattr(os, 'geteuid') and owner != os.geteuid():
+        raise PermissionError("Verdict cache {} is owned by another user".format(path))
+
+
+class SqliteVerdictStore(VerdictStore):
+    """ Store shared between the processes on one host via a SQLite
+    database on local disk, which survives restarts. The database is
+    opened on first use, and must belong to the user running CKAN.
+
+    The database uses write-ahead logging, so readers wait neither for
+    each other nor for the single writer. Once 'max_entries' is
+    exceeded, the least recently used verdicts are evicted; each
+    process checks this after every hundredth of 'max_entries' writes,
+    so the store can briefly hold a little more.
+    """
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_CACHE_SIZE,
+                 clock: 'typing.Callable[[], float]' = time.time):
+        self.path = path
+        self.max_entries = max_entries
+        self.clock = clock
+        self.prune_interval = max(1, max_entries // 100)
+        self._writes = 0
+        self._created = False
+        self._local = threading.local()
+        # connections inherited from a parent process, which must never
+        # be closed here, lest the parent's locks or log be disturbed
+        self._inherited: 'list[sqlite3.Connection]' = []
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT count(*) FROM verdicts').fetchone()[0]
+
+    def _connection(self) -> sqlite3.Connection:
+        """ A connection for the current thread. Connections are not
+        carried across a fork, so a worker forked from a process that
+        used the store opens its own.
+        """
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            if hasattr(local, 'connection'):
+                self._inherited.append(local.connection)
+                del local.connection
+            _check_owner(self.path)
+            connection = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+            if not self._created:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('CREATE TABLE IF NOT EXISTS verdicts ('
+                                   'key TEXT PRIMARY KEY, verdict TEXT NOT NULL, used INTEGER NOT NULL)')
+                connection.execute('CREATE INDEX IF NOT EXISTS verdicts_used ON verdicts (used)')
+                self._created = True
+            connection.execute('PRAGMA synchronous=NORMAL')
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    def get(self, key: str) -> 'Verdict|None':
+        connection = self._connection()
+        row = connection.execute('SELECT verdict, used FROM verdicts WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        now = int(self.clock())
+        if now - row[1] >= SQLITE_TOUCH_INTERVAL:
+            connection.execute('UPDATE verdicts SET used = ? WHERE key = ?', (now, key))
+        return Verdict.from_json(row[0])
+
+    def set(self, key: str, verdict: Verdict) -> None:
+        connection = self._connection()
+        connection.execute('INSERT OR REPLACE INTO verdicts (key, verdict, used) VALUES (?, ?, ?)',
+                           (key, verdict.to_json(), int(self.clock())))
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            connection.execute('DELETE FROM verdicts WHERE key IN ('
+                               'SELECT key FROM verdicts ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                               (self.max_entries,))
+
+
+def type_suffix(filename: str) -> str:
+    """ The part of a filename that can affect its guessed type,
+    ie an extension plus an optional encoding extension like '.gz'.
+    """
+    name = os.path.basename(filename)
+    return ''.join(os.path.splitext(part)[1] for part in (os.path.splitext(name)[0], name))
+
+
+def content_digest(data: 'bytes|memoryview') -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def stream_digest(stream: 'typing.IO[bytes]') -> str:
+    """ Digest the remainder of 'stream' without holding it in memory.
+    The caller is responsible for restoring the stream position.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(READ_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class VerdictCache:
+    """ Builds verdict keys and delegates storage to a backend.
+    """
+
+    def __init__(self, store: VerdictStore, fingerprint: str):
+        self.store = store
+        self.fingerprint = fingerprint
+
+    def key(self, digest: str, filename: str,
+            resource_format: 'str|None', claimed_mimetype: 'str|None') -> str:
+        return content_digest(json.dumps(
+            [digest, type_suffix(filename), resource_format,
+             claimed_mimetype, self.fingerprint]).encode('utf-8'))
+
+    def get(self, key: str) -> 'Verdict|None':
+        try:
+            return self.store.get(key)
+        except Exception as e:
+            LOG.warning("Unable to read verdict cache: %s", e)
+            return None
+
+    def set(self, key: str, verdict: Verdict) -> None:
+        try:
+            self.store.set(key, verdict)
+        except Exception as e:
+            LOG.warning("Unable to write verdict cache: %s", e)
+
+
+def _sqlite_cache_path(config: typing.Any) -> str:
+    path = config.get('ckanext.resource_validation.verdict_cache_path')
+    if path:
+        return path
+    storage_path = config.get('ckan.storage_path')
+    if not storage_path:
+        raise ValueError("The 'sqlite' verdict cache needs ckanext.resource_validation.verdict_cache_path"
+                         " or ckan.storage_path to be set")
+    return os.path.join(storage_path, DEFAULT_CACHE_FILE)
+
+
+def build_verdict_cache(config: typing.Any, fingerprint: str) -> 'VerdictCache|None':
+    """ Construct the configured verdict cache, if any.
+    """
+    backend = config.get('ckanext.resource_validation.verdict_cache', 'none')
+    store: VerdictStore
+    if backend == 'memory':
+        store = MemoryVerdictStore(int(config.get(
+            'ckanext.resource_validation.verdict_cache_size', DEFAULT_CACHE_SIZE)))
+    elif backend == 'sqlite':
+        store = SqliteVerdictStore(
+            _sqlite_cache_path(config),
+            int(config.get('ckanext.resource_validation.verdict_cache_size', DEFAULT_CACHE_SIZE)))
+    elif backend == 'redis':
+        store = RedisVerdictStore(ttl=int(config.get(
+            'ckanext.resource_validation.verdict_cache_ttl', DEFAULT_CACHE_TTL)))
+    elif backend in ('none', '', None):
+        return None
+    else:
+        raise ValueError("Unknown verdict cache backend: {}".format(backend))
+    LOG.debug("Caching validation verdicts in %s", backend)
+    return VerdictCache(store, fingerprint)
@@ -0,0 +1,34 @@
+# encoding: utf-8
+""" Web endpoints for resource type validation.
+"""
+
+from flask import Blueprint, Response
+
+from ckan import plugins
+from ckan.plugins import toolkit
+
+from .metrics import PrometheusRegistry
+from .resource_type_validation import ResourceTypeValidator
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+blueprint = Blueprint('resource_type_validation', __name__)
+
+
+def metrics():
+    """ Expose validation metrics in the Prometheus text format,
+    if the 'prometheus' metrics backend is enabled.
+    """
+    validator: 'ResourceTypeValidator|None' = getattr(
+        plugins.get_plugin('resource_type_validation'), 'validator', None)
+    registry = validator.metrics if validator else None
+    if not isinstance(registry, PrometheusRegistry):
+        return toolkit.abort(404)
+    return Response(registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+blueprint.add_url_rule('/resource-type-validation/metrics', view_func=metrics)
+
+
+def get_blueprints() -> 'list[Blueprint]':
+    return [blueprint]
@@ -0,0 +1,89 @@
+# encoding: utf-8
+""" Micro-benchmark of per-upload sniffing cost, comparing a fresh
+libmagic handle per upload with the pooled sniffer, and sniffing the
+start of in-memory uploads from a copy with sniffing them in place.
+
+Run from the repository root:
+
+    python test/benchmarks/bench_sniffer.py [iterations]
+"""
+
+import io
+import os
+import sys
+import timeit
+import tracemalloc
+
+import magic
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from ckanext.resource_type_validation.sniffer import HEAD_SIZE, MagicPool, head_view  # noqa: E402
+
+RESOURCES_DIR = os.path.join(os.path.dirname(__file__), '..', 'resources')
+
+
+def sample_paths() -> 'list[str]':
+    paths = [os.path.join(RESOURCES_DIR, filename) for filename in sorted(os.listdir(RESOURCES_DIR))]
+    return [path for path in paths if os.path.isfile(path) and os.path.getsize(path)]
+
+
+def load_samples() -> 'list[bytes]':
+    samples = []
+    for path in sample_paths():
+        with open(path, 'rb') as sample_file:
+            samples.append(sample_file.read(HEAD_SIZE))
+    return samples
+
+
+def head_benchmark(pool: MagicPool, iterations: int) -> None:
+    streams = []
+    for path in sample_paths():
+        with open(path, 'rb') as sample_file:
+            streams.append(io.BytesIO(sample_file.read()))
+
+    def read_head():
+        for stream in streams:
+            head = stream.read(HEAD_SIZE)
+            stream.seek(0)
+            pool.from_buffer(head)
+
+    def view_head():
+        for stream in streams:
+            with head_view(stream) as head:
+                pool.from_buffer(head)
+
+    uploads = iterations * len(streams)
+    for label, function in (('read head', read_head), ('view head', view_head)):
+        elapsed = timeit.timeit(function, number=iterations)
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("{:<20} {:>10.1f} us/upload {:>10} bytes peak".format(
+            label, elapsed / uploads * 1000000, peak))
+
+
+def main(iterations: int = 20) -> None:
+    samples = load_samples()
+    pool = MagicPool()
+
+    def fresh_handle():
+        for sample in samples:
+            magic.Magic(mime=True).from_buffer(sample)
+
+    def pooled_handle():
+        for sample in samples:
+            pool.from_buffer(sample)
+
+    uploads = iterations * len(samples)
+    for label, function in (('fresh magic.Magic', fresh_handle),
+                            ('MagicPool', pooled_handle)):
+        elapsed = timeit.timeit(function, number=iterations)
+        print("{:<20} {:>10.1f} us/upload".format(
+            label, elapsed / uploads * 1000000))
+    head_benchmark(pool, iterations)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,75 @@
+# encoding: utf-8
+""" Benchmarks of cold start: importing and configuring the validator,
+building its type policy from the types file, and the first validation,
+each in a fresh interpreter.
+
+CKAN's own imports are made before timing starts, since every worker
+pays for those whether or not this extension is installed.
+
+Run from the repository root, optionally saving or comparing a baseline:
+
+    python test/benchmarks/bench_startup.py --save baseline.json
+    python test/benchmarks/bench_startup.py --compare baseline.json
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import typing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import harness  # noqa: E402
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+
+CHILD_SETUP = '''
+import io, sys, time
+sys.path.insert(0, {root!r})
+import ckan.model, ckan.plugins.toolkit, ckan.logic, ckan.lib.uploader
+from werkzeug.datastructures import FileStorage
+start = time.perf_counter()
+from ckanext.resource_type_validation.resource_type_validation import ResourceTypeValidator
+validator = ResourceTypeValidator({config!r})
+'''
+
+STEPS = {
+    'configure': '',
+    'policy': 'validator.policy',
+    'first_validation': '''validator.validate_resource_mimetype({
+    'url': 'example.csv', 'format': 'CSV',
+    'upload': FileStorage(filename='example.csv', stream=io.BytesIO(b'a,b\\n1,2\\n'))})''',
+}
+
+
+def cold_start(config: 'dict[str, str]', step: str, rounds: int) -> harness.Result:
+    """ Time 'step' from a cold start, in a fresh interpreter per round.
+    """
+    code = CHILD_SETUP.format(root=os.path.abspath(ROOT_DIR), config=config) + step \
+        + '\nprint(time.perf_counter() - start)\n'
+    timings = []
+    for _ in range(rounds + 1):
+        output = subprocess.run([sys.executable, '-c', code], check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        timings.append(float(output.split()[-1]) * 1000000)
+    # the first round warms the disk cache
+    timings = timings[1:]
+    return harness.Result(statistics.median(timings), min(timings), max(timings), rounds)
+
+
+def startup_benchmarks() -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    config = {'ckan.site_url': 'http://ckan:5000/'}
+    return {'startup/' + step: lambda rounds, step=step: cold_start(config, STEPS[step], rounds)
+            for step in STEPS}
+
+
+def main() -> int:
+    parser = harness.argument_parser(__doc__.strip().splitlines()[0])
+    args = parser.parse_args()
+    return harness.run(startup_benchmarks(), args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
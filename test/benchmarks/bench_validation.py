@@ -0,0 +1,416 @@
+# encoding: utf-8
+""" Benchmarks of the validation hot path: type relationship, extension,
+file type, signature and URL lookups, text structure checks, end-to-end
+validation of every sample file, synthetic large uploads, and concurrent
+validation.
+
+Run from the repository root, optionally saving or comparing a baseline:
+
+    python test/benchmarks/bench_validation.py --save baseline.json
+    python test/benchmarks/bench_validation.py --compare baseline.json
+
+Baselines are specific to the machine and libmagic version that
+produced them, which are recorded alongside the results.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import itertools
+import mimetypes
+import os
+import re
+import sys
+import tempfile
+import typing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import magic  # noqa: E402
+
+from ckan.logic import ValidationError  # noqa: E402
+from werkzeug.datastructures import FileStorage as FlaskFileStorage  # noqa: E402
+
+from ckanext.resource_type_validation.resource_type_validation import ResourceTypeValidator  # noqa: E402
+from ckanext.resource_type_validation.sniffer import CDFV2_CORRUPT, MagicPool  # noqa: E402
+from ckanext.resource_type_validation.test_mime_type_validation import \
+    coalesce_types, sample_files  # noqa: E402
+import harness  # noqa: E402
+
+RESOURCES_DIR = os.path.join(os.path.dirname(__file__), '..', 'resources')
+CONFIG = {'ckan.site_url': 'http://ckan:5000/'}
+MIB = 1024 * 1024
+
+
+def sample_content(filename: str) -> bytes:
+    with open(os.path.join(RESOURCES_DIR, filename), 'rb') as sample_file:
+        return sample_file.read()
+
+
+def load_samples() -> 'list[tuple[str, str, bytes]]':
+    """ Returns the filename, format, and contents of each sample file
+    known to the validation tests.
+    """
+    samples = []
+    for filename, resource_format, _ in sample_files:
+        path = os.path.join(RESOURCES_DIR, filename)
+        if os.path.isfile(path):
+            samples.append((filename, resource_format, sample_content(filename)))
+    return samples
+
+
+def validate(validator: ResourceTypeValidator, filename: str, resource_format: str,
+             stream: 'typing.IO[bytes]') -> None:
+    validator.validate_resource_mimetype({
+        'url': filename, 'format': resource_format,
+        'upload': FlaskFileStorage(filename=filename, stream=stream)})
+
+
+def type_benchmarks(validator: ResourceTypeValidator) -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    types = sorted({mime_type for group in validator.policy.equal_types for mime_type in group}
+                   | set(validator.policy.allowed_overrides)
+                   | {mime_type for overrides in validator.policy.allowed_overrides.values()
+                      for mime_type in overrides if '*' not in mime_type}
+                   | {'text/csv', 'application/pdf', 'image/png', 'application/x-unknown'})
+    pairs = list(itertools.product(types + [None], repeat=2))
+
+    def coalesce():
+        for candidates, _ in coalesce_types:
+            validator.coalesce_mime_types(candidates)
+
+    def valid_override():
+        for first, second in pairs:
+            validator.is_valid_override(first, second)
+
+    def equals():
+        for first, second in pairs:
+            validator.type_equals(first, second)
+
+    return {
+        'coalesce_mime_types': lambda rounds: harness.measure(coalesce, len(coalesce_types), rounds * 20),
+        'is_valid_override': lambda rounds: harness.measure(valid_override, len(pairs), rounds),
+        'type_equals': lambda rounds: harness.measure(equals, len(pairs), rounds),
+    }
+
+
+def lookup_benchmarks(validator: ResourceTypeValidator) -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    """ Extension and format lookups through the validator's registry,
+    against the 'mimetypes' module it replaced.
+    """
+    registry = validator.policy.file_types
+    filenames = ['example' + extension for extension in sorted(registry.extensions)] \
+        + ['http://example.com/data.csv?download=true', 'example.csv.gz', 'example.unknown']
+    formats = [extension[1:].upper() for extension in sorted(registry.extensions)] + ['None', 'unknown']
+
+    def registry_filenames():
+        for filename in filenames:
+            registry.type_for_filename(filename)
+
+    def registry_formats():
+        for resource_format in formats:
+            registry.type_for_format(resource_format)
+
+    def guess_filenames():
+        for filename in filenames:
+            mimetypes.guess_type(filename, strict=False)
+
+    def guess_formats():
+        for resource_format in formats:
+            mimetypes.guess_type('example.' + resource_format, strict=False)
+
+    return {
+        'lookup/registry_filename': lambda rounds: harness.measure(registry_filenames, len(filenames), rounds),
+        'lookup/guess_type_filename': lambda rounds: harness.measure(guess_filenames, len(filenames), rounds),
+        'lookup/registry_format': lambda rounds: harness.measure(registry_formats, len(formats), rounds),
+        'lookup/guess_type_format': lambda rounds: harness.measure(guess_formats, len(formats), rounds),
+    }
+
+
+def signature_benchmarks(validator: ResourceTypeValidator) -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    """ Signature lookups against libmagic, for the sample files that
+    signatures recognise, and their cost for those they don't.
+    """
+    signatures = validator.policy.signatures
+    heads = [content[:2048] for _, _, content in load_samples()]
+    hits = [head for head in heads if signatures.match(head)]
+    misses = [head for head in heads if not signatures.match(head)]
+
+    def match(heads: 'list[bytes]'):
+        return lambda: [signatures.match(head) for head in heads]
+
+    def libmagic(heads: 'list[bytes]'):
+        return lambda: [validator.sniffer.from_buffer(head) for head in heads]
+
+    return {
+        'signature/match_hits': lambda rounds: harness.measure(match(hits), len(hits), rounds * 10),
+        'signature/libmagic_hits': lambda rounds: harness.measure(libmagic(hits), len(hits), rounds),
+        'signature/match_misses': lambda rounds: harness.measure(match(misses), len(misses), rounds * 10),
+    }
+
+
+def text_benchmarks(validator: ResourceTypeValidator) -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    """ Structure checks of the sample files that libmagic reports
+    as text of an uncertain type, within the default budget.
+    """
+    text_types = validator.policy.text_types
+    benchmarks = {}
+
+    def classify(content: bytes):
+        return lambda rounds: harness.measure(
+            lambda: text_types.classify(io.BytesIO(content), validator.text_sniff_bytes), 1, rounds)
+
+    for filename, _, content in load_samples():
+        if validator.sniffer.from_buffer(content[:2048]) in text_types.uncertain_types:
+            benchmarks['text/{}'.format(filename)] = classify(content)
+    return benchmarks
+
+
+def pathological_urls() -> 'list[str]':
+    """ Long URLs full of dots and no allowed extension, the worst case
+    for a '.*\\.(a|b|...)$' pattern.
+    """
+    return ['http://example.com/' + 'a.' * 500 + 'exe',
+            'http://example.com/data.csv?' + '&x=a.b' * 200,
+            'http://example.com/' + '.csv' * 250 + '/download']
+
+
+def extension_benchmarks(validator: ResourceTypeValidator) -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    """ The extension index against the alternation pattern it replaced.
+    """
+    extensions = validator.policy.extensions
+    pattern = re.compile(r'.*\.(' + '|'.join(sorted(extensions.allowed or ())) + ')$', re.I)
+    urls = pathological_urls()
+    filenames = ['example' + extension for extension in sorted(validator.policy.file_types.extensions)]
+
+    def index_check(names: 'list[str]'):
+        return lambda: [extensions.is_allowed(name) for name in names]
+
+    def pattern_check(names: 'list[str]'):
+        return lambda: [pattern.search(name) for name in names]
+
+    def validate_urls():
+        for url in urls:
+            validate_ignoring_errors(validator, url, 'CSV', io.BytesIO(b'a,b\n1,2\n'))
+
+    return {
+        'extension/index_filenames': lambda rounds: harness.measure(
+            index_check(filenames), len(filenames), rounds * 10),
+        'extension/pattern_filenames': lambda rounds: harness.measure(
+            pattern_check(filenames), len(filenames), rounds * 10),
+        'extension/index_pathological_urls': lambda rounds: harness.measure(
+            index_check(urls), len(urls), rounds),
+        'extension/pattern_pathological_urls': lambda rounds: harness.measure(
+            pattern_check(urls), len(urls), rounds),
+        'extension/validate_pathological_urls': lambda rounds: harness.measure(validate_urls, len(urls), rounds),
+    }
+
+
+def url_benchmarks(validator: ResourceTypeValidator) -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    """ URL classification, remembered and not, against the pair of
+    patterns it replaced.
+    """
+    download_pattern = re.compile(
+        CONFIG['ckan.site_url'] + '(/[-_a-z0-9]+){2}/resource/[-0-9a-f]+/download', re.IGNORECASE)
+    remote_pattern = re.compile(r'^[a-z+]+://')
+    urls = ['http://ckan:5000/dataset/example-{0}/resource/{0:08x}-0000/download/data.csv'.format(i)
+            for i in range(50)]
+    urls += ['https://example.com/files/{}/data.csv'.format(i) for i in range(50)]
+    urls += ['data-{}.csv'.format(i) for i in range(50)] + pathological_urls()
+
+    def classify():
+        return [validator.urls.classify(url) for url in urls]
+
+    def classify_uncached():
+        validator.urls.classify.cache_clear()
+        return classify()
+
+    def pattern_classify():
+        return [remote_pattern.search(download_pattern.sub('', url)) for url in urls]
+
+    return {
+        'urls/classify': lambda rounds: harness.measure(classify, len(urls), rounds * 10),
+        'urls/classify_uncached': lambda rounds: harness.measure(classify_uncached, len(urls), rounds * 10),
+        'urls/pattern': lambda rounds: harness.measure(pattern_classify, len(urls), rounds * 10),
+    }
+
+
+def sample_benchmarks(validator: ResourceTypeValidator) -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    samples = load_samples()
+    benchmarks = {}
+
+    def sample_benchmark(filename: str, resource_format: str, content: bytes):
+        return lambda rounds: harness.measure(
+            lambda: validate(validator, filename, resource_format, io.BytesIO(content)), 1, rounds * 10)
+
+    for filename, resource_format, content in samples:
+        benchmarks['validate/{}/{}'.format(filename, resource_format)] = \
+            sample_benchmark(filename, resource_format, content)
+
+    def all_samples():
+        for filename, resource_format, content in samples:
+            validate(validator, filename, resource_format, io.BytesIO(content))
+
+    benchmarks['validate/all_samples'] = lambda rounds: harness.measure(all_samples, len(samples), rounds)
+    return benchmarks
+
+
+def rejection_benchmarks(validator: ResourceTypeValidator) -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    """ Uploads that can be rejected from their names alone,
+    against one that must be sniffed first.
+    """
+    content = sample_content('dummy.pdf')
+
+    def rejection_benchmark(filename: str, resource_format: str):
+        return lambda rounds: harness.measure(
+            lambda: validate_ignoring_errors(validator, filename, resource_format, io.BytesIO(content)),
+            1, rounds * 100)
+
+    return {
+        'reject/extension': rejection_benchmark('dummy.exe', 'PDF'),
+        'reject/format': rejection_benchmark('dummy.pdf', 'CSV'),
+        'reject/content': rejection_benchmark('dummy.txt', 'TXT'),
+    }
+
+
+class TruncatedDocumentMagic:
+    """ libmagic handle that, like older libmagic, reports a corrupt
+    Composite Document File for any buffer short of 'needed' bytes,
+    so that the full-content sniffing fallback is always exercised.
+    """
+
+    def __init__(self, needed: int):
+        self.needed = needed
+        self.mime = magic.Magic(mime=True)
+
+    def from_buffer(self, buffer: bytes) -> str:
+        if len(buffer) < self.needed:
+            return CDFV2_CORRUPT
+        return self.mime.from_buffer(buffer)
+
+    def from_descriptor(self, fd: int) -> str:
+        return self.mime.from_descriptor(fd)
+
+
+def fallback_validator() -> ResourceTypeValidator:
+    validator = ResourceTypeValidator(CONFIG)
+    validator.sniffer = MagicPool(factory=lambda: TruncatedDocumentMagic(validator.max_sniff_bytes))
+    return validator
+
+
+def validate_ignoring_errors(validator: ResourceTypeValidator, filename: str, resource_format: str,
+                             stream: 'typing.IO[bytes]') -> None:
+    try:
+        validate(validator, filename, resource_format, stream)
+    except ValidationError:
+        # synthetic content may be rejected; only the cost matters
+        pass
+
+
+def sparse_xls_benchmark(temp_dir: str, size: int) -> 'typing.Callable[[int], harness.Result]':
+    """ An OLE2 header followed by gigabytes of holes,
+    sniffed in full via its file descriptor.
+    """
+    validator = fallback_validator()
+
+    def benchmark(rounds: int) -> harness.Result:
+        path = os.path.join(temp_dir, 'sparse.xls')
+        with open(path, 'wb') as large_file:
+            large_file.write(sample_content('example.xls')[:2048])
+            large_file.truncate(size)
+
+        def run():
+            with open(path, 'rb') as large_file:
+                validate_ignoring_errors(validator, 'sparse.xls', 'XLS', large_file)
+        return harness.measure(run, 1, rounds)
+    return benchmark
+
+
+def large_csv_benchmark(temp_dir: str, size: int) -> 'typing.Callable[[int], harness.Result]':
+    validator = ResourceTypeValidator(CONFIG)
+
+    def benchmark(rounds: int) -> harness.Result:
+        path = os.path.join(temp_dir, 'large.csv')
+        rows = b'1234,"Example Street",-27.4698,153.0251,2024-01-01T00:00:00\n' * 1000
+        with open(path, 'wb') as large_file:
+            large_file.write(b'id,address,latitude,longitude,recorded\n')
+            for _ in range(size // len(rows)):
+                large_file.write(rows)
+
+        def run():
+            with open(path, 'rb') as large_file:
+                validate(validator, 'large.csv', 'CSV', large_file)
+        return harness.measure(run, 1, rounds)
+    return benchmark
+
+
+def corrupt_cdfv2_benchmark(rounds: int) -> harness.Result:
+    """ A truncated OLE2 document held in memory, which is sniffed
+    in growing windows up to the configured cap.
+    """
+    validator = fallback_validator()
+    content = sample_content('example.xls')[:4096] + b'\0' * (2 * validator.max_sniff_bytes)
+    return harness.measure(
+        lambda: validate_ignoring_errors(validator, 'truncated.xls', 'XLS', io.BytesIO(content)),
+        1, rounds)
+
+
+def large_file_benchmarks(temp_dir: str, sparse_size: int,
+                          csv_size: int) -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    return {
+        'large/sparse_xls_{}MiB'.format(sparse_size // MIB): sparse_xls_benchmark(temp_dir, sparse_size),
+        'large/csv_{}MiB'.format(csv_size // MIB): large_csv_benchmark(temp_dir, csv_size),
+        'large/corrupt_cdfv2_in_memory': corrupt_cdfv2_benchmark,
+    }
+
+
+def concurrency_benchmarks(validator: ResourceTypeValidator,
+                           thread_counts: 'list[int]') -> 'dict[str, typing.Callable[[int], harness.Result]]':
+    samples = load_samples() * 4
+
+    def concurrent(threads: int):
+        def run():
+            with ThreadPoolExecutor(threads) as executor:
+                for _ in executor.map(
+                        lambda sample: _validate_sample(validator, sample), samples):
+                    pass
+        return lambda rounds: harness.measure(run, len(samples), rounds)
+
+    return {'concurrent/{}_threads'.format(threads): concurrent(threads)
+            for threads in thread_counts}
+
+
+def _validate_sample(validator: ResourceTypeValidator, sample: 'tuple[str, str, bytes]') -> None:
+    filename, resource_format, content = sample
+    validate(validator, filename, resource_format, io.BytesIO(content))
+
+
+def main() -> int:
+    parser = harness.argument_parser(__doc__.strip().splitlines()[0])
+    parser.add_argument('--sparse-size', type=int, default=4096,
+                        help="Size in MiB of the sparse large file (default %(default)s)")
+    parser.add_argument('--csv-size', type=int, default=256,
+                        help="Size in MiB of the large CSV file (default %(default)s)")
+    parser.add_argument('--threads', default='1,4,16',
+                        help="Comma-separated thread counts for concurrent validation")
+    parser.add_argument('--tmpdir', help="Directory for the synthetic large files")
+    args = parser.parse_args()
+
+    validator = ResourceTypeValidator(CONFIG)
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as temp_dir:
+        benchmarks = {}
+        benchmarks.update(type_benchmarks(validator))
+        benchmarks.update(lookup_benchmarks(validator))
+        benchmarks.update(signature_benchmarks(validator))
+        benchmarks.update(text_benchmarks(validator))
+        benchmarks.update(extension_benchmarks(validator))
+        benchmarks.update(url_benchmarks(validator))
+        benchmarks.update(sample_benchmarks(validator))
+        benchmarks.update(rejection_benchmarks(validator))
+        benchmarks.update(large_file_benchmarks(temp_dir, args.sparse_size * MIB, args.csv_size * MIB))
+        benchmarks.update(concurrency_benchmarks(
+            validator, [int(threads) for threads in args.threads.split(',')]))
+        return harness.run(benchmarks, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
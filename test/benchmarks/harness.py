@@ -0,0 +1,138 @@
+# encoding: utf-8
+""" Shared machinery for the benchmark scripts: timing, JSON baselines,
+and comparison of a run against a saved baseline.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import typing
+
+import magic
+
+DEFAULT_TOLERANCE = 0.25
+
+
+class Result(typing.NamedTuple):
+    """ Timing of one benchmark, in microseconds per operation.
+    """
+    median_us: float
+    min_us: float
+    max_us: float
+    operations: int
+
+    def describe(self) -> str:
+        return "{:>12.2f} us/op (min {:.2f}, max {:.2f}, {} ops)".format(
+            self.median_us, self.min_us, self.max_us, self.operations)
+
+
+def measure(function: 'typing.Callable[[], typing.Any]', operations: int = 1,
+            rounds: int = 5, warmup: int = 1) -> Result:
+    """ Time 'rounds' calls of 'function', each of which performs
+    'operations' operations, after 'warmup' untimed calls.
+    """
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) / operations * 1000000)
+    return Result(statistics.median(timings), min(timings), max(timings), operations * rounds)
+
+
+def environment() -> 'dict[str, typing.Any]':
+    try:
+        libmagic = magic.version()
+    except (AttributeError, NotImplementedError):
+        libmagic = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'libmagic': libmagic,
+        'recorded': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def save_baseline(path: str, results: 'dict[str, Result]') -> None:
+    with open(path, 'w') as baseline_file:
+        json.dump({'environment': environment(),
+                   'results': {name: result._asdict() for name, result in results.items()}},
+                  baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def load_baseline(path: str) -> 'dict[str, Result]':
+    with open(path) as baseline_file:
+        baseline = json.load(baseline_file)
+    return {name: Result(**result) for name, result in baseline['results'].items()}
+
+
+def compare(results: 'dict[str, Result]', baseline: 'dict[str, Result]',
+            tolerance: float = DEFAULT_TOLERANCE) -> 'list[str]':
+    """ Print each result against its baseline.
+    Returns the names of benchmarks whose median slowed by more than
+    'tolerance', as a fraction of the baseline median.
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            print("{:<48} {:>12.2f} us/op (no baseline)".format(name, result.median_us))
+            continue
+        ratio = result.median_us / previous.median_us if previous.median_us else float('inf')
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print("{:<48} {:>12.2f} us/op vs {:>12.2f} ({:+.1%}){}".format(
+            name, result.median_us, previous.median_us, ratio - 1,
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def argument_parser(description: str) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-k', '--filter', default='',
+                        help="Only run benchmarks whose names contain this text")
+    parser.add_argument('--rounds', type=int, default=5,
+                        help="Timed rounds per benchmark")
+    parser.add_argument('--save', metavar='BASELINE',
+                        help="Save the results as a JSON baseline")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="Compare the results with a JSON baseline, "
+                        "exiting with status 1 on any regression")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown before a result counts as "
+                        "a regression, as a fraction (default %(default)s)")
+    return parser
+
+
+def run(benchmarks: 'dict[str, typing.Callable[[int], Result]]',
+        args: argparse.Namespace) -> int:
+    """ Run the selected benchmarks, then save or compare the results.
+    Returns the process exit status.
+    """
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if args.filter in name:
+            results[name] = benchmark(args.rounds)
+            if not args.compare:
+                print("{:<48} {}".format(name, results[name].describe()))
+            sys.stdout.flush()
+
+    if args.save:
+        save_baseline(args.save, results)
+        print("Saved baseline to {}".format(args.save))
+    if args.compare:
+        regressions = compare(results, load_baseline(args.compare), args.tolerance)
+        if regressions:
+            print("{} regression(s): {}".format(len(regressions), ', '.join(regressions)))
+            return 1
+    return 0